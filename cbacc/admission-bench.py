@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import random
+import argparse
+import ipaddress
+from os.path import abspath, dirname, join
+from datetime import datetime
+from importlib.machinery import SourceFileLoader
+
+'''
+Times cbacc-mgr's admission decision for one (S,G) joining or leaving,
+with the incremental AdmissionIndex against re-sorting every desired
+(S,G) in the same blocking order on each change, the way the admission
+pass used to, and checks that they block the same (S,G)s.
+
+The old pass' own order is different: it blocked the biggest offload
+first (against its comment saying the biggest offload is kept), and the
+index blocks the smallest offload first on purpose.  The "vs old"
+column counts the (S,G)s blocked by one and not the other at the end
+of each run, as the intended change.
+
+The (S,G)s all have the same priority unless --priorities is given,
+since the old pass' implied blocks don't make the same decisions.
+
+With --check, it runs regression checks of admission corner cases
+instead and exits non-zero if one fails.
+
+With --solvers, it compares the greedy decision against the optimal
+solver (cbacc-mgr --solver optimal) on a few synthetic channel mixes
+instead, for solve time, link utilization, and admitted offload.
+'''
+
+cbacc = SourceFileLoader('cbacc',
+        join(dirname(abspath(__file__)), 'cbacc-mgr.py')).load_module()
+
+def make_sg(idx, sources, priorities, rnd):
+    src = ipaddress.ip_address('198.18.0.1') + idx % sources
+    grp = ipaddress.ip_address('232.10.0.0') + idx
+    vals = {
+        'max-bits-per-second': str(rnd.choice([1, 2, 4, 8, 20])*1024*1024),
+        'priority': str(rnd.randrange(priorities) if priorities > 1 else 256),
+    }
+    return (src, grp), cbacc.SummedSG(src, grp, [cbacc.CbaccVals(vals)],
+            datetime.now(), rnd.randrange(1, 100))
+
+def greedy_blocked(sgs, max_bw, old_order=False):
+    '''
+    the (S,G)s blocked by sorting them all, without implied blocks, in
+    the index's blocking order or with old_order in the old pass' order
+    '''
+    total = sum(sginfo.sg_bw for sginfo in sgs.values())
+    if total <= max_bw:
+        return set()
+    ordering = []
+    for seq, (sg, sginfo) in enumerate(sgs.items()):
+        offload = (sginfo.population - 1)*sginfo.sg_bw
+        if old_order:
+            key = (offload, sginfo.sg_bw, 0)
+        else:
+            key = (1 if sginfo.over_advertised else 0, -offload, sginfo.sg_bw, 0, seq)
+        ordering.append((key, sg, sginfo))
+    blocked = set()
+    gap = total - max_bw
+    blocked_bw = 0
+    for key, sg, sginfo in sorted(ordering, key=lambda x: x[0], reverse=True):
+        if blocked_bw >= gap:
+            break
+        blocked.add(sg)
+        blocked_bw += sginfo.sg_bw
+    return blocked
+
+# name: (sgs, sources, priorities, MiBps choices, max population, load)
+MIXES = {
+    'small': (2000, 100, 1, [1, 2, 4, 8], 100, 1.5),
+    'video': (300, 30, 1, [4, 8, 20, 50], 1000, 2.0),
+    'bulky': (30, 10, 1, [100, 150, 250, 400], 50, 1.7),
+    'tiered': (1000, 20, 4, [2, 8, 20], 200, 1.5),
+}
+
+def mix_sgs(name, rnd):
+    count, sources, priorities, rates, max_pop, load = MIXES[name]
+    sgs = {}
+    for idx in range(count):
+        src = ipaddress.ip_address('198.18.0.1') + idx % sources
+        grp = ipaddress.ip_address('232.10.0.0') + idx
+        vals = {
+            'max-bits-per-second': str(rnd.choice(rates)*1024*1024),
+            'priority': str(rnd.randrange(priorities) if priorities > 1 else 256),
+        }
+        # a few popular channels and a long tail
+        pop = max(1, int(max_pop*rnd.paretovariate(1.2)/10))
+        sgs[(src, grp)] = cbacc.SummedSG(src, grp, [cbacc.CbaccVals(vals)],
+                datetime.now(), min(pop, max_pop))
+    max_bw = int(sum(sginfo.sg_bw for sginfo in sgs.values())/load)
+    return sgs, max_bw
+
+def run_solvers(buckets, time_limit, rnd):
+    print(f'{"mix":<8}{"sgs":>6}{"solver":>9}{"solve ms":>10}{"admitted":>10}{"util %":>8}{"offload Gb":>12}{"vs greedy":>11}')
+    for name in MIXES:
+        sgs, max_bw = mix_sgs(name, rnd)
+        t0 = time.perf_counter()
+        index = cbacc.AdmissionIndex(max_bw)
+        for sg, sginfo in sgs.items():
+            index.set(sg, sginfo, False)
+        index.rebalance()
+        greedy_time = time.perf_counter() - t0
+        greedy = set(sg for sg in sgs if index.status(sg) == 'admitted')
+
+        t0 = time.perf_counter()
+        optimal = cbacc.solve_admission(list(index.entries.values()), {},
+                max_bw, buckets, time_limit)
+        optimal_time = time.perf_counter() - t0
+        label = 'optimal'
+        if optimal is None:
+            optimal = greedy
+            label = 'timeout'
+
+        def offload(admitted):
+            return sum((sgs[sg].population-1)*sgs[sg].sg_bw for sg in admitted)
+        base = offload(greedy)
+        for solver, admitted, elapsed in (('greedy', greedy, greedy_time), (label, optimal, optimal_time)):
+            bw = sum(sgs[sg].sg_bw for sg in admitted)
+            print(f'{name:<8}{len(sgs):>6}{solver:>9}{elapsed*1000:>10.1f}{len(admitted):>10}{bw*100/max_bw:>8.1f}{offload(admitted)/(1024**3):>12.1f}{offload(admitted)*100/base if base else 100:>10.1f}%')
+
+def check_standin():
+    '''
+    an (S,G) without cbacc data joining a source with advertised
+    (S,G)s: its stand-in at the default bitrate (over the cap) is
+    blocked and held down, and the advertised ones stay admitted.
+    '''
+    mb = 1024*1024
+    index = cbacc.AdmissionIndex(40*mb)
+    src = ipaddress.ip_address('198.18.0.1')
+    sgs = []
+    for idx in range(5):
+        sg = (src, ipaddress.ip_address('232.10.0.1') + idx)
+        vals = {'max-bits-per-second': str(mb), 'priority': '10'}
+        index.set(sg, cbacc.SummedSG(sg[0], sg[1], [cbacc.CbaccVals(vals)],
+                datetime.now(), 5), False)
+        sgs.append(sg)
+    index.rebalance()
+    standin_sg = (src, ipaddress.ip_address('232.10.1.1'))
+    standin = cbacc.SummedSG(standin_sg[0], standin_sg[1],
+            [cbacc.standin_vals(41*mb)], datetime.now(), 5)
+    standin.spoofed = True
+    index.set(standin_sg, standin, False)
+    index.rebalance()
+    failed = []
+    if index.blocked_sgs() != [standin_sg]:
+        failed.append(f'stand-in joined: blocked {index.blocked_sgs()}')
+    index.hold(standin_sg)
+    index.rebalance()
+    admitted = [sg for sg in sgs if index.status(sg) == 'admitted']
+    if len(admitted) != len(sgs) or index.blocked_sgs():
+        failed.append(f'stand-in held: {len(admitted)} admitted, blocked {index.blocked_sgs()}')
+    return failed
+
+def percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals)-1, int(round(pct/100.0 * (len(sorted_vals)-1))))
+    return sorted_vals[idx]
+
+def run(count, changes, sources, priorities, load, check, rnd):
+    sgs = dict(make_sg(idx, sources, priorities, rnd) for idx in range(count))
+    max_bw = int(sum(sginfo.sg_bw for sginfo in sgs.values())/load)
+    index = cbacc.AdmissionIndex(max_bw)
+
+    t0 = time.perf_counter()
+    for sg, sginfo in sgs.items():
+        index.set(sg, sginfo, False)
+    index.rebalance()
+    index.take_touched()
+    build = time.perf_counter() - t0
+
+    idx_times = []
+    greedy_times = []
+    touched = 0
+    mismatches = 0
+    next_idx = count
+    for change in range(changes):
+        if change % 2:
+            sg, sginfo = make_sg(next_idx, sources, priorities, rnd)
+            next_idx += 1
+            sgs[sg] = sginfo
+            t0 = time.perf_counter()
+            index.set(sg, sginfo, False)
+        else:
+            sg = rnd.choice(list(sgs))
+            del(sgs[sg])
+            t0 = time.perf_counter()
+            index.remove(sg)
+        index.rebalance()
+        touched += len(index.take_touched())
+        idx_times.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        blocked = greedy_blocked(sgs, max_bw)
+        greedy_times.append(time.perf_counter() - t0)
+        if check and set(index.blocked_sgs()) != blocked:
+            mismatches += 1
+
+    vs_old = len(set(index.blocked_sgs()) ^ greedy_blocked(sgs, max_bw, True))
+    return build, sorted(idx_times), sorted(greedy_times), touched/changes, len(index.blocked_sgs()), mismatches, vs_old
+
+def main(args_in):
+    parser = argparse.ArgumentParser(
+            description='''
+Benchmark cbacc-mgr's incremental admission index against re-sorting
+all the desired (S,G)s on each change.''')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-n', '--sgs', default='1000,10000,100000',
+        help='comma-separated numbers of desired (S,G)s (default 1000,10000,100000)')
+    parser.add_argument('-c', '--changes', type=int, default=50,
+        help='single (S,G) joins and leaves to time at each size (default 50)')
+    parser.add_argument('-s', '--sources', type=int, default=100,
+        help='number of sources the (S,G)s are spread over (default 100)')
+    parser.add_argument('-p', '--priorities', type=int, default=1,
+        help='number of distinct priorities, >1 turns on implied blocks and skips the check (default 1)')
+    parser.add_argument('-l', '--load', type=float, default=1.25,
+        help='desired bitrate as a multiple of the capacity (default 1.25)')
+    parser.add_argument('--seed', type=int, default=1,
+        help='random seed (default 1)')
+    parser.add_argument('--check', action='store_true', default=False,
+        help='run regression checks of admission corner cases instead')
+    parser.add_argument('--solvers', action='store_true', default=False,
+        help='compare the greedy and optimal solvers on synthetic channel mixes instead')
+    parser.add_argument('--solver-buckets', type=int, default=1000,
+        help='bandwidth resolution of the optimal solver (default 1000)')
+    parser.add_argument('--solver-time', type=float, default=10.0,
+        help='seconds the optimal solver may take for each mix (default 10)')
+
+    args = parser.parse_args(args_in[1:])
+    cbacc.logger = cbacc.setup_logger('admission-bench', args.verbose)
+    cbacc.ingest_common.logger = cbacc.logger
+    rnd = random.Random(args.seed)
+    check = args.priorities <= 1
+
+    if args.check:
+        failed = check_standin()
+        print(f'check_standin: {"FAIL" if failed else "ok"}')
+        for msg in failed:
+            print(f'   {msg}')
+        return 1 if failed else 0
+
+    if args.solvers:
+        run_solvers(args.solver_buckets, args.solver_time, rnd)
+        return 0
+
+    print(f'{"sgs":>8}{"build s":>9}{"index p50 us":>14}{"p99 us":>9}{"greedy p50 ms":>15}{"p99 ms":>9}{"speedup":>9}{"touched":>9}{"blocked":>9}{"mismatch":>10}{"vs old":>8}')
+    for count in [int(v) for v in args.sgs.split(',')]:
+        build, idx_times, greedy_times, touched, blocked, mismatches, vs_old = run(count, args.changes, args.sources, args.priorities, args.load, check, rnd)
+        idx_p50 = percentile(idx_times, 50)
+        greedy_p50 = percentile(greedy_times, 50)
+        speedup = greedy_p50/idx_p50 if idx_p50 else 0
+        print(f'{count:>8}{build:>9.2f}{idx_p50*1e6:>14.1f}{percentile(idx_times,99)*1e6:>9.1f}{greedy_p50*1e3:>15.2f}{percentile(greedy_times,99)*1e3:>9.2f}{speedup:>8.0f}x{touched:>9.1f}{blocked:>9}{mismatches if check else "-":>10}{vs_old if check else "-":>8}')
+
+    return 0
+
+if __name__=="__main__":
+    ret = main(sys.argv)
+    sys.exit(ret)
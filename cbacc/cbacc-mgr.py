@@ -4,23 +4,40 @@ import sys
 import logging
 from ipaddress import ip_address
 from dns.resolver import Resolver
+import dns.resolver
+import dns.rdatatype
+import dns.exception
 import traceback
-import requests_cache
-from dns.resolver import Resolver
+import threading
+import queue
+import sqlite3
+import heapq
+import math
+import operator
 from itertools import groupby
 from requests import Request, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException, HTTPError
+from email.utils import parsedate_to_datetime
 import re
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import xml.etree.ElementTree as ET
 import random
 import time
 import json
 import argparse
 import signal
+import os
 from os.path import abspath, dirname, isfile, basename
 from enum import Enum
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from watchdog.observers import Observer
-from watchdog.events import PatternMatchingEventHandler
+# ingest_common.py is copied next to this script in the image, and is
+# in common/ in the source tree
+sys.path.append(os.path.join(dirname(abspath(__file__)), '..', 'common'))
+import ingest_common
+from ingest_common import JoinJournalWriter, JoinJournalReader, JoinfileWatcher
 
 logger=None
 sgmgr=None
@@ -49,9 +66,60 @@ def stop_handler(signum, frame):
     logger.info(f'{datetime.now()}: stopping cbacc-mgr.py')
     stopping = True
 
+# set by SIGHUP, the main loop does the reload (the signal handler can't
+# take the locks)
+reload_requested = threading.Event()
+def reload_handler(signum, frame):
+    reload_requested.set()
+
+def read_settings(args):
+    '''
+    reads the settings that can change without a restart: the command
+    line values, overridden by the "name=value" lines in args.settings_file
+    if it's given ("bandwidth" and "default" in MiBps, "hold-down" in
+    seconds, '#' starts a comment).  returns (max_bw, default_bw,
+    hold_down) in bytes per second and seconds.
+    '''
+    vals = {
+        'bandwidth': args.bandwidth,
+        'default': args.default,
+        'hold-down': args.hold_down,
+    }
+    if args.settings_file:
+        with open(args.settings_file) as f:
+            for line_num, line in enumerate(f, 1):
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                name, sep, val = [v.strip() for v in line.partition('=')]
+                if not sep or name not in vals:
+                    raise ValueError(f'{args.settings_file}:{line_num}: expected bandwidth, default, or hold-down=<value>, got "{line}"')
+                try:
+                    vals[name] = float(val)
+                except ValueError:
+                    raise ValueError(f'{args.settings_file}:{line_num}: bad value for {name}: "{val}"')
+    if vals['bandwidth'] <= 0 or vals['hold-down'] < 0:
+        raise ValueError(f'bandwidth must be positive and hold-down not negative: {vals}')
+    default_bw = vals['default']
+    if default_bw is None:
+        default_bw = vals['bandwidth']+1
+    return (int(vals['bandwidth']*1024*1024), int(default_bw*1024*1024),
+            vals['hold-down'])
+
 class Context(object):
     def __init__(self):
         self.session = None
+        self.discovery = DormsDiscovery()
+        self.metadata = MetadataCache()
+        # fetch all of a sender's groups in one request (see
+        # fetch_sender_info), except from servers that refused it
+        # recently
+        self.bulk = True
+        self.bulk_retry = 3600
+        self.no_bulk = {}  # api_pre -> time.time() to try bulk again
+        # senders the server didn't know (404), for the metadata default
+        # ttl, so their (S,G)s go straight to per-(S,G) requests
+        self.unknown_senders = {}  # sender url -> time.time() to ask again
 
 # https://softwareengineering.stackexchange.com/a/344274
 # http://utopia.duth.gr/~pefraimi/research/data/2007EncOfAlg.pdf
@@ -59,7 +127,19 @@ def weighted_shuffle(items, weights):
     order = sorted(range(len(items)), key=lambda i: (-random.random() ** (1.0 / weights[i])) if weights[i] > 0 else random.random())
     return [items[i] for i in order]
 
-def discover_dorms(source_ip):
+def srv_priority_groups(rrlist):
+    '''lists of (domain,port) from SRV records for each priority in order, each ordered randomly according to weight'''
+    groups = []
+    grouped = [(pri,[rr for rr in gr]) for pri,gr in groupby(sorted(rrlist, key=lambda r: r.priority), lambda r: r.priority)]
+    for pri,rrpri in sorted(grouped, key=lambda v: v[0]):
+        groups.append([(str(rr.target), str(rr.port)) for rr in weighted_shuffle(rrpri, [it.weight for it in rrpri])])
+    return groups
+
+def srv_preference_order(rrlist):
+    '''(domain,port) from SRV records, ordered by priority then randomly according to weight'''
+    return [server for group in srv_priority_groups(rrlist) for server in group]
+
+def discover_dorms(source_ip, dnsr=None):
     '''Returns list of dorms server (domain,port), ordered by priority then randomly according to weight'''
     src = ip_address(source_ip)
     name = '_dorms._tcp.' + src.reverse_pointer
@@ -71,84 +151,379 @@ def discover_dorms(source_ip):
     #  https://backreference.org/2010/11/17/dnssec-verification-with-dig/
     #  https://www.internetsociety.org/resources/deploy360/2013/dnssec-test-sites/
 
-    dnsr = Resolver()
+    if dnsr is None:
+        dnsr = Resolver()
     answer = dnsr.resolve(name, 'SRV')
-    rrlist = list(answer.rrset)
-    preference_ordering = []
-    grouped = [(pri,[rr for rr in gr]) for pri,gr in groupby(rrlist, lambda r: r.priority)]
-    for pri,rrpri in sorted(grouped, key=lambda v: v[0]):
-        preference_ordering.extend([(str(rr.target), str(rr.port)) for rr in weighted_shuffle(rrpri, [it.weight for it in rrpri])])
-    return preference_ordering
+    return srv_preference_order(list(answer.rrset))
 
-def find_base_uri(context, source_ip):
-    '''takes source ip, returns url prefix for dorms queries.  optionally accepts a requests.Session() object to maintain shared connection'''
+def negative_ttl(e):
+    '''
+    the negative caching TTL from the SOA in the authority section of
+    an NXDOMAIN or NODATA response (RFC 2308 section 5), or None
+    '''
+    try:
+        if isinstance(e, dns.resolver.NXDOMAIN):
+            responses = e.responses().values()
+        else:
+            responses = [e.response()]
+    except Exception:
+        return None
+    ttl = None
+    for response in responses:
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA and len(rrset) > 0:
+                soa_ttl = min(rrset.ttl, rrset[0].minimum)
+                if ttl is None or soa_ttl < ttl:
+                    ttl = soa_ttl
+    return ttl
+
+def dorms_url_prefix(domain, port):
+    if domain.endswith('.'):
+        domain = domain[:-1]
+    if port == "443" or port == "https":
+        return 'https://{domain}'.format(domain=domain)
+    return 'https://{domain}:{port}'.format(domain=domain, port=port)
+
+def check_dorms_server(session, domain, port, timeout=None):
+    '''
+    finds the restconf api root of a dorms server and checks the yang
+    library and module versions it supports.  returns the url prefix
+    for dorms queries, or raises.
+    '''
     global logger
-    servers = discover_dorms(source_ip)
-    # TBD: something like asyncio.staggered_race across the server options?
-    # for now just search for something satisfactory - jake 2020-07
+    url_pre = dorms_url_prefix(domain, port)
 
-    session = context.session
-    if not session:
-        session = Session()
-        context.session = session
-    api_pre = None
-    for domain, port in servers:
+    hostmeta_url = url_pre + '/.well-known/host-meta'
+    resp = session.get(hostmeta_url, headers={'Accept': 'application/xrd+xml'}, timeout=timeout)
+    root = ET.fromstring(resp.text)
+    path_base = root.findall('.//{http://docs.oasis-open.org/ns/xri/xrd-1.0}Link[@rel="restconf"]')[0].attrib['href']
+
+    api_pre = url_pre + path_base
+    if not api_pre.endswith('/'):
+        api_pre += '/'
+
+    json_accept = {'Accept': 'application/yang-data+json'}
+
+    lib_version_uri = api_pre + 'yang-library-version'
+    resp = session.get(lib_version_uri, headers=json_accept, timeout=timeout)
+    lib_version = resp.json()['ietf-restconf:yang-library-version']
+    supported_yang_library_versions = set(['2016-06-21'])
+    if lib_version not in supported_yang_library_versions:
+        logger.warning('{api_pre}yang-library-version is {date} (not in [{supported}]'.format(api_pre=api_pre, date=lib_version, supported=','.join(supported_yang_library_versions)))
+
+    supported_modules_uri = api_pre + 'data/ietf-yang-library:modules-state'
+    resp = session.get(supported_modules_uri, headers=json_accept, timeout=timeout)
+    supported_modules = resp.json()
+    mod_list = supported_modules['ietf-yang-library:modules-state']['module']
+
+    mod_info = {}
+    for mod in mod_list:
+        mod_info[mod['name']] = mod
+
+    supported_dorms_versions = set(['2019-08-25'])
+    if mod_info['ietf-dorms']['revision'] not in supported_dorms_versions:
+        logger.warning('dorms version is {date} (not in [{supported}]'.format(date=mod_info['ietf-dorms']['revision'], supported=','.join(supported_dorms_versions)))
+
+    supported_cbacc_versions = set(['2021-01-15'])
+    if mod_info['ietf-cbacc']['revision'] not in supported_cbacc_versions:
+        logger.warning('cbacc version is {date} (not in [{supported}]'.format(date=mod_info['ietf-cbacc']['revision'], supported=','.join(supported_cbacc_versions)))
+
+    return api_pre
+
+class DormsDiscovery(object):
+    '''
+    Caches dorms server discovery, so a new (S,G) from a sender that's
+    already been seen costs only its metadata GET.
+
+    The SRV answer for each source is kept until its TTL runs out
+    (failed lookups until their negative TTL, or retry seconds), and is
+    re-shuffled by weight on each use.  Each dorms server's checked api
+    root is kept for server_ttl seconds, shared by all the sources that
+    point at that server, and is forgotten early if a query to it fails.
+    A server that failed its check isn't tried again for retry seconds.
+
+    Parallel fetches share one lookup or check per source or server
+    while it's in flight, and take one of per_server slots for their
+    metadata query to a server.
+
+    The servers of the same SRV priority are checked in a staggered
+    race: the next one is started when the one before it fails or
+    hasn't answered within stagger seconds, and the first to pass its
+    check is used.  Servers are tried fastest first by how long their
+    last checks took, so a dead server costs a stagger interval instead
+    of a timeout (and is skipped for retry seconds after it fails).
+
+    With persist (a PersistentCache), SRV answers and checked servers
+    are saved, and read from it the first time they're needed.
+    '''
+    def __init__(self, server_ttl=1800, retry=30, per_server=8, stagger=0.25, timeout=10):
+        self.server_ttl = server_ttl
+        self.retry = retry
+        self.per_server = per_server
+        self.stagger = stagger
+        self.timeout = timeout
+        self.latency = {}  # (domain,port) -> seconds its checks take
+        self.persist = None
+        self.loaded = set()  # sources and servers looked up in persist
+        self.resolver = Resolver()
+        self.lock = threading.Lock()
+        self.key_locks = {}  # source ip or (domain,port) -> Lock
+        self.slots = {}  # api_pre -> BoundedSemaphore
+        self.sources = {}  # source ip -> (expiration, SRV rrs or exception)
+        self.servers = {}  # (domain,port) -> (expiration, api_pre or exception)
+        self.srv_lookups = 0
+        self.server_checks = 0
+
+    def key_lock(self, key):
+        with self.lock:
+            lock = self.key_locks.get(key)
+            if lock is None:
+                lock = threading.Lock()
+                self.key_locks[key] = lock
+            return lock
+
+    def server_slot(self, api_pre):
+        '''a semaphore limiting the queries in flight to one server'''
+        with self.lock:
+            slot = self.slots.get(api_pre)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.per_server)
+                self.slots[api_pre] = slot
+            return slot
+
+    def source_entry(self, src):
+        '''self.sources[src] or None, call with self.lock held'''
+        entry = self.sources.get(src)
+        if entry is None and self.persist and src not in self.loaded:
+            self.loaded.add(src)
+            entry = self.persist.load_source(str(src))
+            if entry:
+                self.sources[src] = entry
+        return entry
+
+    def server_entry(self, key):
+        '''self.servers[key] or None, call with self.lock held'''
+        entry = self.servers.get(key)
+        if entry is None and self.persist and key not in self.loaded:
+            self.loaded.add(key)
+            row = self.persist.load_server(*key)
+            if row:
+                expires, api_pre, latency = row
+                entry = (expires, api_pre)
+                self.servers[key] = entry
+                if latency is not None:
+                    self.latency.setdefault(key, latency)
+        return entry
+
+    def dorms_servers(self, source_ip):
+        '''
+        lists of (domain,port) of the dorms servers for source_ip for each
+        SRV priority, from cache while it's fresh
+        '''
+        src = ip_address(source_ip)
+        with self.key_lock(src):
+            return self.dorms_servers_locked(src)
+
+    def dorms_servers_locked(self, src):
+        global logger
+        now = time.time()
+        with self.lock:
+            entry = self.source_entry(src)
+        if entry and now < entry[0]:
+            val = entry[1]
+            if isinstance(val, Exception):
+                # not the cached one, which would keep adding to its
+                # traceback each time it's raised
+                raise Exception(f'dorms discovery for {src} failed recently: {val}') from val
+            return srv_priority_groups(val)
+
+        name = '_dorms._tcp.' + src.reverse_pointer
+        self.srv_lookups += 1
         try:
-            if domain.endswith('.'):
-                domain = domain[:-1]
-            if port == "443" or port == "https":
-                url_pre = 'https://{domain}'.format(domain=domain)
-            else:
-                url_pre = 'https://{domain}:{port}'.format(domain=domain, port=port)
-
-            session.headers.update({'Accept': 'application/xrd+xml'})
-
-            hostmeta_url = url_pre + '/.well-known/host-meta'
-            resp = session.get(hostmeta_url)
-            root = ET.fromstring(resp.text)
-            path_base = root.findall('.//{http://docs.oasis-open.org/ns/xri/xrd-1.0}Link[@rel="restconf"]')[0].attrib['href']
-
-            api_pre = url_pre + path_base
-            if not api_pre.endswith('/'):
-                api_pre += '/'
-
-            session.headers.update({'Accept': 'application/yang-data+json'})
-            
-            lib_version_uri = api_pre + 'yang-library-version'
-            resp = session.get(lib_version_uri)
-            lib_version = resp.json()['ietf-restconf:yang-library-version']
-            supported_yang_library_versions = set(['2016-06-21'])
-            if lib_version not in supported_yang_library_versions:
-                logger.warning('{api_pre}yang-library-version is {date} (not in [{supported}]'.format(api_pre=api_pre, date=lib_version, supported=','.join(supported_yang_library_versions)))
-
-            supported_modules_uri = api_pre + 'data/ietf-yang-library:modules-state'
-            resp = session.get(supported_modules_uri)
-            supported_modules = resp.json()
-            mod_list = supported_modules['ietf-yang-library:modules-state']['module']
-
-            mod_info = {}
-            for mod in mod_list:
-                mod_info[mod['name']] = mod
-
-            supported_dorms_versions = set(['2019-08-25'])
-            if mod_info['ietf-dorms']['revision'] not in supported_dorms_versions:
-                logger.warning('dorms version is {date} (not in [{supported}]'.format(date=mod_info['ietf-dorms']['revision'], supported=','.join(supported_dorms_versions)))
-
-            supported_cbacc_versions = set(['2021-01-15'])
-            if mod_info['ietf-cbacc']['revision'] not in supported_cbacc_versions:
-                logger.warning('cbacc version is {date} (not in [{supported}]'.format(date=mod_info['ietf-cbacc']['revision'], supported=','.join(supported_cbacc_versions)))
+            answer = self.resolver.resolve(name, 'SRV')
+        except dns.exception.DNSException as e:
+            ttl = None
+            if isinstance(e, (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)):
+                ttl = negative_ttl(e)
+            if ttl is None:
+                ttl = self.retry
+            with self.lock:
+                self.sources[src] = (now + ttl, e)
+            logger.info(f'cached failed dorms discovery for {src} for {ttl}s')
+            raise
+        rrlist = list(answer.rrset)
+        with self.lock:
+            self.sources[src] = (answer.expiration, rrlist)
+        if self.persist:
+            self.persist.save_source(str(src), answer.expiration, rrlist)
+        logger.info(f'cached {len(rrlist)} dorms servers for {src} for {answer.expiration - now:.0f}s')
+        return srv_priority_groups(rrlist)
+
+    def server_api(self, session, domain, port):
+        '''the checked api root for a dorms server, from cache while it's fresh'''
+        with self.key_lock((domain, port)):
+            return self.server_api_locked(session, domain, port)
+
+    def server_api_locked(self, session, domain, port):
+        global logger
+        key = (domain, port)
+        now = time.time()
+        with self.lock:
+            entry = self.server_entry(key)
+        if entry and now < entry[0]:
+            val = entry[1]
+            if isinstance(val, Exception):
+                raise Exception(f'dorms server {domain}:{port} failed its check recently: {val}') from val
+            return val
+
+        self.server_checks += 1
+        t0 = time.monotonic()
+        try:
+            api_pre = check_dorms_server(session, domain, port, self.timeout)
         except Exception as e:
-            logger.warning("got error with {domain}:{err}".format(domain=domain, err=sys.exc_info()[0]))
-            logger.info(traceback.format_exc())
-            api_pre = None
+            with self.lock:
+                self.servers[key] = (now + self.retry, e)
+            raise
+        elapsed = time.monotonic() - t0
+        with self.lock:
+            self.servers[key] = (now + self.server_ttl, api_pre)
+            prev = self.latency.get(key)
+            if prev is None:
+                self.latency[key] = elapsed
+            else:
+                self.latency[key] = 0.7*prev + 0.3*elapsed
+        if self.persist:
+            self.persist.save_server(domain, port, now + self.server_ttl,
+                    api_pre, self.latency[key])
+        logger.info(f'checked dorms server {domain}:{port} at {api_pre} in {elapsed*1000:.0f}ms ({self.server_checks} checks, {self.srv_lookups} srv lookups)')
+        return api_pre
+
+    def cached_api(self, domain, port):
+        '''
+        the server's checked api root if it's cached, False if its
+        check failed recently, or None if it needs checking.
+        '''
+        with self.lock:
+            entry = self.server_entry((domain, port))
+        if not entry or time.time() >= entry[0]:
+            return None
+        if isinstance(entry[1], Exception):
+            return False
+        return entry[1]
+
+    def race(self, session, servers):
+        '''
+        checks servers with staggered starts, returns the first api root
+        that passes its check, or None if they all fail.  the checks
+        still running are left to finish in the background, their
+        results are cached for later.
+        '''
+        global logger
+        results = queue.Queue()
+
+        def attempt(domain, port):
+            try:
+                results.put((domain, port, self.server_api(session, domain, port)))
+            except Exception as e:
+                logger.warning(f'got error with {domain}:{port}: {e}')
+                logger.info(traceback.format_exc())
+                results.put((domain, port, None))
+
+        running = 0
+        next_idx = 0
+        while next_idx < len(servers) or running:
+            timeout = None
+            if next_idx < len(servers):
+                domain, port = servers[next_idx]
+                next_idx += 1
+                running += 1
+                threading.Thread(name=f'dorms-check-{domain}', target=attempt,
+                        args=(domain, port), daemon=True).start()
+                if next_idx < len(servers):
+                    timeout = self.stagger
+            try:
+                domain, port, api_pre = results.get(timeout=timeout)
+            except queue.Empty:
+                # no answer within the stagger, start the next one too
+                continue
+            running -= 1
+            if api_pre:
+                if next_idx > 1:
+                    logger.info(f'dorms server {domain}:{port} won the race after starting {next_idx} of {len(servers)}')
+                return api_pre
+        return None
+
+    def invalidate(self, api_pre):
+        '''forget a server's checked api root, after a query to it failed'''
+        with self.lock:
+            for key, (expiration, val) in list(self.servers.items()):
+                if val == api_pre:
+                    del(self.servers[key])
+                    if self.persist:
+                        self.persist.forget_server(*key)
+
+    def last_base_uri(self, source_ip):
+        '''
+        the api root of a dorms server for source_ip that passed its
+        check, even if it's expired, or None.  doesn't touch the network.
+        '''
+        src = ip_address(source_ip)
+        with self.lock:
+            entry = self.source_entry(src)
+            if not entry or isinstance(entry[1], Exception):
+                return None
+            for group in srv_priority_groups(entry[1]):
+                for server in group:
+                    server_entry = self.server_entry(server)
+                    if server_entry and not isinstance(server_entry[1], Exception):
+                        return server_entry[1]
+        return None
+
+    def base_uri(self, session, source_ip):
+        global logger
+        groups = self.dorms_servers(source_ip)
+        servers = [server for group in groups for server in group]
+        for group in groups:
+            with self.lock:
+                for server in group:
+                    self.server_entry(server)
+                group = sorted(group,
+                        key=lambda server: self.latency.get(server, math.inf))
+            # the usual case: a server was already checked
+            candidates = []
+            for domain, port in group:
+                api_pre = self.cached_api(domain, port)
+                if api_pre:
+                    return api_pre
+                if api_pre is None:
+                    candidates.append((domain, port))
+            if not candidates:
+                continue
+            # one race at a time per source, the rest use its winner
+            with self.key_lock(('race', ip_address(source_ip))):
+                for domain, port in candidates:
+                    api_pre = self.cached_api(domain, port)
+                    if api_pre:
+                        return api_pre
+                api_pre = self.race(session, candidates)
+                if api_pre:
+                    return api_pre
 
-    if not api_pre:
         if len(servers):
             logger.error("errors on all {N} viable servers: {servers}".format(N=len(servers), servers=','.join(['%s:%s'%(domain,port) for domain,port in servers])))
         else:
             logger.error("no dorms servers found")
+        return None
 
-    return api_pre
+def find_base_uri(context, source_ip):
+    '''takes source ip, returns url prefix for dorms queries.  optionally accepts a requests.Session() object to maintain shared connection'''
+    session = context.session
+    if not session:
+        session = Session()
+        # enough pooled connections per server for the parallel fetches
+        session.mount('https://', HTTPAdapter(pool_maxsize=context.discovery.per_server))
+        context.session = session
+    return context.discovery.base_uri(session, source_ip)
 
 class CbaccVals(object):
     def __init__(self, cb_vals):
@@ -169,17 +544,445 @@ class CbaccVals(object):
             'priority': self.priority
         })
 
-def fetch_sg_info(ctx, source, group):
+def standin_vals(bw):
+    '''
+    the CbaccVals for an (S,G) without cbacc data (or whose fetch is
+    still running), at bitrate bw.  It gets the lowest priority, so
+    blocking it doesn't imply blocks on the advertised (S,G)s from the
+    same source.
+    '''
+    return CbaccVals({'max-bits-per-second':str(bw), 'priority':'-1'})
+
+class CachedMetadata(object):
+    def __init__(self, body, expires, etag, last_modified, checked):
+        self.body = body
+        self.expires = expires  # time.time() when it goes stale
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked = checked  # time.time() it was last fetched or revalidated
+
+class SrvRecord(object):
+    '''the fields of an SRV record loaded from the persistent cache'''
+    def __init__(self, target, port, priority, weight):
+        self.target = target
+        self.port = port
+        self.priority = priority
+        self.weight = weight
+
+class PersistentCache(object):
+    '''
+    Keeps the metadata cache and the discovered dorms servers in an
+    sqlite file, so after a restart the first admission decision can be
+    made from them instead of waiting on the network.
+
+    Rows are read when they're first needed, not at startup.  Writes are
+    batched and written every flush_interval seconds, and by flush().
+    Metadata that expired more than max_age seconds ago is dropped when
+    the file is opened.
+    '''
+    def __init__(self, fname, flush_interval=2.0, max_age=7*86400):
+        self.fname = fname
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = {}  # (table, key) -> row, or None to delete it
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS metadata (url TEXT PRIMARY KEY, body TEXT, expires REAL, etag TEXT, last_modified TEXT, checked REAL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, expires REAL, records TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS servers (domain TEXT, port TEXT, expires REAL, api_pre TEXT, latency REAL, PRIMARY KEY (domain, port))')
+            self.db.execute('DELETE FROM metadata WHERE expires < ?', (time.time() - max_age,))
+        self.flush_thread = threading.Thread(name='cache-flush',
+                target=self.flush_loop, daemon=True)
+        self.flush_thread.start()
+
+    KEYS = {
+        'metadata': ('url',),
+        'sources': ('source',),
+        'servers': ('domain', 'port'),
+    }
+
+    def row(self, table, key):
+        with self.lock:
+            if (table, key) in self.pending:
+                return self.pending[(table, key)]
+            where = ' AND '.join(f'{col}=?' for col in self.KEYS[table])
+            return self.db.execute(f'SELECT * FROM {table} WHERE {where}', key).fetchone()
+
+    def put(self, table, key, row):
+        with self.lock:
+            self.pending[(table, key)] = row
+
+    def flush(self):
+        global logger
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            if not pending:
+                return
+            try:
+                with self.db:
+                    for (table, key), row in pending.items():
+                        if row is None:
+                            where = ' AND '.join(f'{col}=?' for col in self.KEYS[table])
+                            self.db.execute(f'DELETE FROM {table} WHERE {where}', key)
+                        else:
+                            marks = ','.join('?'*len(row))
+                            self.db.execute(f'INSERT OR REPLACE INTO {table} VALUES ({marks})', row)
+            except sqlite3.Error as e:
+                logger.error(f'failed writing {len(pending)} rows to {self.fname}: {e}')
+
+    def flush_loop(self):
+        global logger
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'failed flushing {self.fname}: {e}\n{traceback.format_exc()}')
+
+    def load_metadata(self, url):
+        row = self.row('metadata', (url,))
+        if row is None:
+            return None
+        url, body, expires, etag, last_modified, checked = row
+        return CachedMetadata(json.loads(body), expires, etag, last_modified, checked)
+
+    def save_metadata(self, url, entry):
+        self.put('metadata', (url,), (url, json.dumps(entry.body),
+            entry.expires, entry.etag, entry.last_modified, entry.checked))
+
+    def load_source(self, source):
+        '''(expiration, [SrvRecord]) for a source, or None'''
+        row = self.row('sources', (source,))
+        if row is None:
+            return None
+        return row[1], [SrvRecord(*rr) for rr in json.loads(row[2])]
+
+    def save_source(self, source, expires, rrlist):
+        records = [(str(rr.target), int(rr.port), int(rr.priority), int(rr.weight)) for rr in rrlist]
+        self.put('sources', (source,), (source, expires, json.dumps(records)))
+
+    def load_server(self, domain, port):
+        '''(expiration, api_pre, latency) for a server that passed its check, or None'''
+        row = self.row('servers', (domain, port))
+        if row is None:
+            return None
+        return row[2], row[3], row[4]
+
+    def save_server(self, domain, port, expires, api_pre, latency):
+        self.put('servers', (domain, port), (domain, port, expires, api_pre, latency))
+
+    def forget_server(self, domain, port):
+        self.put('servers', (domain, port), None)
+
+def response_freshness(resp, default_ttl):
+    '''
+    seconds a response stays fresh (RFC 7234 section 4.2.1): max-age
+    less the Age, or Expires less Date, or 10% of the time since
+    Last-Modified, or default_ttl if the response says nothing.
+    no-cache and no-store make it stale right away.
+    '''
+    cache_control = {}
+    for directive in resp.headers.get('Cache-Control', '').split(','):
+        name, _, val = directive.strip().partition('=')
+        if name:
+            cache_control[name.lower()] = val.strip('"')
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return 0
+    age = 0
+    try:
+        age = int(resp.headers.get('Age', 0))
+    except ValueError:
+        pass
+    if 'max-age' in cache_control:
+        try:
+            return int(cache_control['max-age']) - age
+        except ValueError:
+            return 0
+    date = None
+    try:
+        date = parsedate_to_datetime(resp.headers['Date'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    if 'Expires' in resp.headers:
+        try:
+            expires = parsedate_to_datetime(resp.headers['Expires'])
+            if date is None:
+                return (expires - datetime.now(timezone.utc)).total_seconds()
+            return (expires - date).total_seconds() - age
+        except (TypeError, ValueError):
+            # invalid Expires means already expired
+            return 0
+    if date is not None and 'Last-Modified' in resp.headers:
+        try:
+            modified = parsedate_to_datetime(resp.headers['Last-Modified'])
+            return max(0, (date - modified).total_seconds()/10 - age)
+        except (TypeError, ValueError):
+            pass
+    return default_ttl
+
+class MetadataCache(object):
+    '''
+    An HTTP cache for dorms metadata GETs.  A response is fresh for as
+    long as its Cache-Control or Expires headers say (kept between
+    min_ttl and max_ttl, so a server saying no-cache isn't re-queried
+    on every joinfile change), and after that it's revalidated with
+    If-None-Match/If-Modified-Since, so metadata that hasn't changed
+    costs a 304 instead of a full response.
+
+    Validators are kept by url, after the (S,G) they were for is gone,
+    for up to max_entries urls.
+
+    Entries can also be filled from a bigger response (see
+    fetch_sender_info), with that response's freshness.  They keep the
+    validators from their own last response if the body is the same.
+
+    With persist (a PersistentCache), entries are saved as they change,
+    and read from it when they're not in memory.
+    '''
+    def __init__(self, default_ttl=1800, min_ttl=10, max_ttl=86400, max_entries=10000):
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # url -> CachedMetadata
+        self.persist = None
+        self.fresh_hits = 0
+        self.revalidated = 0
+        self.fetched = 0
+
+    def hit_ratio(self):
+        total = self.fresh_hits + self.revalidated + self.fetched
+        if not total:
+            return 0.0
+        return (self.fresh_hits + self.revalidated)/total
+
+    def stats(self):
+        return f'{self.fresh_hits} fresh, {self.revalidated} revalidated, {self.fetched} fetched, {self.hit_ratio()*100:.0f}% hits'
+
+    def get(self, session, url, headers, revalidate=False, checked_since=None):
+        '''
+        returns (json body, expiration as time.time()), from the cache
+        if it's fresh (unless revalidate, or if it was fetched or
+        revalidated after checked_since) or the server says it hasn't
+        changed.  The body is None if the server has no data for url
+        (a 404, which is cached like other responses).  Raises
+        requests.exceptions.HTTPError for other error responses.
+        '''
+        now = time.time()
+        with self.lock:
+            entry = self.entry(url)
+            if entry:
+                if ((now < entry.expires and not revalidate) or
+                        (checked_since is not None and entry.checked >= checked_since)):
+                    self.fresh_hits += 1
+                    return entry.body, entry.expires
+
+        req_headers = dict(headers)
+        if entry:
+            if entry.etag:
+                req_headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                req_headers['If-Modified-Since'] = entry.last_modified
+        resp = session.get(url, headers=req_headers)
+        ttl = min(self.max_ttl, max(self.min_ttl,
+                response_freshness(resp, self.default_ttl)))
+
+        with self.lock:
+            if resp.status_code == 304 and entry:
+                self.revalidated += 1
+                # a 304 carries the new freshness, and maybe new validators
+                entry.expires = now + ttl
+                entry.checked = now
+                entry.etag = resp.headers.get('ETag', entry.etag)
+                entry.last_modified = resp.headers.get('Last-Modified', entry.last_modified)
+                if self.persist:
+                    self.persist.save_metadata(url, entry)
+                return entry.body, entry.expires
+
+            if resp.status_code == 404:
+                body = None
+            else:
+                resp.raise_for_status()
+                body = resp.json()
+            self.fetched += 1
+            entry = CachedMetadata(body, now + ttl,
+                    resp.headers.get('ETag'), resp.headers.get('Last-Modified'), now)
+            self.store(url, entry)
+            return entry.body, entry.expires
+
+    def entry(self, url):
+        '''the cached entry for url or None, call with self.lock held'''
+        entry = self.entries.get(url)
+        if entry:
+            self.entries.move_to_end(url)
+        elif self.persist:
+            entry = self.persist.load_metadata(url)
+            if entry:
+                self.store(url, entry, save=False)
+        return entry
+
+    def store(self, url, entry, save=True):
+        self.entries[url] = entry
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        if save and self.persist:
+            self.persist.save_metadata(url, entry)
+
+    def fresh(self, url):
+        '''whether url is cached and still fresh'''
+        with self.lock:
+            entry = self.entry(url)
+            return entry is not None and time.time() < entry.expires
+
+    def checked(self, url, since):
+        '''whether url is cached and was fetched or revalidated after since'''
+        with self.lock:
+            entry = self.entry(url)
+            return entry is not None and entry.checked >= since
+
+    def peek(self, url):
+        '''(json body, expiration) for url even if it's stale, or None'''
+        with self.lock:
+            entry = self.entry(url)
+            if entry is None:
+                return None
+            return entry.body, entry.expires
+
+    def fill(self, items, expires):
+        '''caches (url, json body) items from a bigger response'''
+        now = time.time()
+        with self.lock:
+            for url, body in items:
+                etag = last_modified = None
+                old = self.entry(url)
+                if old and old.body == body:
+                    # still good for revalidating just this url
+                    etag = old.etag
+                    last_modified = old.last_modified
+                self.store(url, CachedMetadata(body, expires, etag, last_modified, now))
+
+def sg_cbacc_url(api_pre, src_ip, group_ip):
+    return api_pre+'data/ietf-dorms:metadata/sender={src}/group={grp}/ietf-cbacc:cbacc'.format(src=src_ip.exploded, grp=group_ip.exploded)
+
+def fetch_sender_info(ctx, api_pre, src_ip, group_ip, revalidate, since):
+    '''
+    fetches (or revalidates) the metadata for all the sender's groups
+    in one request, and caches each group's cbacc data as if it had
+    been fetched for that (S,G), unless another fetch for the same
+    sender already did that for group_ip since since.  Concurrent
+    fetches for a sender wait for the one in flight.
+
+    returns False if the server doesn't know the sender (it isn't asked
+    about it again for the metadata default ttl) or doesn't do sender
+    requests (it isn't asked again for bulk_retry seconds).
+    '''
+    global logger
+    sg_url = sg_cbacc_url(api_pre, src_ip, group_ip)
+    url = api_pre+'data/ietf-dorms:metadata/sender={src}'.format(src=src_ip.exploded)
+    with ctx.discovery.key_lock(('sender', url)):
+        if (ctx.no_bulk.get(api_pre, 0) > time.time() or
+                ctx.unknown_senders.get(url, 0) > time.time()):
+            return False
+        if ctx.metadata.checked(sg_url, since):
+            return True
+        try:
+            with ctx.discovery.server_slot(api_pre):
+                body, expires = ctx.metadata.get(ctx.session, url,
+                        {'Accept': 'application/yang-data+json'}, revalidate, since)
+        except HTTPError as e:
+            code = e.response.status_code
+            if code in (400, 405, 406, 413, 501):
+                logger.warning(f'{api_pre} refused a request for all of sender {src_ip} ({code}), fetching (S,G)s separately for {ctx.bulk_retry}s')
+                ctx.no_bulk[api_pre] = time.time() + ctx.bulk_retry
+                return False
+            raise
+        if body is None:
+            logger.info(f'{api_pre} has no metadata for sender {src_ip}, fetching its (S,G)s separately')
+            ctx.unknown_senders[url] = time.time() + ctx.metadata.default_ttl
+            return False
+        items = []
+        for sender in body.get('ietf-dorms:sender', []):
+            for grp in sender.get('group', []):
+                cbacc = grp.get('ietf-cbacc:cbacc')
+                if cbacc is None or 'group-address' not in grp:
+                    continue
+                items.append((sg_cbacc_url(api_pre, src_ip, ip_address(grp['group-address'])),
+                        {'ietf-cbacc:cbacc': cbacc}))
+        ctx.metadata.fill(items, expires)
+    logger.info(f'got cbacc info for {len(items)} groups from {src_ip} with {url}')
+    return True
+
+def fetch_sg_info(ctx, source, group, revalidate=False):
+    '''
+    returns ([CbaccVals], expiration datetime) for the (S,G), or None
+    instead of the CbaccVals if the server has no data for it.  with
+    revalidate, cached metadata is checked with the server even if it's
+    still fresh.
+
+    Unless ctx.bulk is off, metadata that isn't cached is fetched for
+    the whole sender at once, so the sender's other (S,G)s find theirs
+    in the cache.  It's fetched for just the (S,G) if the sender's
+    response didn't have it, or the server doesn't do sender requests.
+    '''
     global logger
     api_pre = find_base_uri(ctx, source)
+    if api_pre is None:
+        raise Exception(f'no usable dorms server for {source}')
     session = ctx.session
     src_ip=ip_address(source)
     group_ip=ip_address(group)
-    url=api_pre+'data/ietf-dorms:metadata/sender={src}/group={grp}/ietf-cbacc:cbacc'.format(src=src_ip.exploded, grp=group_ip.exploded)
-    logger.info(f'fetching cbacc info with {url}')
-    resp = session.get(url)
-    streams = [CbaccVals(resp.json()['ietf-cbacc:cbacc'])]
-    return streams
+    url=sg_cbacc_url(api_pre, src_ip, group_ip)
+    since = time.time()
+    checked_since = None
+    try:
+        if (ctx.bulk and ctx.no_bulk.get(api_pre, 0) < since and
+                (revalidate or not ctx.metadata.fresh(url))):
+            if fetch_sender_info(ctx, api_pre, src_ip, group_ip, revalidate, since):
+                checked_since = since
+        if ((revalidate or not ctx.metadata.fresh(url)) and
+                (checked_since is None or not ctx.metadata.checked(url, checked_since))):
+            logger.info(f'fetching cbacc info with {url}')
+        with ctx.discovery.server_slot(api_pre):
+            body, expires = ctx.metadata.get(session, url, {'Accept': 'application/yang-data+json'}, revalidate, checked_since)
+    except HTTPError as e:
+        if e.response.status_code >= 500:
+            ctx.discovery.invalidate(api_pre)
+        raise
+    except RequestException:
+        # check the server again (or find another) next time
+        ctx.discovery.invalidate(api_pre)
+        raise
+    if body is None:
+        logger.info(f'no cbacc info for ({src_ip},{group_ip}), asking again in {expires - time.time():.0f}s (metadata cache: {ctx.metadata.stats()})')
+        return None, datetime.fromtimestamp(expires)
+    logger.info(f'got cbacc info for ({src_ip},{group_ip}), fresh for {expires - time.time():.0f}s (metadata cache: {ctx.metadata.stats()})')
+    streams = [CbaccVals(body['ietf-cbacc:cbacc'])]
+    return streams, datetime.fromtimestamp(expires)
+
+def cached_sg_info(ctx, source, group):
+    '''
+    ([CbaccVals], expiration datetime) for the (S,G) from the cache, even
+    if it's expired, or None.  doesn't touch the network.
+    '''
+    api_pre = ctx.discovery.last_base_uri(source)
+    if api_pre is None:
+        return None
+    cached = ctx.metadata.peek(sg_cbacc_url(api_pre, ip_address(source), ip_address(group)))
+    if cached is None:
+        return None
+    body, expires = cached
+    if body is None:
+        return None
+    try:
+        streams = [CbaccVals(body['ietf-cbacc:cbacc'])]
+    except (KeyError, TypeError, ValueError):
+        return None
+    return streams, datetime.fromtimestamp(expires)
 
 class SummedSG(object):
     def __init__(self, source, group, udp_streams, expire_time, population):
@@ -194,9 +997,563 @@ class SummedSG(object):
         self.priority = min([cbi.priority for cbi in udp_streams])
         for cbi in udp_streams:
             self.sg_bw += cbi.max_bps
+        # data-rate-window is in ms, the advertised rate is averaged over it
+        self.rate_window = max([cbi.rate_window for cbi in udp_streams])/1000.0
+        self.advertised_bw = self.sg_bw
+        self.observed_bw = None
+        self.over_advertised = False
+        # a stand-in while the metadata fetch is still running
+        self.fetching = False
+        # when to refresh the metadata ahead of expire_time, None while
+        # a refresh is running
+        self.refresh_time = None
+        # refreshes that failed in a row, for backing off
+        self.refresh_failures = 0
+
+class ObservedRates(object):
+    '''
+    Follows the rates file written by driad-ingest --rates-file, for the
+    measured bitrates of the (S,G)s it's ingesting.  Each line is
+    "source,group,packets,bytes,bitrate,idle", after a
+    "# <unix time> <window>" line.
+
+    The byte counters are kept at each poll, so a bitrate can be
+    averaged over each (S,G)'s own data-rate-window rather than the
+    window driad-ingest uses.
+    '''
+    def __init__(self, fname, max_window=300, stale_after=10):
+        self.fname = fname
+        self.max_window = max_window
+        self.stale_after = stale_after
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.feed_time = None
+        self.history = {}  # (src,grp) -> deque of (unix time, bytes)
+
+    def poll(self):
+        '''
+        reads the rates file if it changed since the last poll, returns
+        whether it did.
+        '''
+        global logger
+        try:
+            mtime = os.stat(self.fname).st_mtime
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+
+        feed_time = None
+        counts = {}
+        try:
+            with open(self.fname) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if line.startswith('#'):
+                        feed_time = float(line[1:].split()[0])
+                        continue
+                    vals = line.split(',')
+                    counts[(ip_address(vals[0]), ip_address(vals[1]))] = int(vals[3])
+        except (OSError, ValueError, IndexError) as e:
+            logger.warning(f'failed to read rates from {self.fname}: {e}')
+            return False
+        if feed_time is None:
+            logger.warning(f'no "# <time> <window>" line in {self.fname}')
+            return False
+
+        with self.lock:
+            self.feed_time = feed_time
+            for sg in set(self.history) - set(counts):
+                del(self.history[sg])
+            for sg, nbytes in counts.items():
+                hist = self.history.get(sg)
+                if hist is None or nbytes < hist[-1][1]:
+                    # new, or rejoined and counting from 0 again
+                    hist = deque()
+                    self.history[sg] = hist
+                elif hist[-1][0] >= feed_time:
+                    continue
+                hist.append((feed_time, nbytes))
+                # keep one sample at least max_window old
+                while len(hist) > 2 and hist[1][0] <= feed_time - self.max_window:
+                    hist.popleft()
+        return True
+
+    def rate(self, sg, window):
+        '''
+        bits per second for sg averaged over at least the last window
+        seconds (up to max_window), or None if it hasn't been measured
+        that long or the rates file has gone stale.
+        '''
+        window = min(window, self.max_window)
+        with self.lock:
+            if self.feed_time is None or time.time() - self.feed_time > self.stale_after:
+                return None
+            hist = self.history.get(sg)
+            if not hist:
+                return None
+            end_time, end_bytes = hist[-1]
+            start = None
+            for sample in reversed(hist):
+                if sample[0] <= end_time - window and sample[0] < end_time:
+                    start = sample
+                    break
+            if start is None:
+                return None
+            start_time, start_bytes = start
+            return (end_bytes - start_bytes)*8/(end_time - start_time)
+
+class AdmissionEntry(object):
+    def __init__(self, sg, seq):
+        self.sg = sg
+        self.seq = seq
+        self.sginfo = None
+        self.bw = 0
+        self.priority = 0
+        self.key = None
+        # 'admitted', 'blocked', 'implied' or 'held'
+        self.where = None
+        # matches the entry's one live heap item, 0 when it's in neither heap
+        self.version = 0
+
+class SourceIndex(object):
+    '''the (S,G)s from one source, for blocks implied by priority'''
+    def __init__(self):
+        self.members = {}  # (src,grp) -> AdmissionEntry
+        self.by_pri = {}  # priority -> set of (src,grp)
+        self.blocked = {}  # priority -> count of blocked or held (S,G)s
+        self.implied = set()
+
+    def max_blocked(self, without=None):
+        '''the highest blocked priority, leaving out one without if given'''
+        best = None
+        for pri, count in self.blocked.items():
+            if pri == without:
+                count -= 1
+            if count > 0 and (best is None or pri > best):
+                best = pri
+        return best
+
+    def count_blocked(self, pri, delta):
+        count = self.blocked.get(pri, 0) + delta
+        if count:
+            self.blocked[pri] = count
+        else:
+            del(self.blocked[pri])
+
+class AdmissionIndex(object):
+    '''
+    The admission decision for the desired (S,G)s, kept up to date as
+    (S,G)s are added, removed, or change bitrate or population, instead
+    of re-sorting all of them on every update.
+
+    (S,G)s are ordered for blocking by: measured over their
+    advertisement or without cbacc data (stand-ins at the default
+    bitrate) first, then smallest offload ((population-1)*bitrate),
+    then biggest bitrate, then not already admitted.  The candidates
+    (desired and not held down) are split at a point in that order into
+    admitted and blocked, each a heap with its boundary end on top
+    (stale heap items are dropped when they surface):
+     - everything blocked comes before everything admitted,
+     - the admitted total is at most max_bw, and
+     - the last blocked one wouldn't fit with them,
+    which is the same split as blocking from the front of the order
+    until the rest fits.  A change moves (S,G)s across the boundary one
+    at a time, each O(log n).
+
+    When an (S,G) is blocked or held down, the (S,G)s of lower priority
+    from the same source are implied blocked, and don't count toward the
+    admitted total.  Blocked and held-down priorities are counted per
+    source, so this only looks at that source's (S,G)s.  Stand-ins have
+    the lowest priority (see standin_vals), so they don't imply blocks.
+
+    Changed (S,G)s are collected in touched for the caller.
+    '''
+    def __init__(self, max_bw):
+        self.max_bw = max_bw
+        self.entries = {}  # (src,grp) -> AdmissionEntry
+        self.sources = {}  # src -> SourceIndex
+        # max-heap of (negated key, version, sg)
+        self.admitted = []
+        # min-heap of (key, version, sg)
+        self.blocked = []
+        self.blocked_set = set()
+        self.implied_set = set()
+        self.admitted_bw = 0
+        self.admitted_count = 0
+        self.held_count = 0
+        self.seq = 0
+        self.version = 0
+        self.touched = set()
+
+    def block_key(self, entry, on):
+        sginfo = entry.sginfo
+        offload = (sginfo.population - 1)*sginfo.sg_bw
+        # stand-ins without cbacc data go first with the ones measured
+        # over their advertisement
+        return (1 if sginfo.over_advertised or sginfo.spoofed else 0, -offload, sginfo.sg_bw,
+                -1 if on else 0, entry.seq)
+
+    def status(self, sg):
+        entry = self.entries.get(sg)
+        if entry:
+            return entry.where
+        return None
+
+    def take_touched(self):
+        touched = self.touched
+        self.touched = set()
+        return touched
+
+    def blocked_sgs(self):
+        '''the (S,G)s blocked now (by order or implied), not the held-down ones'''
+        return list(self.blocked_set) + list(self.implied_set)
+
+    def top(self, heap):
+        '''the entry on top of heap, after dropping stale items'''
+        while heap:
+            item = heap[0]
+            entry = self.entries.get(item[2])
+            if entry and entry.version == item[1]:
+                return entry
+            heapq.heappop(heap)
+        return None
+
+    def put(self, entry, where):
+        self.version += 1
+        entry.version = self.version
+        entry.where = where
+        if where == 'admitted':
+            heapq.heappush(self.admitted, (tuple(-v for v in entry.key), entry.version, entry.sg))
+            self.admitted_bw += entry.bw
+            self.admitted_count += 1
+        else:
+            heapq.heappush(self.blocked, (entry.key, entry.version, entry.sg))
+            self.blocked_set.add(entry.sg)
+            self.sources[entry.sg[0]].count_blocked(entry.priority, 1)
+        self.touched.add(entry.sg)
+
+    def unfile(self, entry):
+        '''takes entry out of wherever it is'''
+        where = entry.where
+        if where == 'admitted':
+            self.admitted_bw -= entry.bw
+            self.admitted_count -= 1
+        elif where == 'blocked':
+            self.blocked_set.discard(entry.sg)
+            self.sources[entry.sg[0]].count_blocked(entry.priority, -1)
+        elif where == 'implied':
+            self.implied_set.discard(entry.sg)
+            self.sources[entry.sg[0]].implied.discard(entry.sg)
+        elif where == 'held':
+            self.held_count -= 1
+            self.sources[entry.sg[0]].count_blocked(entry.priority, -1)
+        entry.where = None
+        entry.version = 0
+        self.touched.add(entry.sg)
+
+    def imply(self, entry):
+        entry.where = 'implied'
+        self.implied_set.add(entry.sg)
+        self.sources[entry.sg[0]].implied.add(entry.sg)
+        self.touched.add(entry.sg)
+
+    def place(self, entry):
+        '''files an unfiled entry as implied, blocked, or admitted'''
+        bmax = self.sources[entry.sg[0]].max_blocked()
+        if bmax is not None and entry.priority < bmax:
+            self.imply(entry)
+            return
+        first_blocked = self.top(self.blocked)
+        if first_blocked is not None and entry.key > first_blocked.key:
+            self.put(entry, 'blocked')
+        else:
+            self.put(entry, 'admitted')
+
+    def update_implied(self, src):
+        '''re-checks the implied blocks for src after its blocks changed'''
+        si = self.sources.get(src)
+        if not si:
+            return
+        while True:
+            bmax = si.max_blocked()
+            lifted = [si.members[sg] for sg in si.implied
+                    if bmax is None or si.members[sg].priority >= bmax]
+            for entry in lifted:
+                self.unfile(entry)
+                self.place(entry)
+            if not lifted:
+                break
+            # one may have gone to blocked and raised bmax
+        if bmax is None:
+            return
+        for pri, sgs in si.by_pri.items():
+            if pri < bmax:
+                for sg in sgs:
+                    entry = si.members[sg]
+                    if entry.where == 'admitted':
+                        self.unfile(entry)
+                        self.imply(entry)
+
+    def released_bw(self, entry):
+        '''bitrate of the implied blocks that unblocking entry would lift'''
+        si = self.sources[entry.sg[0]]
+        bmax = si.max_blocked(without=entry.priority)
+        bw = 0
+        for sg in si.implied:
+            other = si.members[sg]
+            if bmax is None or other.priority >= bmax:
+                bw += other.bw
+        return bw
+
+    def set(self, sg, sginfo, on, held=False):
+        '''adds or re-files sg, with sginfo's current bitrate and population'''
+        entry = self.entries.get(sg)
+        if entry is None:
+            self.seq += 1
+            entry = AdmissionEntry(sg, self.seq)
+            self.entries[sg] = entry
+            si = self.sources.get(sg[0])
+            if si is None:
+                si = SourceIndex()
+                self.sources[sg[0]] = si
+            si.members[sg] = entry
+        else:
+            self.unfile(entry)
+            by_pri = self.sources[sg[0]].by_pri
+            by_pri[entry.priority].discard(sg)
+            if not by_pri[entry.priority]:
+                del(by_pri[entry.priority])
+        entry.sginfo = sginfo
+        entry.bw = sginfo.sg_bw
+        entry.priority = sginfo.priority
+        self.sources[sg[0]].by_pri.setdefault(entry.priority, set()).add(sg)
+        entry.key = self.block_key(entry, on)
+        if held:
+            entry.where = 'held'
+            self.held_count += 1
+            self.sources[sg[0]].count_blocked(entry.priority, 1)
+        else:
+            self.place(entry)
+        self.update_implied(sg[0])
+
+    def rekey(self, sg, on):
+        '''
+        updates whether sg is already on in its key, leaving it where it
+        is.  turning on an admitted one or off a blocked one only moves it
+        away from the boundary, so no rebalance is needed.
+        '''
+        entry = self.entries.get(sg)
+        if entry is None:
+            return
+        entry.key = self.block_key(entry, on)
+        where = entry.where
+        if where in ('admitted', 'blocked'):
+            self.unfile(entry)
+            self.put(entry, where)
+
+    def assign(self, admitted):
+        '''
+        files every candidate as admitted if it's in admitted and blocked
+        otherwise, for a decision made outside the index (see
+        solve_admission).  the heaps are no longer split by the blocking
+        order after this, rebalance only keeps the total within max_bw.
+        '''
+        srcs = set()
+        for sg, entry in self.entries.items():
+            if entry.where == 'held':
+                continue
+            self.unfile(entry)
+            self.put(entry, 'admitted' if sg in admitted else 'blocked')
+            srcs.add(sg[0])
+        for src in srcs:
+            self.update_implied(src)
+
+    def hold(self, sg):
+        '''sg is held down: blocked, but out of the candidates'''
+        entry = self.entries[sg]
+        self.unfile(entry)
+        entry.where = 'held'
+        self.held_count += 1
+        self.sources[sg[0]].count_blocked(entry.priority, 1)
+        self.update_implied(sg[0])
+
+    def remove(self, sg):
+        entry = self.entries.pop(sg, None)
+        if entry is None:
+            return
+        self.unfile(entry)
+        si = self.sources[sg[0]]
+        del(si.members[sg])
+        si.by_pri[entry.priority].discard(sg)
+        if not si.by_pri[entry.priority]:
+            del(si.by_pri[entry.priority])
+        if not si.members:
+            del(self.sources[sg[0]])
+        else:
+            self.update_implied(sg[0])
+
+    def rebalance(self):
+        '''moves (S,G)s across the boundary until it's in the right place'''
+        # over the limit: block from the front of the order
+        while self.admitted_bw > self.max_bw:
+            entry = self.top(self.admitted)
+            if entry is None:
+                break
+            self.unfile(entry)
+            self.put(entry, 'blocked')
+            self.update_implied(entry.sg[0])
+        # room to spare: admit from the back of the blocked ones while
+        # they fit, along with any implied blocks that lifts
+        while True:
+            entry = self.top(self.blocked)
+            if entry is None:
+                break
+            if self.admitted_bw + entry.bw + self.released_bw(entry) > self.max_bw:
+                break
+            self.unfile(entry)
+            self.put(entry, 'admitted')
+            self.update_implied(entry.sg[0])
+
+        # drop stale heap items if they're most of a heap
+        for name in ('admitted', 'blocked'):
+            heap = getattr(self, name)
+            if len(heap) > 2*len(self.entries) + 64:
+                live = [item for item in heap
+                        if item[2] in self.entries and self.entries[item[2]].version == item[1]]
+                heapq.heapify(live)
+                setattr(self, name, live)
+
+def solve_admission(entries, held, max_bw, buckets=1000, time_limit=1.0):
+    '''
+    picks the (S,G)s to admit from entries (the AdmissionEntry
+    candidates) to maximize the admitted offload ((population-1)*bitrate)
+    within max_bw, keeping the priority rule: when an (S,G) is blocked,
+    the (S,G)s from its source with a lower priority are blocked too.
+    held is {src: highest held-down priority}, those count as blocked.
+
+    Within a source that means admitting every (S,G) above some
+    priority, any subset of the ones at that priority, and none below,
+    so it's a knapsack over the bitrates (rounded up to max_bw/buckets,
+    so the result always fits) with a choice of cutoff per source.
+    Ties go to admitting more bitrate, then to (S,G)s already on.
+    (S,G)s measured over their advertisement count for no offload.  The
+    bitrate lost to rounding is then filled in blocking order.
+
+    returns the set of admitted (src,grp)s, or None if it ran past
+    time_limit seconds.
+    '''
+    if max_bw <= 0:
+        return set()
+    t_end = time.monotonic() + time_limit
+    unit = max_bw/buckets
+    cap = buckets
+    scale = int(sum(entry.bw for entry in entries)) + 1
+
+    def weight(entry):
+        return math.ceil(entry.bw/unit)
+
+    def value(entry):
+        offload = 0
+        if not entry.sginfo.over_advertised:
+            offload = int((entry.sginfo.population - 1)*entry.bw)
+        return (offload*scale + int(entry.bw))*2 + (1 if entry.key[3] else 0)
+
+    by_src = {}
+    for entry in entries:
+        src = entry.sg[0]
+        if src in held and entry.priority < held[src]:
+            # implied by a held-down one
+            continue
+        by_src.setdefault(src, {}).setdefault(entry.priority, []).append(entry)
+
+    # best[c]: the best value using at most c units
+    none = float('-inf')
+    best = [0]*(cap+1)
+    steps = []
+    for src, levels in by_src.items():
+        order = sorted(levels.items(), reverse=True)
+        full = best
+        src_best = None
+        cutoff = None
+        level_takes = []
+        for idx, (pri, members) in enumerate(order):
+            # cut off at this priority: all above it, some at it
+            arr = full
+            takes = []
+            for entry in members:
+                if time.monotonic() > t_end:
+                    return None
+                w = weight(entry)
+                take = None
+                if w <= cap:
+                    v = value(entry)
+                    cand = [none]*w + [a + v for a in arr[:cap+1-w]]
+                    take = bytes(map(operator.gt, cand, arr))
+                    arr = list(map(max, arr, cand))
+                takes.append((entry, w, take))
+            level_takes.append(takes)
+            if src_best is None:
+                src_best = arr
+                cutoff = [0]*(cap+1)
+            else:
+                for c in range(cap+1):
+                    if arr[c] > src_best[c]:
+                        src_best[c] = arr[c]
+                        cutoff[c] = idx
+            # all of this priority, for the cutoffs below it
+            lw = sum(w for entry, w, take in takes)
+            lv = sum(value(entry) for entry, w, take in takes)
+            if lw > cap:
+                break
+            full = [none]*lw + [a + lv for a in full[:cap+1-lw]]
+        steps.append((order, cutoff, level_takes))
+        best = src_best
+
+    admitted = set()
+    c = cap
+    for order, cutoff, level_takes in reversed(steps):
+        idx = cutoff[c]
+        for entry, w, take in reversed(level_takes[idx]):
+            if take and take[c]:
+                admitted.add(entry.sg)
+                c -= w
+        for pri, members in order[:idx]:
+            for entry in members:
+                admitted.add(entry.sg)
+                c -= weight(entry)
+
+    # fill in what the rounding left, in blocking order
+    used = sum(entry.bw for entry in entries if entry.sg in admitted)
+    blocked_pri = {}
+    for src, pri in held.items():
+        blocked_pri.setdefault(src, []).append(pri)
+    for entry in entries:
+        if entry.sg not in admitted:
+            blocked_pri.setdefault(entry.sg[0], []).append(entry.priority)
+    fill_order = sorted(entries, key=lambda entry: entry.key)
+    changed = True
+    while changed:
+        # admitting one can lift the cutoff for its source
+        changed = False
+        for entry in fill_order:
+            if entry.sg in admitted or used + entry.bw > max_bw:
+                continue
+            src_pris = blocked_pri[entry.sg[0]]
+            src_pris.remove(entry.priority)
+            if src_pris and entry.priority < max(src_pris):
+                src_pris.append(entry.priority)
+                continue
+            admitted.add(entry.sg)
+            used += entry.bw
+            changed = True
+    return admitted
 
 class SGManager(object):
-    def __init__(self, ctx, output_file, default_bw, max_bw):
+    def __init__(self, ctx, output_file, default_bw, max_bw, journal=None, observed=None, headroom=1.2, observed_floor=0.25, fetch_workers=32, fetch_deadline=2.0, refresh_ahead=60, solver='greedy', solver_buckets=1000, solver_time=1.0, hold_down=150):
         self.default_bw = default_bw
         self.max_bw = max_bw
         self.cur_desired_set = set()
@@ -204,32 +1561,532 @@ class SGManager(object):
         self.known_sgs = {}
         self.output_file = output_file
         self.ctx = ctx
+        # optional JoinJournalWriter for the output, and the hold times
+        # from the input journal to pass along with it
+        self.journal = journal
+        self.sg_holds = {}
+        # optional ObservedRates, to admit by measured bitrates (times
+        # headroom) instead of only the advertised ones
+        self.observed = observed
+        self.headroom = headroom
+        # a measured stream counts as at least this fraction of its
+        # advertised rate, so one that's idle over its window isn't
+        # admitted as free and then allowed to start sending
+        self.observed_floor = observed_floor
+        self.wrote_output = False
+        # updates come from the joinfile watcher, the observed rates
+        # poller, and the admission timer
+        self.lock = threading.RLock()
+        # metadata fetches run in parallel.  an update waits up to
+        # fetch_deadline for them (without holding self.lock), and the
+        # ones that finish later are picked up by a re-evaluation.
+        self.fetch_pool = ThreadPoolExecutor(max_workers=fetch_workers,
+                thread_name_prefix='fetch')
+        self.fetch_deadline = fetch_deadline
+        self.fetches = {}  # (src,grp) -> Future
+        # (src,grp)s whose fetch missed a deadline, guarded by timer_cond
+        # since the fetch threads check it when they finish
+        self.late_sgs = set()
+        # metadata is refreshed in the background up to refresh_ahead
+        # seconds (or a tenth of its lifetime) before it expires
+        self.refresh_ahead = refresh_ahead
+        self.refreshes = {}  # (src,grp) -> Future
+        # the admission timer wakes up for the earliest hold-down end or
+        # refresh time, and for fetches finishing, and re-runs admission
+        # only if one of them changed something.
+        self.timer_cond = threading.Condition()
+        self.timer_dirty = False
+        self.late_results = False
+        # heap of (time, seq, 'hold_down_time' or 'refresh_time', sg),
+        # stale if the sg's time has changed since
+        self.timers = []
+        self.timer_seq = 0
+        # seconds a blocked (S,G) stays blocked before it's reconsidered
+        self.hold_down = hold_down
+        self.index = AdmissionIndex(max_bw)
+        # 'greedy' blocks from the front of the blocking order, 'optimal'
+        # solves for the most offload when something has to be blocked
+        # (see solve_admission), keeping the greedy decision if it takes
+        # longer than solver_time
+        self.solver = solver
+        self.solver_buckets = solver_buckets
+        self.solver_time = solver_time
+        self.timer_thread = threading.Thread(name='admission-timer',
+                target=self.timer_loop, daemon=True)
+        self.timer_thread.start()
+
+    def fetch_done(self, sg):
+        with self.timer_cond:
+            if sg in self.late_sgs:
+                self.late_results = True
+                self.timer_dirty = True
+                self.timer_cond.notify()
+
+    def reschedule(self):
+        '''wakes the admission timer to look at the deadlines again'''
+        with self.timer_cond:
+            self.timer_dirty = True
+            self.timer_cond.notify()
+
+    def set_timer(self, sginfo, attr, when):
+        '''sets sginfo's hold_down_time or refresh_time, and its timer'''
+        setattr(sginfo, attr, when)
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (when, self.timer_seq, attr, (sginfo.source, sginfo.group)))
+
+    def timer_current(self, item):
+        when, _, attr, sg = item
+        sginfo = self.known_sgs.get(sg)
+        return (sg in self.cur_desired_set and sginfo is not None and
+                getattr(sginfo, attr) == when)
+
+    def set_refresh_time(self, sginfo, now):
+        ahead = min(self.refresh_ahead,
+                (sginfo.expire_time - now).total_seconds()/10)
+        self.set_timer(sginfo, 'refresh_time',
+                sginfo.expire_time - timedelta(seconds=max(0, ahead)))
+
+    def next_timer(self):
+        '''the earliest hold-down end or refresh time of the desired sgs, or None'''
+        with self.lock:
+            while self.timers:
+                if self.timer_current(self.timers[0]):
+                    return self.timers[0][0]
+                heapq.heappop(self.timers)
+            return None
+
+    def timer_loop(self):
+        global logger
+        while True:
+            soonest = self.next_timer()
+            with self.timer_cond:
+                if not self.timer_dirty:
+                    timeout = None
+                    if soonest is not None:
+                        timeout = max(0, (soonest - datetime.now()).total_seconds())
+                    self.timer_cond.wait(timeout)
+                self.timer_dirty = False
+                late = self.late_results
+            if late:
+                # collect the rest of a burst of late fetches
+                time.sleep(0.2)
+            try:
+                self.run_timers()
+            except Exception as e:
+                logger.error(f'failed running admission timers: {e}\n{traceback.format_exc()}')
+                time.sleep(1)
+
+    def run_timers(self):
+        '''
+        picks up finished refreshes, starts the refreshes that are due,
+        and re-runs admission if a hold-down ended, a late fetch
+        finished, or a refresh changed an (S,G)'s metadata.
+        '''
+        global logger
+        with self.lock:
+            now = datetime.now()
+            changes = []
+            with self.timer_cond:
+                if self.late_results:
+                    changes.append('late cbacc fetches finished')
+                self.late_results = False
+
+            for sg, fut in list(self.refreshes.items()):
+                if fut.done():
+                    del(self.refreshes[sg])
+                    if self.apply_refresh(sg, fut, now):
+                        changes.append(f'cbacc data changed for {sg}')
+
+            while self.timers and self.timers[0][0] <= now:
+                item = heapq.heappop(self.timers)
+                if not self.timer_current(item):
+                    continue
+                when, _, attr, sg = item
+                sginfo = self.known_sgs[sg]
+                if attr == 'hold_down_time':
+                    sginfo.hold_down_time = None
+                    self.index_sg(sg, sginfo, now)
+                    changes.append(f'hold-down ended for {sg}')
+                else:
+                    sginfo.refresh_time = None
+                    if sg not in self.refreshes:
+                        logger.debug(f'refreshing cbacc data for {sg}, expiring at {sginfo.expire_time}')
+                        src, grp = sg
+                        fut = self.fetch_pool.submit(fetch_sg_info, self.ctx, src, grp, True)
+                        fut.add_done_callback(lambda fut: self.reschedule())
+                        self.refreshes[sg] = fut
+
+            if changes:
+                more = ''
+                if len(changes) > 5:
+                    more = f' (and {len(changes)-5} more)'
+                logger.info('re-running admission: ' + ', '.join(changes[:5]) + more)
+                self.reevaluate()
+
+    def apply_refresh(self, sg, fut, now):
+        '''
+        updates an sg's metadata from a finished refresh, returns
+        whether anything admission uses has changed.
+        '''
+        global logger
+        sginfo = self.known_sgs.get(sg)
+        default_ttl = self.ctx.metadata.default_ttl
+        try:
+            streams, expire_time = fut.result()
+        except Exception as e:
+            if not sginfo:
+                return False
+            # a stand-in has nothing to lose, real metadata is retried
+            # sooner, backing off to the default ttl
+            retry = default_ttl
+            if not sginfo.spoofed:
+                retry = min(default_ttl, 30*2**min(sginfo.refresh_failures, 10))
+            sginfo.refresh_failures += 1
+            logger.warning(f'failed to refresh cbacc data for {sg}, retrying in {retry:.0f}s: {str(e)}')
+            self.set_timer(sginfo, 'refresh_time', now + timedelta(seconds=retry))
+            return False
+        if not sginfo:
+            return False
+        if streams is None:
+            # no data: a stand-in stays one, and (like a failed lookup)
+            # an expired value is left in place, until the server's
+            # answer expires
+            sginfo.refresh_failures = 0
+            sginfo.expire_time = expire_time
+            self.set_refresh_time(sginfo, now)
+            return False
+        src, grp = sg
+        new_sginfo = SummedSG(src, grp, streams, expire_time, sginfo.population)
+        changed = (sginfo.spoofed or
+                new_sginfo.advertised_bw != sginfo.advertised_bw or
+                new_sginfo.priority != sginfo.priority or
+                new_sginfo.rate_window != sginfo.rate_window)
+        if changed:
+            new_sginfo.hold_down_time = sginfo.hold_down_time
+            new_sginfo.over_advertised = sginfo.over_advertised
+            self.known_sgs[sg] = new_sginfo
+            sginfo = new_sginfo
+            if sg in self.cur_desired_set:
+                self.index_sg(sg, sginfo, now)
+        else:
+            sginfo.expire_time = expire_time
+            sginfo.refresh_failures = 0
+        self.set_refresh_time(sginfo, now)
+        return changed
+
+    def index_sg(self, sg, sginfo, now):
+        '''(re-)files a desired sg in the admission index'''
+        if self.observed:
+            self.apply_observed(sginfo)
+        if sginfo.hold_down_time and sginfo.hold_down_time <= now:
+            sginfo.hold_down_time = None
+        held = sginfo.hold_down_time is not None
+        if held:
+            # its timer may have been dropped while it wasn't desired
+            self.set_timer(sginfo, 'hold_down_time', sginfo.hold_down_time)
+        self.index.set(sg, sginfo, sg in self.cur_enabled_set, held)
+
+    def solve(self):
+        '''
+        re-decides the candidates in the index with solve_admission.
+        returns the blocked (S,G)s and the ones among them that are
+        implied by a higher-priority block, or None to keep the greedy
+        decision.
+        '''
+        global logger
+        entries = []
+        held = {}
+        for sg, entry in self.index.entries.items():
+            if entry.where == 'held':
+                if sg[0] not in held or entry.priority > held[sg[0]]:
+                    held[sg[0]] = entry.priority
+            else:
+                entries.append(entry)
+
+        def offload(sgs):
+            return sum((self.index.entries[sg].sginfo.population-1)*self.index.entries[sg].bw for sg in sgs)
+
+        greedy = [entry.sg for entry in entries if entry.where == 'admitted']
+        t0 = time.monotonic()
+        admitted = solve_admission(entries, held, self.max_bw,
+                self.solver_buckets, self.solver_time)
+        elapsed = time.monotonic() - t0
+        if admitted is None:
+            logger.warning(f'optimal admission for {len(entries)} sgs took over {self.solver_time:g}s, keeping the greedy decision')
+            return None
+        logger.info(f'optimal admission for {len(entries)} sgs in {elapsed*1000:.1f}ms: {len(admitted)} admitted with {offload(admitted)/(1024*1024):.4g}mb offload, greedy had {len(greedy)} with {offload(greedy)/(1024*1024):.4g}mb')
+        self.index.assign(admitted)
+
+        blocked = [entry for entry in entries if entry.sg not in admitted]
+        top = dict(held)
+        for entry in blocked:
+            src = entry.sg[0]
+            if src not in top or entry.priority > top[src]:
+                top[src] = entry.priority
+        implied = set(entry.sg for entry in blocked
+                if entry.priority < top[entry.sg[0]])
+        return [entry.sg for entry in blocked], implied
+
+    def start_fetches(self, sgs):
+        '''
+        starts fetching metadata for the sgs without a fetch running,
+        returns {sg: Future} for all of them.
+        '''
+        futs = {}
+        for sg in sgs:
+            fut = self.fetches.get(sg)
+            if fut is None:
+                src, grp = sg
+                fut = self.fetch_pool.submit(fetch_sg_info, self.ctx, src, grp)
+                fut.add_done_callback(lambda fut, sg=sg: self.fetch_done(sg))
+                self.fetches[sg] = fut
+            futs[sg] = fut
+        return futs
+
+    def collect_fetches(self, futs):
+        '''
+        returns {sg: streams and expiration, or None for a failed fetch}
+        for the finished ones of futs ({sg: Future}).  the rest are
+        marked late and keep running, and re-run admission when done.
+        call with self.lock held.
+        '''
+        global logger
+        results = {}
+        for sg, fut in futs.items():
+            if not fut.done():
+                with self.timer_cond:
+                    self.late_sgs.add(sg)
+                if not fut.done():
+                    self.fetches[sg] = fut
+                    continue
+            if self.fetches.get(sg) is fut:
+                del(self.fetches[sg])
+            with self.timer_cond:
+                self.late_sgs.discard(sg)
+            try:
+                results[sg] = fut.result()
+            except Exception as e:
+                logger.error(f'failed to fetch cbacc data for {sg}: {str(e)}')
+                results[sg] = None
+        return results
+
+    def apply_journal_snapshot(self, snapshot):
+        with self.lock:
+            self.sg_holds = dict(snapshot)
+        self.update_sgset(set(snapshot.keys()), {})
+
+    def reevaluate(self):
+        '''re-run admission for the same desired set'''
+        with self.lock:
+            if self.cur_desired_set:
+                self.update_sgs(set(), set(), {})
+
+    def reconfigure(self, max_bw, default_bw, hold_down):
+        '''
+        changes the bandwidth cap, the bitrate used for (S,G)s without
+        cbacc data, and the hold-down time while running, and re-runs
+        admission for the same desired set.  A lower cap blocks only as
+        much as it has to from the front of the blocking order (which
+        favors the ones already admitted), and a higher one lifts the
+        hold-downs so blocked (S,G)s are reconsidered right away.
+        '''
+        global logger
+        with self.lock:
+            now = datetime.now()
+            changes = []
+            reindex = set()
+            if max_bw != self.max_bw:
+                changes.append(f'bandwidth {self.max_bw/(1024*1024):g} -> {max_bw/(1024*1024):g}mb')
+                raised = max_bw > self.max_bw
+                self.max_bw = max_bw
+                self.index.max_bw = max_bw
+                if raised:
+                    for sg in self.cur_desired_set:
+                        sginfo = self.known_sgs[sg]
+                        if sginfo.hold_down_time:
+                            sginfo.hold_down_time = None
+                            reindex.add(sg)
+            if default_bw != self.default_bw:
+                changes.append(f'default {self.default_bw/(1024*1024):g} -> {default_bw/(1024*1024):g}mb')
+                self.default_bw = default_bw
+                for sg, sginfo in self.known_sgs.items():
+                    if sginfo.spoofed:
+                        sginfo.udp_streams = [standin_vals(default_bw)]
+                        sginfo.sg_bw = default_bw
+                        sginfo.advertised_bw = default_bw
+                        sginfo.total_bw = default_bw
+                        if sg in self.cur_desired_set:
+                            reindex.add(sg)
+            if hold_down != self.hold_down:
+                changes.append(f'hold-down {self.hold_down:g} -> {hold_down:g}s')
+                self.hold_down = hold_down
+                # shorten the running hold-downs, don't extend them
+                latest = now + timedelta(seconds=hold_down)
+                for sg in self.cur_desired_set:
+                    sginfo = self.known_sgs[sg]
+                    if sginfo.hold_down_time and sginfo.hold_down_time > latest:
+                        self.set_timer(sginfo, 'hold_down_time', latest)
+
+            if not changes:
+                logger.info('reconfigured, nothing changed')
+                return
+            logger.info(f'reconfigured: {", ".join(changes)}')
+            for sg in reindex:
+                self.index_sg(sg, self.known_sgs[sg], now)
+            self.reevaluate()
+
+    def refresh_observed(self):
+        '''re-files the desired sgs whose observed rates changed, and re-runs admission'''
+        with self.lock:
+            now = datetime.now()
+            for sg in self.cur_desired_set:
+                sginfo = self.known_sgs[sg]
+                before = (sginfo.sg_bw, sginfo.over_advertised)
+                self.apply_observed(sginfo)
+                if (sginfo.sg_bw, sginfo.over_advertised) != before:
+                    self.index_sg(sg, sginfo, now)
+            self.reevaluate()
+
+    def apply_observed(self, sginfo):
+        '''
+        sets sginfo.sg_bw for admission from its advertised rate and its
+        measured rate over its data-rate-window, if it's been measured.
+
+        A measured stream counts as its measured rate plus headroom,
+        capped at its advertisement and floored at observed_floor of it.
+        A stream measured above its advertisement counts as what it's
+        actually using and is flagged, so it's demoted in the blocking
+        order.  A stream without CBACC data counts as its measured rate
+        plus headroom instead of the default, floored the same way with
+        the default as its advertisement.
+        '''
+        global logger
+        sg = (sginfo.source, sginfo.group)
+        measured = self.observed.rate(sg, sginfo.rate_window)
+        sginfo.observed_bw = measured
+        if measured is None:
+            sginfo.sg_bw = sginfo.advertised_bw
+            return
+        over = not sginfo.spoofed and measured > sginfo.advertised_bw
+        if over and not sginfo.over_advertised:
+            logger.warning(f'{sg} measured at {measured/(1024*1024):.3g}mb over {sginfo.rate_window:g}s, exceeding its advertised {sginfo.advertised_bw/(1024*1024):.3g}mb')
+        elif sginfo.over_advertised and not over:
+            logger.info(f'{sg} measured at {measured/(1024*1024):.3g}mb, back within its advertised {sginfo.advertised_bw/(1024*1024):.3g}mb')
+        sginfo.over_advertised = over
+        bw = measured*self.headroom
+        if not sginfo.spoofed and not over:
+            bw = min(bw, sginfo.advertised_bw)
+        sginfo.sg_bw = max(bw, sginfo.advertised_bw*self.observed_floor)
+
+    def apply_journal_events(self, events):
+        add_sgs = set()
+        remove_sgs = set()
+        refreshed = []
+        with self.lock:
+            for op, sg, hold_time in events:
+                if op == '-':
+                    self.sg_holds.pop(sg, None)
+                    if sg in add_sgs:
+                        add_sgs.discard(sg)
+                    elif sg in self.cur_desired_set:
+                        remove_sgs.add(sg)
+                    continue
+                self.sg_holds[sg] = hold_time
+                if op == '=':
+                    refreshed.append(sg)
+                if sg in remove_sgs:
+                    remove_sgs.discard(sg)
+                elif sg not in self.cur_desired_set:
+                    add_sgs.add(sg)
+
+        if add_sgs or remove_sgs:
+            self.update_sgs(add_sgs, remove_sgs, {})
+        if self.journal:
+            with self.lock:
+                self.journal.append([('=', sg, self.sg_holds.get(sg))
+                    for sg in refreshed if sg in self.cur_enabled_set])
 
     def update_sgset(self, sgset, pops):
+        with self.lock:
+            add_sgs = sgset - self.cur_desired_set
+            remove_sgs = self.cur_desired_set - sgset
+        self.update_sgs(add_sgs, remove_sgs, pops)
+
+    def update_sgs(self, add_sgs, remove_sgs, pops):
+        '''
+        applies a change to the desired set (and populations from pops),
+        re-runs admission on the index, and writes the output if the
+        admitted set changed.
+
+        The metadata fetches for added sgs are waited for without
+        self.lock, so the admission timer and observed rates aren't held
+        up by them.  Only the joinfile watcher's thread adds sgs, and it
+        calls this without self.lock held.
+        '''
         global logger
-        logger.info(f'got sgs update: {sgset}')
-        add_sgs = sgset - self.cur_desired_set
-        kept_sgs = self.cur_desired_set.intersection(sgset)
-        remove_sgs = self.cur_desired_set - sgset
-        changed_pops = dict()
-
-        new_desired_set = add_sgs.union(kept_sgs)
-        now = datetime.now()
-        for sg in new_desired_set:
-            src, grp = sg
-            sginfo = self.known_sgs.get(sg)
-            if sginfo:
-                sgpop = pops.get(sg)
-                if sgpop and sginfo.population != sgpop:
-                    changed_pops[sg] = sginfo.population
+        with self.lock:
+            now = datetime.now()
+            # new ones, and ones whose metadata expired while not desired
+            new_fetch = [sg for sg in add_sgs
+                    if sg not in self.known_sgs or self.known_sgs[sg].expire_time < now]
+            # new ones with cached metadata (even expired, like after a
+            # restart) use it until their fetch is done, instead of
+            # waiting for it
+            cached = {}
+            for sg in new_fetch:
+                if sg not in self.known_sgs:
+                    sg_info = cached_sg_info(self.ctx, *sg)
+                    if sg_info is not None:
+                        cached[sg] = sg_info
+            started = self.start_fetches(new_fetch)
+            # ones that already missed an earlier update's deadline aren't
+            # waited for again
+            with self.timer_cond:
+                waiting = [fut for sg, fut in started.items()
+                        if sg not in cached and sg not in self.late_sgs]
+        if waiting:
+            t0 = time.monotonic()
+            wait(waiting, timeout=self.fetch_deadline)
+            logger.info(f'waited {time.monotonic()-t0:.3f}s for cbacc data for {len(waiting)} sgs (metadata cache: {self.ctx.metadata.stats()})')
+
+        with self.lock:
+            logger.info(f'got sgs update: {len(add_sgs)} added, {len(remove_sgs)} removed, {len(self.cur_desired_set)} before')
+            logger.debug(f'added: {add_sgs}, removed: {remove_sgs}')
+            now = datetime.now()
+            self.cur_desired_set.difference_update(remove_sgs)
+            self.cur_desired_set.update(add_sgs)
+
+            reindex = set(add_sgs)
+            for sg, sgpop in pops.items():
+                sginfo = self.known_sgs.get(sg)
+                if sginfo and sgpop and sginfo.population != sgpop:
                     sginfo.population = sgpop
-            if not sginfo or sginfo.expire_time < now:
-                expire_time = now + timedelta(seconds=1800) # TBD: update with cache info instead of hard half-hour?
+                    reindex.add(sg)
+
+            # new ones, and stand-ins for fetches that missed a deadline
+            for sg, fut in self.fetches.items():
+                if sg in self.cur_desired_set and sg not in add_sgs:
+                    started[sg] = fut
+            to_fetch = list(started)
+            fetched = self.collect_fetches(started)
+            for sg in list(self.fetches):
+                if sg not in self.cur_desired_set and self.fetches[sg].done():
+                    del(self.fetches[sg])
+                    with self.timer_cond:
+                        self.late_sgs.discard(sg)
+
+            for sg in to_fetch:
+                src, grp = sg
+                sginfo = self.known_sgs.get(sg)
+                # retry a failed lookup after the default metadata ttl
+                expire_time = now + timedelta(seconds=self.ctx.metadata.default_ttl)
                 streams = None
-                try:
-                    streams = fetch_sg_info(self.ctx, src, grp)
-                except Exception as e:
-                    logger.error(f'failed to fetch cbacc data for {sg}: {str(e)}')
+                fetching = sg not in fetched
+                if fetching:
+                    # still running, use the fallback until it's done
+                    expire_time = now
+                elif fetched[sg] is not None:
+                    streams, expire_time = fetched[sg]
                 if streams is None:
                     # TBD: think about failed lookups harder.
                     # for now, leave expired values in place if lookup failed
@@ -237,115 +2094,64 @@ class SGManager(object):
                     # not reach dorms server" means keep old value, but
                     # "reached dorms server, it knows nothing about this
                     # sg" means drop it in spite of estimate?)
-                    if not sginfo:
-                        sginfo = SummedSG(src, grp, [CbaccVals({'max-bits-per-second':str(self.default_bw)})], expire_time, pops.get(sg, 1))
+                    if not sginfo and sg in cached:
+                        sginfo = SummedSG(src, grp, cached[sg][0], expire_time, pops.get(sg, 1))
+                        self.known_sgs[sg] = sginfo
+                    elif not sginfo:
+                        sginfo = SummedSG(src, grp, [standin_vals(self.default_bw)], expire_time, pops.get(sg, 1))
                         sginfo.total_bw = self.default_bw
                         sginfo.spoofed = True
                         self.known_sgs[sg] = sginfo
+                    sginfo.fetching = fetching
+                    if not fetching:
+                        # ask again when the failure or the server's "no
+                        # data" answer expires, even if the stand-in was
+                        # made while the fetch was still running
+                        sginfo.expire_time = expire_time
                 else:
                     sginfo = SummedSG(src, grp, streams, expire_time, pops.get(sg, 1))
                     self.known_sgs[sg] = sginfo
-
-        for sg in remove_sgs:
-            src, grp = sg
-            sginfo = self.known_sgs.get(sg)
-            if sginfo and sginfo.expire_time < now:
-                del(self.known_sgs[sg])
-
-        held_down = set()
-        next_wake_time = now + timedelta(seconds=86400)
-        desired_rate = 0
-        for sg in new_desired_set:
-            sginfo = self.known_sgs[sg]
-            if sginfo.expire_time < next_wake_time:
-                next_wake_time = sginfo.expire_time
-            if sginfo.hold_down_time:
-                if sginfo.hold_down_time < now:
-                    held_down.add(sg)
-                    continue
-                else:
-                    sginfo.hold_down_time = None
-            desired_rate += sginfo.sg_bw
-
-        if desired_rate <= self.max_bw:
-            # all desired flows are admitted, yay.
-            blocked_set = set()
-            logger.info(f'none blocked ({len(new_desired_set)} flows with {desired_rate/(1024*1024):.3g}mb) active and ({len(held_down)}) held down from prior block: {held_down}')
-        else:
-            desire_gap = desired_rate - self.max_bw
-            ordering = []
-            source_batches = dict()
-            for sg in new_desired_set:
-                src,grp = sg
-                sginfo = self.known_sgs[sg]
-                grps = source_batches.get(src)
-                if grps is None:
-                    grps = dict()
-                    source_batches[src] = grps
-                grps[grp] = sginfo
-
-                # offload is most important.  biggest offload is kept.
-                # for the same offload, smaller stream is better to keep.
-                offload = (sginfo.population - 1)*sginfo.sg_bw
-                stream_size = sginfo.sg_bw
-                on_already = 0
-                if sg in self.cur_enabled_set:
-                    # favor the ones already on, all else equal (so put
-                    # them towards the back)
-                    # (TBD: maybe offload should be estimated in buckets
-                    # instead of a strict calc from the pop*bw to make this
-                    # more stable?)
-                    on_already = -1
-
-                ordering.append((offload, stream_size, on_already, sginfo))
-
-            blocked_sgis = []
-            blocked_bw = 0
-            for offload, stream_size, on, sginfo in reversed(sorted(ordering, key=lambda x: (x[0],x[1],x[2]))):
-                blocked_sgis.append(sginfo)
-                blocked_bw += sginfo.sg_bw
-                if blocked_bw >= desire_gap:
-                    break
-
-            min_blocked_bw = min([sgi.sg_bw for sgi in blocked_sgis])
-            blocked_set = set([(sgi.source,sgi.group) for sgi in blocked_sgis])
-            implied_blocks = set()
-            implied_order = []
-            implied_bw = 0
-            for sginfo in blocked_sgis:
-                for grp, other_sginfo in source_batches[sginfo.source].items():
-                    if other_sginfo.priority < sginfo.priority:
-                        other_sg = (other_sginfo.source,other_sginfo.group)
-                        if other_sg not in implied_blocks:
-                            logger.info(f'{other_sg} (pri {other_sginfo.priority}, {other_sginfo.sg_bw/(1024*1024):.3g}MiB) implied blocked by {(sginfo.source,sginfo.group)} (pri {sginfo.priority})')
-                            implied_blocks.add(other_sg)
-                            implied_order.append(other_sg)
-                            if other_sg not in blocked_set:
-                                implied_bw += other_sg.sg_bw
-
-            if implied_bw >= min_blocked_bw:
-                allowed = 0
-                for maybe_allow in reversed(blocked_sgis):
-                    if implied_bw <= maybe_allow.sg_bw:
-                        maybe_sg = (maybe_allow.source,maybe_allow.group)
-                        if maybe_sg not in implied_blocks:
-                            implied_bw -= maybe_allow.sg_bw
-                            blocked_set.remove(maybe_sg)
-                            logger.info('{maybe_sg} ({maybe_allow.sg_bw/(1024*1024):.3g}MiB) permitted due to extra space from implied blocks')
-                            allowed += 1
-                            if implied_bw < min_blocked_bw:
-                                break
-                if allowed:
-                    # order is now broken, but it's ok we don't need it anymore
-                    blocked_sgis = [self.known_sgs[sg] for sg in blocked_set]
-
-            hold_down = now + timedelta(seconds=150)
-            for sgi in blocked_sgis:
-                sgi.hold_down_time = hold_down
-
-            if blocked_sgis:
-                logger.info(f'blocked {len(blocked_sgis)}:\n   '+'\n   '.join([f'{sgi.source},{sgi.group}' for sgi in blocked_sgis]))
-
+                if not sginfo.fetching:
+                    self.set_refresh_time(sginfo, now)
+                reindex.add(sg)
+
+            for sg in remove_sgs:
+                self.index.remove(sg)
+                sginfo = self.known_sgs.get(sg)
+                if sginfo and sginfo.expire_time < now:
+                    del(self.known_sgs[sg])
+
+            for sg in reindex:
+                if sg in self.cur_desired_set:
+                    self.index_sg(sg, self.known_sgs[sg], now)
+
+            self.index.rebalance()
+
+            blocked = self.index.blocked_sgs()
+            implied_sgs = set(sg for sg in blocked
+                    if self.index.status(sg) == 'implied')
+            if blocked and self.solver == 'optimal':
+                solved = self.solve()
+                if solved is not None:
+                    blocked, implied_sgs = solved
+            if not blocked:
+                # all desired flows are admitted, yay.
+                logger.info(f'none blocked ({self.index.admitted_count} flows with {self.index.admitted_bw/(1024*1024):.3g}mb) active and ({self.index.held_count}) held down from prior block')
+            else:
+                hold_down = now + timedelta(seconds=self.hold_down)
+                lines = []
+                for sg in blocked:
+                    sginfo = self.known_sgs[sg]
+                    implied = ''
+                    if sg in implied_sgs:
+                        implied = f' (pri {sginfo.priority}, implied by a higher priority block from {sginfo.source})'
+                    lines.append(f'{sginfo.source},{sginfo.group}{implied}')
+                    if sginfo.fetching:
+                        # revised when its fetch is done, not held down
+                        continue
+                    self.set_timer(sginfo, 'hold_down_time', hold_down)
+                    self.index.hold(sg)
+                logger.info(f'blocked {len(blocked)}:\n   '+'\n   '.join(lines))
 
             '''
             # this kind of fails and added a TBD to the cbacc spec.
@@ -363,48 +2169,49 @@ class SGManager(object):
                 sr.groups.append(grp)
             '''
 
-        allowed_sgs = []
-        for sg in new_desired_set:
-            sginfo = self.known_sgs[sg]
-            if sg not in blocked_set:
-                if sginfo.hold_down_time:
-                    if sginfo.hold_down_time < next_wake_time:
-                        next_wake_time = sginfo.hold_down_time
-                else:
-                    allowed_sgs.append(sg)
-
-        output = '\n'.join([f'{src},{grp}' for src,grp in allowed_sgs])
-        with open(self.output_file, 'w') as f:
-            print(output, file=f)
-
-        logger.debug('wrote:\n'+output)
-
-        self.cur_desired_set = new_desired_set
-        self.cur_enabled_set = set(allowed_sgs)
-
-def on_created_handler(channels, input_file):
-    def on_created(event):
-        global logger
-        logger.debug(f'on_created({event})')
-        if event.src_path.endswith(input_file):
-            read_joinfile(event.src_path, channels)
-    return on_created
-
-def on_moved_handler(channels, input_file):
-    def on_moved(event):
-        global logger
-        logger.debug(f'on_moved({event})')
-        if event.dest_path.endswith(input_file):
-            read_joinfile(event.dest_path, channels)
-    return on_moved
-
-def on_modified_handler(channels, input_file):
-    def on_modified(event):
-        global logger
-        logger.debug(f'on_modified({event})')
-        if event.src_path.endswith(input_file):
-            read_joinfile(event.src_path, channels)
-    return on_modified
+            enabling = []
+            disabling = []
+            for sg in self.index.take_touched() | add_sgs | remove_sgs:
+                on = sg in self.cur_desired_set and self.index.status(sg) == 'admitted'
+                if on and sg not in self.cur_enabled_set:
+                    enabling.append(sg)
+                elif not on and sg in self.cur_enabled_set:
+                    disabling.append(sg)
+            self.cur_enabled_set.difference_update(disabling)
+            self.cur_enabled_set.update(enabling)
+            # being on already is part of the blocking order
+            for sg in enabling + disabling:
+                self.index.rekey(sg, sg in self.cur_enabled_set)
+            self.index.take_touched()
+
+            if not self.wrote_output or enabling or disabling:
+                output = '\n'.join([f'{src},{grp}' for src,grp in self.cur_enabled_set])
+                # rename into place, so the consumer never reads a partial file
+                tmp_fname = os.path.join(dirname(self.output_file),
+                        '.' + basename(self.output_file) + '.tmp')
+                with open(tmp_fname, 'w') as f:
+                    print(output, file=f)
+                os.replace(tmp_fname, self.output_file)
+                self.wrote_output = True
+
+                logger.debug('wrote:\n'+output)
+
+            if self.journal:
+                events = [('-', sg, None) for sg in disabling]
+                events.extend([('+', sg, self.sg_holds.get(sg))
+                    for sg in enabling])
+                self.journal.append(events)
+
+            self.reschedule()
+
+def read_input(fname, sgmgr, journal):
+    '''
+    with a journal, the joinfile is only read if the journal is missing
+    (e.g. the producer isn't writing one) or skipped some changes.
+    '''
+    if not journal or not journal.poll():
+        if isfile(fname):
+            read_joinfile(fname, sgmgr)
 
 def read_joinfile(fname, sgmgr):
     global logger
@@ -425,7 +2232,7 @@ def read_joinfile(fname, sgmgr):
                 src = ip_address(sg[0])
                 grp = ip_address(sg[1])
                 if len(sg) > 2:
-                    pop = int(sg[3])
+                    pop = int(sg[2])
                     assert(pop > 0)
                     pops[(src,grp)] = pop
                 assert(grp.is_multicast)
@@ -459,55 +2266,147 @@ priority.
     parser.add_argument('-d', '--default', type=int,
         default=None,
         help='the effective bitrate in MiBps to use for SGs without CBACC data (default is bandwidth+1, to avoid choosing them)')
+    parser.add_argument('--hold-down', type=float, default=150,
+        help='seconds a blocked (S,G) stays blocked before it\'s reconsidered (default 150)')
+    parser.add_argument('--settings-file',
+        help='file of "name=value" lines overriding --bandwidth, --default, and --hold-down (as bandwidth, default, and hold-down), re-read on SIGHUP to change them without a restart')
+    parser.add_argument('--debounce', type=float, default=0.1,
+        help='seconds without further input-file changes before acting on a burst of changes (default 0.1)')
+    parser.add_argument('--max-stale', type=float, default=1.0,
+        help='longest time in seconds an input-file change waits for a burst of changes to settle (default 1.0)')
+    parser.add_argument('--journal', action='store_true', default=False,
+        help='follow the <input-file>.journal changes from a producer started with --journal instead of re-reading the whole input-file on each change, and write <output-file>.journal for the next consumer')
+    parser.add_argument('--dorms-ttl', type=float, default=1800,
+        help='seconds to reuse a dorms server after checking its capabilities, before checking again (default 1800).  The dorms servers for each source are kept for the TTL of their SRV records.')
+    parser.add_argument('--cache-file',
+        help='sqlite file to keep cbacc metadata and discovered dorms servers in across restarts.  After a restart, (S,G)s with cached metadata are admitted by it right away (even if it\'s expired) while it\'s refreshed.')
+    parser.add_argument('--dorms-stagger', type=float, default=0.25,
+        help='seconds to wait on a dorms server\'s capability check before also trying the next one of the same SRV priority (default 0.25)')
+    parser.add_argument('--dorms-timeout', type=float, default=10,
+        help='seconds before giving up on a dorms server\'s capability check (default 10)')
+    parser.add_argument('--fetch-workers', type=int, default=32,
+        help='cbacc metadata fetches to run at once (default 32)')
+    parser.add_argument('--fetch-per-server', type=int, default=8,
+        help='cbacc metadata fetches to run at once against one dorms server (default 8)')
+    parser.add_argument('--per-sg-fetch', action='store_true', default=False,
+        help='fetch cbacc metadata for each (S,G) separately, instead of for all of a sender\'s groups at once')
+    parser.add_argument('--fetch-deadline', type=float, default=2.0,
+        help='seconds an update waits for cbacc metadata fetches before writing the output with the ones still running treated like (S,G)s without cbacc data.  The output is revised when they finish.  (default 2)')
+    parser.add_argument('--refresh-ahead', type=float, default=60,
+        help='seconds before cbacc metadata expires to refresh it in the background (at most a tenth of its lifetime, default 60)')
+    parser.add_argument('--observed-rates',
+        help='rates file written by driad-ingest --rates-file.  With this, (S,G)s measured for their data-rate-window are admitted by their measured bitrate (plus headroom, capped at their advertised bitrate) instead of their advertised bitrate, and ones exceeding their advertisement are flagged and blocked first.')
+    parser.add_argument('--observed-headroom', type=float, default=1.2,
+        help='multiplier on measured bitrates for admission, to allow for them to burst (default 1.2)')
+    parser.add_argument('--observed-floor', type=float, default=0.25,
+        help='fraction of its advertised bitrate (or of --default, without CBACC data) that a measured (S,G) counts as at least, so an idle one isn\'t admitted for free (default 0.25)')
+    parser.add_argument('--observed-interval', type=float, default=5.0,
+        help='seconds between re-checking admission against the observed rates (default 5)')
+    parser.add_argument('--solver', choices=['greedy', 'optimal'], default='greedy',
+        help='how to pick the (S,G)s to block when they don\'t all fit: greedy blocks the smallest offload first, optimal solves for the most admitted offload and falls back to greedy if it takes longer than --solver-time (default greedy)')
+    parser.add_argument('--solver-buckets', type=int, default=1000,
+        help='bandwidth resolution of the optimal solver, as the number of steps the bandwidth is divided into (default 1000)')
+    parser.add_argument('--solver-time', type=float, default=1.0,
+        help='seconds the optimal solver may take before the greedy decision is used instead (default 1)')
 
     #global self_ip
     # global upstream_neighbor_ip
     args = parser.parse_args(args_in[1:])
     logger = setup_logger('cbacc-mgr', args.verbose)
+    ingest_common.logger = logger
 
     full_input_path = abspath(args.input_file)
     input_name = basename(full_input_path)
     watch_dir = dirname(full_input_path)
 
-    if args.default is None:
-        default_bw = args.bandwidth+1
-    else:
-        default_bw = args.default
-    default_bw *= 1024*1024
-    bandwidth = args.bandwidth*1024*1024
+    try:
+        bandwidth, default_bw, hold_down = read_settings(args)
+    except (OSError, ValueError) as e:
+        logger.error(f'failed reading settings: {e}')
+        return 1
 
     signal.signal(signal.SIGTERM, stop_handler)
     signal.signal(signal.SIGINT, stop_handler)
-    signal.signal(signal.SIGHUP, stop_handler)
+    signal.signal(signal.SIGHUP, reload_handler)
 
     ctx = Context()
-    sgmgr = SGManager(ctx, args.output_file, default_bw, bandwidth)
-
-    if isfile(full_input_path):
-        read_joinfile(full_input_path, sgmgr)
-
-    event_handler = PatternMatchingEventHandler(
-            patterns=['*'],
-            ignore_patterns=None,
-            ignore_directories=True,
-            case_sensitive=True)
-
-    event_handler.on_created = on_created_handler(sgmgr, input_name)
-    event_handler.on_moved = on_moved_handler(sgmgr, input_name)
-    event_handler.on_modified = on_modified_handler(sgmgr, input_name)
+    ctx.discovery.server_ttl = args.dorms_ttl
+    ctx.discovery.stagger = args.dorms_stagger
+    ctx.discovery.timeout = args.dorms_timeout
+    ctx.bulk = not args.per_sg_fetch
+    persist = None
+    if args.cache_file:
+        try:
+            persist = PersistentCache(args.cache_file)
+            ctx.metadata.persist = persist
+            ctx.discovery.persist = persist
+            logger.info(f'keeping cbacc metadata in {args.cache_file}')
+        except sqlite3.Error as e:
+            logger.error(f'failed opening cache file {args.cache_file}, running without it: {e}')
+    ctx.discovery.per_server = args.fetch_per_server
+    out_journal = None
+    if args.journal:
+        out_journal = JoinJournalWriter(args.output_file + '.journal')
+    observed = None
+    if args.observed_rates:
+        observed = ObservedRates(args.observed_rates,
+                stale_after=max(10, 3*args.observed_interval))
+    sgmgr = SGManager(ctx, args.output_file, default_bw, bandwidth,
+            out_journal, observed, args.observed_headroom, args.observed_floor,
+            args.fetch_workers, args.fetch_deadline, args.refresh_ahead,
+            args.solver, args.solver_buckets, args.solver_time, hold_down)
+
+    in_journal = None
+    if args.journal:
+        in_journal = JoinJournalReader(full_input_path + '.journal',
+                sgmgr.apply_journal_snapshot, sgmgr.apply_journal_events)
+
+    in_journal_fname = None
+    if in_journal:
+        in_journal_fname = in_journal.fname
+    watcher = JoinfileWatcher(full_input_path,
+            lambda: read_input(full_input_path, sgmgr, in_journal),
+            in_journal_fname, args.debounce, args.max_stale)
 
     logger.info(f'watching {watch_dir}/{input_name}')
     observer = Observer()
-    observer.schedule(event_handler, watch_dir, recursive=False)
+    observer.schedule(watcher.handler, watch_dir, recursive=False)
     observer.start()
+    watcher.start()
+    # initial read, for an input file that was already there
+    watcher.notify()
+
+    if observed:
+        def poll_observed():
+            while not stopping:
+                time.sleep(args.observed_interval)
+                try:
+                    if observed.poll():
+                        sgmgr.refresh_observed()
+                except Exception as e:
+                    logger.error(f'failed re-checking observed rates: {e}\n{traceback.format_exc()}')
+        logger.info(f'admitting by observed rates from {args.observed_rates}')
+        threading.Thread(name='observed-rates', target=poll_observed,
+                daemon=True).start()
 
     try:
         while not stopping:
-            time.sleep(1)
+            if not reload_requested.wait(1):
+                continue
+            reload_requested.clear()
+            logger.info(f'got SIGHUP, reloading {args.settings_file or "settings (no --settings-file given)"}')
+            try:
+                sgmgr.reconfigure(*read_settings(args))
+            except (OSError, ValueError) as e:
+                logger.error(f'failed reloading settings, keeping the current ones: {e}')
+            except Exception as e:
+                logger.error(f'failed reconfiguring: {e}\n{traceback.format_exc()}')
     except KeyboardInterrupt:
         pass
     observer.stop()
     observer.join()
+    if persist:
+        persist.flush()
 
 if __name__=="__main__":
     ret = main(sys.argv)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import shutil
+import tempfile
+import logging
+import argparse
+import datetime
+import threading
+from os.path import join
+
+import ingest_common
+
+'''
+Regression checks for the classes the daemons share from
+ingest_common.py.  Exits non-zero if one fails.
+'''
+
+def check_expiry():
+    '''
+    ExpiryScheduler still expires keys whose deadlines were refreshed
+    later when cancels compact its heap.
+    '''
+    lock = threading.RLock()
+    expired = []
+    sched = ingest_common.ExpiryScheduler('check-expiry', lock, expired.append)
+    with lock:
+        now = datetime.datetime.now()
+        for key in range(100):
+            sched.schedule(key, now + datetime.timedelta(seconds=0.1))
+        for key in range(100):
+            sched.schedule(key, now + datetime.timedelta(seconds=0.3))
+        for key in range(80):
+            sched.cancel(key)
+    deadline = time.monotonic() + 3
+    while time.monotonic() < deadline:
+        with lock:
+            if len(expired) >= 20:
+                break
+        time.sleep(0.05)
+    with lock:
+        if sorted(expired) != list(range(80, 100)):
+            return [f'refreshed then compacted: expired {len(expired)} of 20, {len(sched.heap)} in heap, {len(sched.deadlines)} pending']
+    return []
+
+def check_journal_gap():
+    '''
+    a journal with a bad line in the middle is read once, reporting the
+    gap so the joinfile is re-read, and followed on after it.
+    '''
+    tmpdir = tempfile.mkdtemp()
+    fname = join(tmpdir, 'joined-sgs.journal')
+    with open(fname, 'w') as f:
+        f.write('1 S\n2 + 198.18.0.1,232.10.0.1,210\n3 E\n'
+                '4 + 198.18.0.1,232.10.0.2,210\nbad line\n'
+                '6 + 198.18.0.1,232.10.0.3,210\n')
+    snapshots = []
+    events = []
+    reader = ingest_common.JoinJournalReader(fname, snapshots.append, events.extend)
+    failed = []
+    try:
+        ret = reader.poll()
+        if ret is not False or len(snapshots) != 1 or len(events) != 2:
+            failed.append(f'gap: poll returned {ret}, {len(snapshots)} snapshots, {len(events)} events')
+        with open(fname, 'a') as f:
+            f.write('7 - 198.18.0.1,232.10.0.2\n')
+        ret = reader.poll()
+        if ret is not True or len(snapshots) != 1 or len(events) != 3:
+            failed.append(f'after gap: poll returned {ret}, {len(snapshots)} snapshots, {len(events)} events')
+    except RecursionError:
+        failed.append('gap: recursed')
+    finally:
+        shutil.rmtree(tmpdir)
+    return failed
+
+def run_checks():
+    failures = 0
+    for check in (check_expiry, check_journal_gap):
+        failed = check()
+        print(f'{check.__name__}: {"FAIL" if failed else "ok"}')
+        for msg in failed:
+            print(f'   {msg}')
+        failures += len(failed)
+    return 1 if failures else 0
+
+def main(args_in):
+    parser = argparse.ArgumentParser(
+            description='''
+Run regression checks for ingest_common.py.''')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+
+    args = parser.parse_args(args_in[1:])
+    log_level = logging.WARNING
+    if args.verbose > 1:
+        log_level = logging.DEBUG
+    elif args.verbose > 0:
+        log_level = logging.INFO
+    logging.basicConfig(format='%(asctime)s[%(levelname)s]: %(message)s',
+            level=log_level)
+    ingest_common.logger = logging.getLogger('ingest-common-check')
+    return run_checks()
+
+if __name__=="__main__":
+    ret = main(sys.argv)
+    sys.exit(ret)
@@ -0,0 +1,564 @@
+# Shared by the pimwatch, driad-ingest, and cbacc daemons.  Each image
+# copies this next to its script, and each script sets logger here to
+# its own logger at startup.
+import logging
+import os
+import ipaddress
+import datetime
+import heapq
+import threading
+import time
+import json
+import socket
+import http.client
+import urllib.parse
+import io
+import tarfile
+import traceback
+
+logger = logging.getLogger('ingest-common')
+
+class ExpiryScheduler(object):
+    '''
+    calls expire(key) from a background thread once key's deadline has
+    passed.  the deadlines are kept in a heap, and a refresh that only
+    pushes a deadline later just updates self.deadlines: the old heap
+    entry gets pushed again with the new deadline when it surfaces.  so
+    schedule/cancel are O(1) or O(log n), and nothing polls per key.
+
+    lock must be held when calling schedule or cancel, and is held
+    while expire runs.  flush (if given) is called after each batch of
+    keys that expired together.
+    '''
+    def __init__(self, name, lock, expire, flush=None):
+        self.heap = []  # (deadline, seq, key)
+        self.deadlines = {}  # key -> current deadline
+        self.seq = 0
+        self.expire = expire
+        self.flush = flush
+        self.cond = threading.Condition(lock)
+        self.thread = threading.Thread(name=name, target=self.run, daemon=True)
+        self.thread.start()
+
+    def _push(self, deadline, key):
+        self.seq += 1
+        heapq.heappush(self.heap, (deadline, self.seq, key))
+
+    def schedule(self, key, deadline):
+        '''deadline is a datetime, or None to never expire key'''
+        if deadline is None:
+            self.cancel(key)
+            return
+        old_deadline = self.deadlines.get(key)
+        self.deadlines[key] = deadline
+        if old_deadline is not None and old_deadline <= deadline:
+            return
+        self._push(deadline, key)
+        if self.heap[0][1] == self.seq:
+            self.cond.notify()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+        # compact once cancelled entries dominate the heap.  a refreshed
+        # key's heap entry can be older than its deadline, so rebuild from
+        # the live deadlines instead of filtering the entries.
+        if len(self.heap) > 64 and len(self.heap) > 4*len(self.deadlines):
+            self.heap = []
+            for live_key, deadline in self.deadlines.items():
+                self.seq += 1
+                self.heap.append((deadline, self.seq, live_key))
+            heapq.heapify(self.heap)
+
+    def run(self):
+        with self.cond:
+            while True:
+                now = datetime.datetime.now()
+                expired = 0
+                while self.heap and self.heap[0][0] <= now:
+                    deadline, _, key = heapq.heappop(self.heap)
+                    cur_deadline = self.deadlines.get(key)
+                    if cur_deadline is None or cur_deadline < deadline:
+                        # cancelled, or superseded by an earlier entry
+                        continue
+                    if cur_deadline > deadline:
+                        self._push(cur_deadline, key)
+                        continue
+                    del(self.deadlines[key])
+                    expired += 1
+                    try:
+                        self.expire(key)
+                    except Exception as e:
+                        logger.error('error expiring %s: %s' % (key, e))
+                        logger.info(traceback.format_exc())
+                if expired and self.flush:
+                    self.flush()
+                timeout = None
+                if self.heap:
+                    timeout = (self.heap[0][0] - now).total_seconds()
+                self.cond.wait(timeout)
+
+def format_journal_hold(hold_time):
+    if hold_time is None:
+        return 'inf'
+    return '%d' % hold_time.total_seconds()
+
+def parse_journal_hold(hold_str):
+    if hold_str == 'inf':
+        return None
+    return datetime.timedelta(seconds=int(hold_str))
+
+class JoinJournalWriter(object):
+    '''
+    Appends joinfile changes to an append-only journal next to the
+    joinfile, so consumers can apply the changes instead of re-reading
+    and diffing the whole joinfile.  Each line is "seq op payload":
+        <seq> S                  start of a full snapshot
+        <seq> + src,grp[,hold]   (S,G) added (or a snapshot member)
+        <seq> = src,grp[,hold]   (S,G) refreshed
+        <seq> - src,grp          (S,G) removed
+        <seq> E                  end of a full snapshot
+    hold is the hold time in seconds or "inf".  Every journal file starts
+    with a snapshot; after snapshot_every changes the journal is rotated
+    by writing a new file starting with a snapshot and renaming it into
+    place, which is also how a consumer that falls behind resyncs.
+    '''
+    def __init__(self, fname, snapshot_every=10000):
+        self.fname = fname
+        self.snapshot_every = snapshot_every
+        self.state = {}  # (src,grp) -> hold_time
+        self.seq = 0
+        self.since_snapshot = 0
+        self.f = None
+        self.rotate()
+
+    def rotate(self):
+        lines = []
+        self.seq += 1
+        lines.append(f'{self.seq} S')
+        for (src, grp), hold_time in self.state.items():
+            self.seq += 1
+            lines.append(f'{self.seq} + {src},{grp},{format_journal_hold(hold_time)}')
+        self.seq += 1
+        lines.append(f'{self.seq} E')
+        tmp_fname = os.path.join(os.path.dirname(self.fname),
+                '.' + os.path.basename(self.fname) + '.tmp')
+        with open(tmp_fname, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_fname, self.fname)
+        if self.f:
+            self.f.close()
+        self.f = open(self.fname, 'a')
+        self.since_snapshot = 0
+
+    def append(self, events):
+        '''events is a list of (op, (src,grp), hold_time) with op in "+=-"'''
+        if not events:
+            return
+        lines = []
+        for op, sg, hold_time in events:
+            src, grp = sg
+            self.seq += 1
+            if op == '-':
+                self.state.pop(sg, None)
+                lines.append(f'{self.seq} - {src},{grp}')
+            else:
+                self.state[sg] = hold_time
+                lines.append(f'{self.seq} {op} {src},{grp},{format_journal_hold(hold_time)}')
+        self.f.write('\n'.join(lines) + '\n')
+        self.f.flush()
+        self.since_snapshot += len(events)
+        if self.since_snapshot >= self.snapshot_every:
+            self.rotate()
+
+class JoinJournalReader(object):
+    '''
+    Follows the journal written next to a joinfile by the producer's
+    JoinJournalWriter, and hands the changes to on_events as a list of
+    (op, (src,grp), hold_time) with op in "+=-".  hold_time is a
+    timedelta, None for infinite, or missing_hold if the producer didn't
+    give one.  Full snapshots go to on_snapshot as a dict of
+    (src,grp) -> hold_time.
+
+    poll() reads whatever was appended since the last poll, so the cost
+    scales with the number of changes.  It reopens the journal from its
+    starting snapshot when the file was rotated.  It returns False if
+    there's no journal to read, or if a sequence number was skipped
+    within the same file (re-reading it would hit the same gap), so the
+    caller should re-read the joinfile; following the journal goes on
+    after the gap.
+    '''
+    def __init__(self, fname, on_snapshot, on_events, missing_hold=None):
+        self.fname = fname
+        self.on_snapshot = on_snapshot
+        self.on_events = on_events
+        self.missing_hold = missing_hold
+        self.f = None
+        self.ino = None
+        self.partial = ''
+        self.last_seq = None
+        self.snapshot = None
+
+    def reopen(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+        try:
+            self.f = open(self.fname)
+        except FileNotFoundError:
+            return False
+        self.ino = os.fstat(self.f.fileno()).st_ino
+        self.partial = ''
+        self.last_seq = None
+        self.snapshot = None
+        logger.info(f'reading journal {self.fname} from start')
+        return True
+
+    def rotated(self):
+        try:
+            return os.stat(self.fname).st_ino != self.ino
+        except FileNotFoundError:
+            return True
+
+    def poll(self):
+        while True:
+            try:
+                ino = os.stat(self.fname).st_ino
+            except FileNotFoundError:
+                return False
+            if self.f is None or ino != self.ino:
+                if not self.reopen():
+                    return False
+            ret = self.read_new()
+            if ret is not None:
+                return ret
+            # rotated under us, start over from the new file's snapshot
+
+    def read_new(self):
+        '''
+        handles the lines appended since the last read.  returns True,
+        False after a gap in the sequence, or None if the file was
+        rotated after a gap.
+        '''
+        chunk = self.f.read()
+        if not chunk:
+            return True
+        lines = (self.partial + chunk).split('\n')
+        # the last piece is empty, or a line still being written
+        self.partial = lines.pop()
+        events = []
+        skipped = False
+        for line in lines:
+            try:
+                seq_str, op, *payload = line.split(' ', 2)
+                seq = int(seq_str)
+            except ValueError as e:
+                logger.warning(f'{self.fname}: bad journal line "{line}": {e}')
+                continue
+            if self.last_seq is not None and seq != self.last_seq + 1:
+                if events:
+                    self.on_events(events)
+                    events = []
+                if self.rotated():
+                    logger.warning(f'{self.fname}: journal skipped from {self.last_seq} to {seq} and was rotated, resyncing')
+                    return None
+                logger.warning(f'{self.fname}: journal skipped from {self.last_seq} to {seq}, re-reading the joinfile')
+                skipped = True
+            if self.last_seq is None and op != 'S':
+                # we only start reading from a snapshot
+                continue
+            self.last_seq = seq
+            if op == 'S':
+                self.snapshot = {}
+                continue
+            if op == 'E':
+                if self.snapshot is not None:
+                    if events:
+                        self.on_events(events)
+                        events = []
+                    self.on_snapshot(self.snapshot)
+                    self.snapshot = None
+                continue
+            if op not in ('+', '=', '-') or len(payload) != 1:
+                logger.warning(f'{self.fname}: unknown journal line "{line}"')
+                continue
+            fields = payload[0].split(',')
+            try:
+                src = ipaddress.ip_address(fields[0])
+                grp = ipaddress.ip_address(fields[1])
+                if len(fields) > 2:
+                    hold_time = parse_journal_hold(fields[2])
+                else:
+                    hold_time = self.missing_hold
+            except (ValueError, IndexError) as e:
+                logger.warning(f'{self.fname}: bad journal line "{line}": {e}')
+                continue
+            if self.snapshot is not None:
+                self.snapshot[(src, grp)] = hold_time
+            else:
+                events.append((op, (src, grp), hold_time))
+        if events:
+            self.on_events(events)
+        return not skipped
+
+class JoinfileWatcher(object):
+    '''
+    Watches a joinfile (and its journal, if any) and calls reconcile()
+    on a single worker thread, so reconciliations never overlap.
+
+    A burst of events is collapsed into one reconcile() that runs once
+    no event has arrived for the quiet period, or once the oldest
+    unhandled event is max_stale old, whichever comes first.
+
+    Only close-after-write and rename-into-place count for the joinfile,
+    since those mean a complete file is there to read (a modify event
+    can be a partial write).  The journal is append-only and its reader
+    keeps partial lines, so appends to it count too.
+    '''
+    def __init__(self, fname, reconcile, journal_fname=None, quiet=0.1, max_stale=1.0):
+        self.fname = fname
+        self.journal_fname = journal_fname
+        self.reconcile = reconcile
+        self.quiet = quiet
+        self.max_stale = max_stale
+        self.cond = threading.Condition()
+        self.first_event = None
+        self.last_event = None
+        # imported here since pimwatch uses this module without watchdog
+        from watchdog.events import PatternMatchingEventHandler
+        self.handler = PatternMatchingEventHandler(
+                patterns=['*'],
+                ignore_patterns=None,
+                ignore_directories=True,
+                case_sensitive=True)
+        self.handler.on_closed = self.on_closed
+        self.handler.on_moved = self.on_moved
+        self.handler.on_modified = self.on_modified
+        self.thread = threading.Thread(target=self.run,
+                name='joinfile-watcher', daemon=True)
+
+    def on_closed(self, event):
+        if event.src_path == self.fname:
+            self.notify()
+
+    def on_moved(self, event):
+        if event.dest_path in (self.fname, self.journal_fname):
+            self.notify()
+
+    def on_modified(self, event):
+        if self.journal_fname and event.src_path == self.journal_fname:
+            self.notify()
+
+    def notify(self):
+        global logger
+        now = time.monotonic()
+        with self.cond:
+            if self.first_event is None:
+                self.first_event = now
+                logger.debug(f'change to {self.fname} pending')
+            self.last_event = now
+            self.cond.notify()
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        global logger
+        while True:
+            with self.cond:
+                while True:
+                    if self.first_event is None:
+                        self.cond.wait()
+                        continue
+                    deadline = min(self.last_event + self.quiet,
+                            self.first_event + self.max_stale)
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.cond.wait(timeout)
+                stale = time.monotonic() - self.first_event
+                self.first_event = None
+                self.last_event = None
+            logger.debug(f'reconciling {self.fname}, {stale:.3f}s after first change')
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.error(f'failed reconciling {self.fname}: {e}\n{traceback.format_exc()}')
+
+class DockerError(Exception):
+    pass
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+class DockerEngine(object):
+    '''
+    Talks to the Docker Engine API over its unix socket, keeping idle
+    connections open for the next request instead of paying for a
+    docker cli process and a new connection per call.
+    https://docs.docker.com/engine/api/
+    '''
+    def __init__(self, socket_path='/var/run/docker.sock', timeout=60):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.idle = []  # kept-alive UnixHTTPConnections
+        self.idle_lock = threading.Lock()
+
+    def __str__(self):
+        return 'docker api at %s' % self.socket_path
+
+    def request(self, method, path, body=None, ok=(200, 201, 204), content_type='application/json'):
+        '''
+        returns (status, decoded json or None), and raises DockerError
+        for a status not in ok.  body is encoded as json unless it's
+        already bytes.
+        '''
+        headers = {}
+        data = None
+        if body is not None:
+            data = body
+            if not isinstance(body, bytes):
+                data = json.dumps(body).encode()
+            headers['Content-Type'] = content_type
+        while True:
+            conn = None
+            with self.idle_lock:
+                if self.idle:
+                    conn = self.idle.pop()
+            reused = conn is not None
+            if not conn:
+                conn = UnixHTTPConnection(self.socket_path, self.timeout)
+            sent = False
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                sent = True
+                resp = conn.getresponse()
+                raw = resp.read()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                # the engine may have closed the idle connection.  try a
+                # new one, unless the request went out and isn't safe to
+                # repeat (a create or start might have happened).
+                if reused and (not sent or method in ('GET', 'HEAD', 'DELETE')):
+                    continue
+                raise DockerError('%s %s: %s' % (method, path, e))
+            if resp.will_close:
+                conn.close()
+            else:
+                with self.idle_lock:
+                    self.idle.append(conn)
+            break
+
+        val = None
+        if raw and 'json' in resp.getheader('Content-Type', ''):
+            try:
+                val = json.loads(raw)
+            except ValueError:
+                # a stream of progress objects, like from an image pull
+                val = [json.loads(line) for line in raw.splitlines() if line.strip()]
+        if resp.status not in ok:
+            msg = raw.decode(errors='replace').strip()
+            if isinstance(val, dict) and 'message' in val:
+                msg = val['message']
+            raise DockerError('%s %s: %d %s' % (method, path, resp.status, msg))
+        return resp.status, val
+
+    def container_names(self):
+        _, containers = self.request('GET', '/containers/json')
+        return [name.lstrip('/') for cont in containers for name in cont.get('Names', [])]
+
+    def image_entrypoint(self, imagename):
+        '''returns the image's entrypoint list, or None if there's no such image'''
+        status, image = self.request('GET', '/images/%s/json' % urllib.parse.quote(imagename, safe=''), ok=(200, 404))
+        if status == 404:
+            return None
+        return (image.get('Config') or {}).get('Entrypoint') or []
+
+    def pull_image(self, imagename):
+        repo, _, tag = imagename.rpartition(':')
+        if not repo or '/' in tag:
+            repo, tag = imagename, 'latest'
+        # a pull can take a lot longer than other requests, so it gets
+        # its own connection
+        conn = UnixHTTPConnection(self.socket_path, timeout=600)
+        try:
+            conn.request('POST', '/images/create?%s' % urllib.parse.urlencode({'fromImage': repo, 'tag': tag}))
+            resp = conn.getresponse()
+            raw = resp.read()
+        except (OSError, http.client.HTTPException) as e:
+            raise DockerError('pull %s: %s' % (imagename, e))
+        finally:
+            conn.close()
+        if resp.status != 200:
+            raise DockerError('pull %s: %d %s' % (imagename, resp.status, raw.decode(errors='replace').strip()))
+        # errors partway through come back in the progress stream
+        for line in raw.splitlines():
+            try:
+                progress = json.loads(line)
+            except ValueError:
+                continue
+            if 'error' in progress:
+                raise DockerError('pull %s: %s' % (imagename, progress['error']))
+
+    def network_exists(self, nwname):
+        status, _ = self.request('GET', '/networks/%s' % urllib.parse.quote(nwname), ok=(200, 404))
+        return status == 200
+
+    def run_gateway(self, contname, imagename, args, amt_nwname, native_nwname, entrypoint=None):
+        '''
+        create (on amt_nwname), connect (to native_nwname) and start the
+        gateway container, back to back on one kept-alive connection.
+        '''
+        name = urllib.parse.quote(contname)
+        body = {
+            'Image': imagename,
+            'Cmd': args,
+            'HostConfig': {
+                'AutoRemove': True,
+                'Privileged': True,
+                'NetworkMode': amt_nwname,
+                'LogConfig': {
+                    'Type': 'json-file',
+                    'Config': {'max-size': '2m', 'max-file': '5'},
+                },
+            },
+        }
+        if entrypoint:
+            body['Entrypoint'] = [entrypoint]
+        self.request('POST', '/containers/create?name=%s' % name, body)
+        try:
+            self.request('POST', '/networks/%s/connect' % urllib.parse.quote(native_nwname), {'Container': contname})
+            self.request('POST', '/containers/%s/start' % name, ok=(204, 304))
+        except DockerError:
+            # not started, so AutoRemove won't clean it up
+            self.request('DELETE', '/containers/%s?force=1' % name, ok=(204, 404, 409))
+            raise
+
+    def put_files(self, contname, dirpath, files):
+        '''writes [(fname, data)] into dirpath in the container, in order'''
+        self.request('PUT', '/containers/%s/archive?path=%s' % (urllib.parse.quote(contname), urllib.parse.quote(dirpath)), tar_files(files), ok=(200,), content_type='application/x-tar')
+
+    def container_running(self, contname):
+        status, cont = self.request('GET', '/containers/%s/json' % urllib.parse.quote(contname), ok=(200, 404))
+        return status == 200 and bool(cont.get('State', {}).get('Running'))
+
+    def stop(self, contname):
+        self.request('POST', '/containers/%s/stop' % urllib.parse.quote(contname), ok=(204, 304, 404))
+
+def tar_files(files):
+    '''a tar archive of [(fname, data)], for copying into a container'''
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for fname, data in files:
+            info = tarfile.TarInfo(fname)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
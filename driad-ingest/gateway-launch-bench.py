@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import re
+import json
+import time
+import shutil
+import tempfile
+import tarfile
+import io
+import argparse
+import threading
+import socketserver
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, dirname, join
+from importlib.machinery import SourceFileLoader
+
+'''
+Measures amtgw gateway launch and stop latency through driad-ingest-mgr's
+docker backends, against a fake Docker Engine API served on a local unix
+socket (so no docker daemon or amtgw image is needed).
+
+The api backend talks to the socket directly.  The cli backend runs the
+docker cli with DOCKER_HOST pointed at the same socket, if there is a
+docker cli installed.  The api-warm run binds gateways from a
+WarmGatewayPool instead of launching them.
+'''
+
+ingest = SourceFileLoader('ingest',
+        join(dirname(abspath(__file__)), 'driad-ingest-mgr')).load_module()
+
+class FakeEngine(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    just enough of the engine api for the gateway lifecycle, adding
+    delay seconds to each request.  counts connections and requests.
+    '''
+    daemon_threads = True
+
+    def __init__(self, path, delay):
+        self.delay = delay
+        self.containers = {}  # name -> running
+        self.files = {}  # (container name, path) -> bytes copied in
+        self.images = {}  # name -> entrypoint
+        self.networks = {'amt-bridge', 'mcast-native-ingest'}
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        super().__init__(path, FakeEngineHandler)
+
+    def get_request(self):
+        request, _ = super().get_request()
+        with self.lock:
+            self.connections += 1
+        # BaseHTTPRequestHandler wants a (host, port) client_address
+        return request, ('local', 0)
+
+class FakeEngineHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    version_re = re.compile(r'^/v[0-9.]+/')
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, val=None):
+        body = b''
+        if val is not None:
+            body = json.dumps(val).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Api-Version', '1.41')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_any(self):
+        srv = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        url = urllib.parse.urlsplit(self.version_re.sub('/', self.path))
+        path = [urllib.parse.unquote(p) for p in url.path.strip('/').split('/')]
+        query = urllib.parse.parse_qs(url.query)
+        with srv.lock:
+            srv.requests += 1
+        time.sleep(srv.delay)
+
+        with srv.lock:
+            if path[0] == '_ping':
+                return self.reply(200, 'OK')
+            if path[0] == 'version':
+                return self.reply(200, {'Version': '20.10.0', 'ApiVersion': '1.41', 'MinAPIVersion': '1.12'})
+            if path[0] == 'images' and path[-1] == 'json':
+                name = '/'.join(path[1:-1])
+                if name not in srv.images:
+                    return self.reply(404, {'message': 'No such image: %s' % name})
+                return self.reply(200, {'Config': {'Entrypoint': srv.images[name]}})
+            if path == ['images', 'create']:
+                name = '%s:%s' % (query['fromImage'][0], query.get('tag', ['latest'])[0])
+                srv.images[name] = ['/usr/bin/amtgw-start']
+                return self.reply(200, {'status': 'Downloaded newer image for %s' % name})
+            if path == ['containers', 'json']:
+                return self.reply(200, [{'Names': ['/' + name]} for name, running in srv.containers.items() if running])
+            if path == ['containers', 'create']:
+                name = query.get('name', [''])[0]
+                if name in srv.containers:
+                    return self.reply(409, {'message': 'Conflict. The container name "/%s" is already in use' % name})
+                srv.containers[name] = False
+                return self.reply(201, {'Id': name, 'Warnings': []})
+            if path[0] == 'networks' and len(path) == 2:
+                if path[1] not in srv.networks:
+                    return self.reply(404, {'message': 'network %s not found' % path[1]})
+                return self.reply(200, {'Name': path[1]})
+            if path[0] == 'networks' and path[2:] == ['connect']:
+                cont = json.loads(body).get('Container')
+                if cont not in srv.containers:
+                    return self.reply(404, {'message': 'No such container: %s' % cont})
+                return self.reply(200)
+            if path[0] == 'containers' and len(path) >= 2:
+                name = path[1]
+                if name not in srv.containers:
+                    return self.reply(404, {'message': 'No such container: %s' % name})
+                if self.command == 'DELETE':
+                    del(srv.containers[name])
+                    return self.reply(204)
+                if path[2:] == ['start']:
+                    srv.containers[name] = True
+                    return self.reply(204)
+                if path[2:] == ['stop']:
+                    # created with AutoRemove/--rm
+                    del(srv.containers[name])
+                    return self.reply(204)
+                if path[2:] == ['archive'] and self.command == 'PUT':
+                    with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+                        for member in tar.getmembers():
+                            data = tar.extractfile(member).read()
+                            srv.files[(name, query['path'][0] + '/' + member.name)] = data
+                    return self.reply(200)
+                if path[2:] == ['json']:
+                    return self.reply(200, {'Name': '/' + name, 'State': {'Running': srv.containers[name]}})
+        return self.reply(404, {'message': 'page not found'})
+
+    do_GET = handle_any
+    do_POST = handle_any
+    do_DELETE = handle_any
+    do_HEAD = handle_any
+    do_PUT = handle_any
+
+def percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals)-1, int(round(pct/100.0 * (len(sorted_vals)-1))))
+    return sorted_vals[idx]
+
+def run_backend(docker, gateways, parallel):
+    '''launches then stops the gateways, returns sorted latencies'''
+    def launch(idx):
+        t0 = time.perf_counter()
+        docker.run_gateway('ingest-gw-bench-%d' % idx, 'grumpyoldtroll/amtgw:0.0.4',
+                ['192.0.2.%d' % (idx % 250 + 1)], 'amt-bridge', 'mcast-native-ingest')
+        return time.perf_counter() - t0
+    def stop(idx):
+        t0 = time.perf_counter()
+        docker.stop('ingest-gw-bench-%d' % idx)
+        return time.perf_counter() - t0
+
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        t0 = time.perf_counter()
+        launches = sorted(pool.map(launch, range(gateways)))
+        launch_elapsed = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        stops = sorted(pool.map(stop, range(gateways)))
+        stop_elapsed = time.perf_counter() - t0
+    return launches, launch_elapsed, stops, stop_elapsed
+
+def run_warm(docker, gateways, warm):
+    '''fills a warm pool of the given size, then binds gateways from it'''
+    pool = ingest.WarmGatewayPool(docker, ingest.amtgw_image, warm,
+            'amt-bridge', 'mcast-native-ingest')
+    pool.start(docker.image_entrypoint(ingest.amtgw_image))
+    binds = []
+    launch_elapsed = 0
+    for idx in range(gateways):
+        while not pool.ready:
+            time.sleep(0.001)
+        t0 = time.perf_counter()
+        contname = pool.take()
+        pool.bind(contname, '192.0.2.%d' % (idx % 250 + 1))
+        elapsed = time.perf_counter() - t0
+        binds.append(elapsed)
+        launch_elapsed += elapsed
+    pool.pool.shutdown()
+    return sorted(binds), launch_elapsed
+
+def main(args_in):
+    parser = argparse.ArgumentParser(
+            description='''
+Benchmark amtgw gateway launch/stop latency through the docker engine api
+and the docker cli, against a fake engine on a unix socket.''')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-n', '--gateways', type=int, default=200,
+        help='number of gateways to launch and stop (default 200)')
+    parser.add_argument('-p', '--parallel', type=int, default=1,
+        help='launches in flight at once (default 1)')
+    parser.add_argument('-d', '--delay', type=float, default=0.002,
+        help='seconds the fake engine takes per request (default 0.002)')
+    parser.add_argument('--docker-cli', default=shutil.which('docker'),
+        help='docker cli to compare against (default: docker from PATH, skipped if there is none)')
+    parser.add_argument('--cli-gateways', type=int, default=10,
+        help='gateways to launch through the docker cli, which runs a docker process for each create, connect, and start (default 10)')
+    parser.add_argument('-w', '--warm', type=int, default=4,
+        help='warm gateway pool size for the api-warm run, 0 to skip it (default 4).  Its launch/s is binds per second of bind time, not counting the pool refilling in between.')
+
+    args = parser.parse_args(args_in[1:])
+    ingest.logger = ingest.setup_logger('gateway-launch-bench', args.verbose)
+    ingest.ingest_common.logger = ingest.logger
+
+    tmpdir = tempfile.mkdtemp()
+    sock_path = join(tmpdir, 'docker.sock')
+    engine = FakeEngine(sock_path, args.delay)
+    threading.Thread(target=engine.serve_forever, daemon=True).start()
+
+    backends = [('api', ingest.DockerEngine(sock_path), args.gateways)]
+    if args.docker_cli:
+        os.environ['DOCKER_HOST'] = 'unix://' + sock_path
+        backends.append(('cli', ingest.DockerCLI(args.docker_cli), min(args.gateways, args.cli_gateways)))
+    else:
+        print('no docker cli found, only benchmarking the api backend')
+
+    print(f'{args.parallel} launches in parallel, {args.delay*1000:.1f}ms per engine request')
+    print(f'{"backend":<9}{"gateways":>9}{"launch/s":>10}{"p50 ms":>9}{"p99 ms":>9}{"max ms":>9}{"stop p50":>10}{"conns":>7}{"reqs":>7}')
+    try:
+        api = backends[0][1]
+        api.pull_image(ingest.amtgw_image)
+        if args.warm > 0:
+            engine.connections = engine.requests = 0
+            binds, bind_elapsed = run_warm(api, args.gateways, args.warm)
+            print(f'{"api-warm":<9}{args.gateways:>9}{args.gateways/bind_elapsed:>10.1f}{percentile(binds,50)*1000:>9.1f}{percentile(binds,99)*1000:>9.1f}{binds[-1]*1000:>9.1f}{"":>10}{engine.connections:>7}{engine.requests:>7}')
+            bound = sum(1 for (name, path) in engine.files if path.endswith('amt-relay.ready'))
+            if bound != args.gateways:
+                print(f'error: {bound} warm gateways bound, expected {args.gateways}')
+            for name in list(engine.containers):
+                api.stop(name)
+        for name, docker, gateways in backends:
+            engine.connections = engine.requests = 0
+            launches, launch_elapsed, stops, stop_elapsed = run_backend(docker, gateways, args.parallel)
+            print(f'{name:<9}{gateways:>9}{gateways/launch_elapsed:>10.1f}{percentile(launches,50)*1000:>9.1f}{percentile(launches,99)*1000:>9.1f}{launches[-1]*1000:>9.1f}{percentile(stops,50)*1000:>10.1f}{engine.connections:>7}{engine.requests:>7}')
+    finally:
+        engine.shutdown()
+        shutil.rmtree(tmpdir)
+
+    return 0
+
+if __name__=="__main__":
+    ret = main(sys.argv)
+    sys.exit(ret)
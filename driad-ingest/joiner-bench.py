@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import ipaddress
+from os.path import abspath, dirname, join
+from importlib.machinery import SourceFileLoader
+
+'''
+Joins and leaves a lot of (S,G)s through driad-ingest-mgr's joiners and
+compares what they cost: join/leave latency, sockets or processes, and
+memory.
+
+The socket joiner makes real source-specific joins, so it needs an
+interface with a route for the groups (see --interface).  The process
+joiner runs mcrx-check if it's installed, or otherwise a stand-in that
+just sleeps, which is a lower bound on a process per (S,G) since it
+doesn't make the join.
+'''
+
+ingest = SourceFileLoader('ingest',
+        join(dirname(abspath(__file__)), 'driad-ingest-mgr')).load_module()
+
+def percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals)-1, int(round(pct/100.0 * (len(sorted_vals)-1))))
+    return sorted_vals[idx]
+
+def sg_list(count, groups, v6=False):
+    '''count (S,G)s, spread over groups groups'''
+    if v6:
+        src_base, grp_base = ipaddress.ip_address('2001:db8::100'), ipaddress.ip_address('ff3e::8000:0')
+    else:
+        src_base, grp_base = ipaddress.ip_address('198.18.0.1'), ipaddress.ip_address('232.10.0.0')
+    return [(src_base + idx//groups, grp_base + idx % groups) for idx in range(count)]
+
+def pss_kib(pid):
+    '''proportional set size, so shared library pages aren't counted per process'''
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+def run_joiner(joiner, sgs):
+    fds_before = open_fds()
+    pss_before = pss_kib(os.getpid())
+    joins = []
+    handles = []
+    failures = 0
+    t0 = time.perf_counter()
+    for src, grp in sgs:
+        t1 = time.perf_counter()
+        try:
+            handles.append(joiner.join(src, grp))
+        except OSError as e:
+            failures += 1
+            if failures == 1:
+                print(f'join ({src},{grp}) failed: {e}')
+        joins.append(time.perf_counter() - t1)
+    join_elapsed = time.perf_counter() - t0
+
+    if isinstance(joiner, ingest.McrxJoiner):
+        procs = list(joiner.procs)
+        mem = sum(pss_kib(p.pid) for p in procs)
+        holders = f'{len(procs)} procs'
+    else:
+        mem = pss_kib(os.getpid()) - pss_before
+        holders = f'{joiner.socket_count} socks'
+    fds = open_fds() - fds_before
+
+    leaves = []
+    t0 = time.perf_counter()
+    for handle in handles:
+        t1 = time.perf_counter()
+        joiner.leave(handle)
+        leaves.append(time.perf_counter() - t1)
+    leave_elapsed = time.perf_counter() - t0
+    return sorted(joins), join_elapsed, sorted(leaves), leave_elapsed, holders, fds, mem, failures
+
+def main(args_in):
+    parser = argparse.ArgumentParser(
+            description='''
+Benchmark joining and leaving (S,G)s with the in-process socket joiner
+against a process per (S,G).''')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-n', '--sgs', type=int, default=2000,
+        help='number of (S,G)s to join (default 2000)')
+    parser.add_argument('-g', '--groups', type=int, default=50,
+        help='number of groups the (S,G)s are spread over (default 50)')
+    parser.add_argument('-i', '--interface',
+        help='interface to join on (default: the kernel picks from the routing table)')
+    parser.add_argument('-6', '--ipv6', action='store_true', default=False,
+        help='join ipv6 (S,G)s')
+    parser.add_argument('--procs', type=int, default=500,
+        help='(S,G)s to join with a process each, 0 to skip (default 500)')
+    parser.add_argument('--mcrx-check', default=shutil.which('mcrx-check'),
+        help='mcrx-check to run for the process per (S,G) joiner (default: from PATH, or a sleeping stand-in)')
+
+    args = parser.parse_args(args_in[1:])
+    ingest.logger = ingest.setup_logger('joiner-bench', args.verbose)
+    ingest.ingest_common.logger = ingest.logger
+
+    runs = [('socket', ingest.SSMJoiner(args.interface), sg_list(args.sgs, args.groups, args.ipv6))]
+    tmpdir = None
+    if args.procs > 0:
+        cmd = args.mcrx_check
+        name = 'mcrx'
+        if not cmd:
+            tmpdir = tempfile.mkdtemp()
+            cmd = join(tmpdir, 'mcrx-standin')
+            with open(cmd, 'w') as f:
+                f.write('#!/bin/sh\nexec sleep 100000\n')
+            os.chmod(cmd, 0o755)
+            name = 'sleep'
+            print('no mcrx-check found, using a sleeping stand-in for the process per (S,G)')
+        runs.append((name, ingest.McrxJoiner(cmd), sg_list(args.procs, args.groups, args.ipv6)))
+
+    print(f'{"joiner":<8}{"sgs":>7}{"joins/s":>10}{"p50 us":>9}{"p99 us":>10}{"leaves/s":>10}{"holders":>13}{"fds":>6}{"KiB/sg":>8}{"fails":>7}')
+    try:
+        for name, joiner, sgs in runs:
+            joins, join_elapsed, leaves, leave_elapsed, holders, fds, mem, failures = run_joiner(joiner, sgs)
+            print(f'{name:<8}{len(sgs):>7}{len(sgs)/join_elapsed:>10.0f}{percentile(joins,50)*1e6:>9.1f}{percentile(joins,99)*1e6:>10.1f}{len(sgs)/leave_elapsed:>10.0f}{holders:>13}{fds:>6}{mem/len(sgs):>8.1f}{failures:>7}')
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+    return 0
+
+if __name__=="__main__":
+    ret = main(sys.argv)
+    sys.exit(ret)
@@ -29,6 +29,11 @@ smcroutectl, and expects to use the host network.''')
     parser.add_argument('-v', '--verbose', action='count', default=0)
     parser.add_argument('-j', '--joinfile', required=True,
         help='Name of the file inside the container where (S,G)s will be updated (needs absolute path within the container)')
+    parser.add_argument('-c', '--capture', choices=['pcap', 'text'],
+        default='pcap',
+        help='how pimwatch reads join/prunes from tcpdump (default pcap)')
+    parser.add_argument('--journal', action='store_true', default=False,
+        help='also write the <joinfile>.journal delta channel')
     '''
     parser.add_argument('-u', '--upstream', required=True,
         help='The interface from which native multicast traffic for joined (S,G)s will be forwarded to downstream')
@@ -55,7 +60,10 @@ smcroutectl, and expects to use the host network.''')
         '-u', upstream,
         '-d', downstream,
         '-j', args.joinfile,
+        '-c', args.capture,
     ]
+    if args.journal:
+        watch_cmd.append('--journal')
 
     conf = f'''
 phyint eth0 enable
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+import sys
+import struct
+import random
+import time
+import tracemalloc
+import argparse
+import ipaddress
+import io
+from os.path import abspath, dirname, join
+from importlib.machinery import SourceFileLoader
+
+'''
+Generates synthetic PIM join/prune storms and measures how fast
+pimwatch's join/prune parsers get through them.
+
+The storm is written both as a pcap (what "tcpdump -w -" produces for
+--capture pcap) and as "tcpdump -vvv -n pim" text (what --capture text
+parses), so the two parsers see the same packets.  Generated files can
+also be fed to "pimwatch.py --replay" to load-test the joinfile
+consumers.
+'''
+
+pimwatch = SourceFileLoader('pimwatch',
+        join(dirname(abspath(__file__)), 'pimwatch.py')).load_module()
+
+PIM_ALL_ROUTERS = ipaddress.ip_address('224.0.0.13')
+
+def format_holdtime(secs):
+    '''inverse of pimwatch.parse_holdtime, matching tcpdump's format'''
+    if secs == pimwatch.PIM_HOLDTIME_INFINITE:
+        return 'infinity'
+    if secs == 0:
+        return '0s'
+    out = ''
+    for unit in 'ywdhms':
+        n, secs = divmod(secs, pimwatch.holdtime_units[unit])
+        if n:
+            out += '%d%s' % (n, unit)
+    return out
+
+class StormPacket(object):
+    def __init__(self, sender, nbr, hold_secs, groups):
+        self.sender = sender
+        self.nbr = nbr
+        self.hold_secs = hold_secs
+        self.groups = groups  # [(grp, [joined srcs], [pruned srcs])]
+
+    def to_pim(self):
+        def enc_unicast(ip):
+            return bytes([1 if ip.version == 4 else 2, 0]) + ip.packed
+        def enc_group(ip):
+            return bytes([1 if ip.version == 4 else 2, 0, 0, ip.max_prefixlen]) + ip.packed
+        def enc_source(ip):
+            return bytes([1 if ip.version == 4 else 2, 0, 0x04, ip.max_prefixlen]) + ip.packed
+
+        out = [bytes([0x20 | pimwatch.PIM_TYPE_JOIN_PRUNE, 0, 0, 0]),
+                enc_unicast(self.nbr),
+                struct.pack('!BBH', 0, len(self.groups), self.hold_secs)]
+        for grp, joins, prunes in self.groups:
+            out.append(enc_group(grp))
+            out.append(struct.pack('!HH', len(joins), len(prunes)))
+            out.extend(enc_source(src) for src in joins)
+            out.extend(enc_source(src) for src in prunes)
+        return b''.join(out)
+
+    def to_frame(self):
+        pim = self.to_pim()
+        ip_hdr = struct.pack('!BBHHHBBH4s4s', 0x45, 0xc0, 20 + len(pim),
+                0, 0, 1, pimwatch.PIM_PROTO, 0,
+                self.sender.packed, PIM_ALL_ROUTERS.packed)
+        return b'\x01\x00\x5e\x00\x00\x0d' + bytes(6) + b'\x08\x00' + ip_hdr + pim
+
+    def to_text(self, ts):
+        pim_len = len(self.to_pim())
+        lines = [
+            '%s IP (tos 0xc0, ttl 1, id 0, offset 0, flags [none], proto PIM (103), length %d)' % (time.strftime('%H:%M:%S', time.gmtime(ts)) + '.%06d' % int((ts % 1)*1e6), 20 + pim_len),
+            '    %s > %s: PIMv2, length %d' % (self.sender, PIM_ALL_ROUTERS, pim_len),
+            '\tJoin / Prune, cksum 0x0000 (correct), upstream-neighbor: %s' % self.nbr,
+            '\t  %d group(s), holdtime: %s' % (len(self.groups), format_holdtime(self.hold_secs)),
+        ]
+        for idx, (grp, joins, prunes) in enumerate(self.groups):
+            lines.append('\t    group #%d: %s, joined sources: %d, pruned sources: %d' % (idx+1, grp, len(joins), len(prunes)))
+            for sidx, src in enumerate(joins):
+                lines.append('\t      joined source #%d: %s(S)' % (sidx+1, src))
+            for sidx, src in enumerate(prunes):
+                lines.append('\t      pruned source #%d: %s(S)' % (sidx+1, src))
+        return '\n'.join(lines) + '\n'
+
+def join_prune_storm(packets, groups, sources, prune_ratio, routers=1, hold_secs=210, seed=None):
+    '''
+    yields StormPacket objects, each carrying groups x sources (S,G)s.
+    prune_ratio is the chance that a given (S,G) is pruned instead of
+    joined.  the downstream routers take turns sending.
+    '''
+    rnd = random.Random(seed)
+    nbr = ipaddress.ip_address('10.9.1.2')
+    senders = [ipaddress.ip_address('10.9.1.16') + i for i in range(routers)]
+    grp_base = int(ipaddress.ip_address('232.0.0.0'))
+    src_base = int(ipaddress.ip_address('23.0.0.0'))
+    for pkt_idx in range(packets):
+        pkt_groups = []
+        for _ in range(groups):
+            grp = ipaddress.ip_address(grp_base + rnd.randrange(1 << 24))
+            joins, prunes = [], []
+            for _ in range(sources):
+                src = ipaddress.ip_address(src_base + rnd.randrange(1 << 24))
+                (prunes if rnd.random() < prune_ratio else joins).append(src)
+            pkt_groups.append((grp, joins, prunes))
+        yield StormPacket(senders[pkt_idx % routers], nbr, hold_secs, pkt_groups)
+
+def write_pcap(f, storm, start_ts=0.0, interval=0.001):
+    f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 262144, pimwatch.LINKTYPE_ETHERNET))
+    ts = start_ts
+    for pkt in storm:
+        frame = pkt.to_frame()
+        f.write(struct.pack('<IIII', int(ts), int((ts % 1)*1e6), len(frame), len(frame)))
+        f.write(frame)
+        ts += interval
+
+def write_text(f, storm, start_ts=0.0, interval=0.001):
+    ts = start_ts
+    for pkt in storm:
+        f.write(pkt.to_text(ts))
+        ts += interval
+
+class TimedIter(object):
+    '''
+    wraps a notice generator, recording the time spent producing each
+    notice (the parse latency per packet).
+    '''
+    def __init__(self, it):
+        self.it = it
+        self.latencies = []
+
+    def __iter__(self):
+        it = iter(self.it)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                notice = next(it)
+            except StopIteration:
+                return
+            self.latencies.append(time.perf_counter() - t0)
+            yield notice
+
+def percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals)-1, int(round(pct/100.0 * (len(sorted_vals)-1))))
+    return sorted_vals[idx]
+
+def parser_for(kind, data):
+    if kind == 'pcap':
+        return pimwatch.parse_pcap_notices(io.BytesIO(data))
+    return pimwatch.parse_pimdump_text(io.StringIO(data))
+
+def run_parser(kind, data):
+    '''returns (elapsed, packet count, sg count, sorted latencies)'''
+    timed = TimedIter(parser_for(kind, data))
+    sgs = 0
+    pkts = 0
+    t0 = time.perf_counter()
+    for notice in timed:
+        pkts += 1
+        sgs += len(notice.joins) + len(notice.prunes)
+    elapsed = time.perf_counter() - t0
+    return elapsed, pkts, sgs, sorted(timed.latencies)
+
+def peak_memory(kind, data):
+    # build the input stream first so its buffer copy isn't counted
+    notices = parser_for(kind, data)
+    tracemalloc.start()
+    for _ in notices:
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def main(args_in):
+    parser = argparse.ArgumentParser(
+            description='''
+Generate a synthetic PIM join/prune storm, and benchmark the pimwatch
+text and pcap parsers on it (or on a saved capture).''')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-n', '--packets', type=int, default=2000,
+        help='number of join/prune packets in the storm (default 2000)')
+    parser.add_argument('-g', '--groups', type=int, default=20,
+        help='groups per packet (default 20)')
+    parser.add_argument('-s', '--sources', type=int, default=10,
+        help='sources per group (default 10)')
+    parser.add_argument('-p', '--prune-ratio', type=float, default=0.2,
+        help='fraction of (S,G)s that are pruned instead of joined (default 0.2)')
+    parser.add_argument('--routers', type=int, default=4,
+        help='number of downstream routers sending the storm (default 4)')
+    parser.add_argument('--seed', type=int, default=1,
+        help='random seed for the storm (default 1)')
+    parser.add_argument('--write-pcap',
+        help='write the storm to this pcap file (for pimwatch.py --replay) instead of benchmarking')
+    parser.add_argument('--write-text',
+        help='write the storm to this tcpdump text file (for pimwatch.py --replay) instead of benchmarking')
+    parser.add_argument('-r', '--replay',
+        help='benchmark on this saved pcap or tcpdump text file instead of a generated storm')
+    parser.add_argument('--sgs-per-router', type=int, default=500,
+        help='(S,G)s joined per downstream router, for the sizing estimate (default 500)')
+    parser.add_argument('--refresh', type=int, default=60,
+        help='seconds between periodic join refreshes (RFC 7761 t_periodic, default 60), for the sizing estimate')
+
+    args = parser.parse_args(args_in[1:])
+    pimwatch.logger = pimwatch.get_logger('pimwatch-bench', args.verbose)
+    pimwatch.ingest_common.logger = pimwatch.logger
+
+    def storm():
+        return join_prune_storm(args.packets, args.groups, args.sources,
+                args.prune_ratio, args.routers, seed=args.seed)
+
+    if args.write_pcap or args.write_text:
+        if args.write_pcap:
+            with open(args.write_pcap, 'wb') as f:
+                write_pcap(f, storm())
+            print(f'wrote {args.packets} packets to {args.write_pcap}')
+        if args.write_text:
+            with open(args.write_text, 'w') as f:
+                write_text(f, storm())
+            print(f'wrote {args.packets} packets to {args.write_text}')
+        return 0
+
+    inputs = []
+    if args.replay:
+        with open(args.replay, 'rb') as f:
+            raw = f.read()
+        if raw[:4] in pimwatch.pcap_magics:
+            inputs.append(('pcap', raw))
+        else:
+            inputs.append(('text', raw.decode()))
+        print(f'replaying {args.replay}')
+    else:
+        pcap_f = io.BytesIO()
+        write_pcap(pcap_f, storm())
+        text_f = io.StringIO()
+        write_text(text_f, storm())
+        inputs.append(('text', text_f.getvalue()))
+        inputs.append(('pcap', pcap_f.getvalue()))
+        print(f'storm: {args.packets} packets x {args.groups} groups x {args.sources} sources, prune ratio {args.prune_ratio}, {args.routers} routers')
+
+    print(f'{"parser":<8}{"packets":>9}{"notices/s":>12}{"(S,G)s/s":>12}{"p50 us":>9}{"p99 us":>9}{"max us":>9}{"peak KiB":>10}')
+    for kind, data in inputs:
+        elapsed, pkts, sgs, lat = run_parser(kind, data)
+        peak = peak_memory(kind, data)
+        rate = pkts/elapsed if elapsed else 0
+        sg_rate = sgs/elapsed if elapsed else 0
+        print(f'{kind:<8}{pkts:>9}{rate:>12.0f}{sg_rate:>12.0f}{percentile(lat,50)*1e6:>9.1f}{percentile(lat,99)*1e6:>9.1f}{percentile(lat,100)*1e6:>9.1f}{peak/1024:>10.0f}')
+        if pkts and sgs:
+            # each router re-sends every joined (S,G) once per refresh
+            # period, packed as densely as this storm packs them.
+            sgs_per_pkt = sgs/pkts
+            router_pkt_rate = args.sgs_per_router / sgs_per_pkt / args.refresh
+            print(f'{"":<8}~{int(rate/router_pkt_rate)} downstream routers at {args.sgs_per_router} (S,G)s each, {args.refresh}s refresh, {sgs_per_pkt:.0f} (S,G)s/packet (parser only)')
+
+    return 0
+
+if __name__=="__main__":
+    ret = main(sys.argv)
+    sys.exit(ret)
@@ -8,7 +8,15 @@ import datetime
 import random
 import time
 import argparse
+import struct
+import os
+import threading
 from enum import Enum
+# ingest_common.py is copied next to this script in the image, and is
+# in common/ in the source tree
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import ingest_common
+from ingest_common import ExpiryScheduler, JoinJournalWriter
 
 '''
 sample from tcpdump -n -vvv pim:
@@ -26,16 +34,47 @@ downstream_interface = None
 joinfile = None
 
 class PimNotice(object):
-    def __init__(self, hold_time):
+    def __init__(self, hold_time, upstream_nbr=None):
         self.joins = []
         self.prunes = []
+        # hold_time is None for the "infinite" holdtime (0xffff)
         self.hold_time = hold_time
+        self.upstream_nbr = upstream_nbr
 
     def __repr__(self):
         joins = ','.join('%s->%s' % (s,g) for s,g in self.joins)
         prunes = ','.join('%s->%s' % (s,g) for s,g in self.prunes)
         return 'Joins[%s]; Prunes[%s]' % (joins, prunes)
 
+default_hold_time = datetime.timedelta(seconds=210)
+holdtime_units = {
+    'y': 365*86400,
+    'w': 7*86400,
+    'd': 86400,
+    'h': 3600,
+    'm': 60,
+    's': 1,
+}
+holdtime_re = re.compile(r'(?P<val>\d+)(?P<unit>[ywdhms])')
+
+def parse_holdtime(hold_str):
+    '''
+    parses tcpdump's holdtime string ("3m30s", "1h", "infinity") into a
+    timedelta, or None for infinity.  raises ValueError if unparseable.
+    '''
+    if hold_str == 'infinity':
+        return None
+    secs = 0
+    pos = 0
+    for m in holdtime_re.finditer(hold_str):
+        if m.start() != pos:
+            break
+        secs += int(m.group('val')) * holdtime_units[m.group('unit')]
+        pos = m.end()
+    if pos == 0 or pos != len(hold_str):
+        raise ValueError('bad holdtime "%s"' % hold_str)
+    return datetime.timedelta(seconds=secs)
+
 def pimdump_lines(ifname):
     cmd = ['/usr/bin/stdbuf', '-oL', '-eL', '/usr/sbin/tcpdump', '-i', ifname, '-vvv', '-n', '-Qin', 'pim']
     popen = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
@@ -50,10 +89,16 @@ def sg_joinprune_watch(ifname):
     '''
     watches ifname with tcpdump, yields PimNotice objects.
     '''
+    yield from parse_pimdump_text(pimdump_lines(ifname))
+
+def parse_pimdump_text(lines):
+    '''
+    parses lines of "tcpdump -vvv -n pim" output, yields PimNotice objects.
+    '''
 
     global logger
-    # TBD: notice timeout from not getting an update before holdtime
-    # (e.g. neighbor powers off abruptly)
+    # (notice timeouts from not getting an update before holdtime are
+    # handled by ChannelManager.expiry)
     # Join / Prune, cksum 0xccc9 (correct), upstream-neighbor: 10.8.1.2
     # 1 group(s), holdtime: 3m30s
     # group #1: 233.44.15.9, joined sources: 0, pruned sources: 1
@@ -65,7 +110,7 @@ def sg_joinprune_watch(ifname):
     src_re = re.compile(r'\s*(?P<jp>joined|pruned) source #(?P<idx>\d+): (?P<src>[^(]+)\(S\)\s*')
 
     reset_parse_state = True
-    for line in pimdump_lines(ifname):
+    for line in lines:
         if reset_parse_state:
             reset_parse_state = False
             cur_nbr = None
@@ -113,9 +158,17 @@ def sg_joinprune_watch(ifname):
                 reset_parse_state = True
                 continue
 
-            # TBD: parse hold time: "3m30s". Be forgiving (with warnings)...
-            hold_time = datetime.timedelta(seconds=210)
-            cur_notice = PimNotice(hold_time)
+            try:
+                hold_time = parse_holdtime(hold_str)
+            except ValueError as e:
+                logger.warning('%s, using %s from line: "%s"' % (e, default_hold_time, line))
+                hold_time = default_hold_time
+            try:
+                nbr_ip = ipaddress.ip_address(cur_nbr)
+            except ValueError as e:
+                logger.warning('%s: bad upstream-neighbor "%s"' % (e, cur_nbr))
+                nbr_ip = None
+            cur_notice = PimNotice(hold_time, nbr_ip)
             continue
 
         if not cur_notice:
@@ -193,6 +246,249 @@ def sg_joinprune_watch(ifname):
             yield cur_notice
             reset_parse_state = True
 
+# little-endian then big-endian, microsecond then nanosecond timestamps
+pcap_magics = (
+    b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1',
+    b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d',
+)
+
+# pcap linktypes we know how to strip down to the IP header
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+PIM_PROTO = 103
+PIM_TYPE_JOIN_PRUNE = 3
+PIM_HOLDTIME_INFINITE = 0xffff
+
+# encoded-source flags (RFC 7761 section 4.9.1)
+PIM_SRC_FLAG_WILDCARD = 0x02
+PIM_SRC_FLAG_RPT = 0x01
+
+pim_addr_lens = { 1: 4, 2: 16 }  # address family -> address length
+
+class PimDecodeError(ValueError):
+    pass
+
+def pimpcap_stream(ifname):
+    '''
+    runs tcpdump writing pcap to stdout for pim packets on ifname, returns
+    the popen (read the pcap stream from popen.stdout).
+    '''
+    cmd = ['/usr/sbin/tcpdump', '-i', ifname, '-n', '-Qin', '-U', '-w', '-', 'pim']
+    logger.info('running %s' % ' '.join(cmd))
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+def _read_exact(stream, n):
+    buf = stream.read(n)
+    if not buf:
+        return None
+    while len(buf) < n:
+        more = stream.read(n - len(buf))
+        if not more:
+            raise EOFError('pcap stream ended mid-record (%d of %d bytes)' % (len(buf), n))
+        buf += more
+    return buf
+
+def pcap_packets(stream):
+    '''
+    reads a pcap stream (file or pipe opened in binary mode), yields
+    (linktype, frame) for each captured packet.
+    '''
+    hdr = _read_exact(stream, 24)
+    if hdr is None:
+        return
+    magic = hdr[:4]
+    if magic in pcap_magics[:2]:
+        endian = '<'
+    elif magic in pcap_magics[2:]:
+        endian = '>'
+    else:
+        raise PimDecodeError('bad pcap magic %s' % magic.hex())
+    linktype = struct.unpack(endian + 'I', hdr[20:24])[0] & 0x0fffffff
+    rec_fmt = struct.Struct(endian + 'IIII')
+    while True:
+        rec = _read_exact(stream, rec_fmt.size)
+        if rec is None:
+            return
+        _, _, incl_len, _ = rec_fmt.unpack(rec)
+        frame = _read_exact(stream, incl_len) if incl_len else b''
+        if frame is None:
+            raise EOFError('pcap stream ended before %d-byte packet' % incl_len)
+        yield linktype, frame
+
+def frame_to_ip(linktype, frame):
+    '''
+    strips the link layer from a captured frame, returns the IP packet
+    (or None if it isn't one).
+    '''
+    if linktype == LINKTYPE_ETHERNET:
+        off = 12
+        ethertype = struct.unpack_from('!H', frame, off)[0]
+        while ethertype in (0x8100, 0x88a8):
+            off += 4
+            ethertype = struct.unpack_from('!H', frame, off)[0]
+        off += 2
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype = struct.unpack_from('!H', frame, 14)[0]
+        off = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ethertype = struct.unpack_from('!H', frame, 0)[0]
+        off = 20
+    elif linktype == LINKTYPE_RAW:
+        return frame
+    elif linktype == LINKTYPE_NULL:
+        return frame[4:]
+    else:
+        raise PimDecodeError('unsupported pcap linktype %d' % linktype)
+    if ethertype not in (0x0800, 0x86dd):
+        return None
+    return frame[off:]
+
+def ip_to_pim(pkt):
+    '''
+    returns the PIM message from an IP packet, or None if it's not PIM.
+    '''
+    if len(pkt) < 1:
+        return None
+    ver = pkt[0] >> 4
+    if ver == 4:
+        ihl = (pkt[0] & 0x0f) * 4
+        if len(pkt) < 20 or ihl < 20 or pkt[9] != PIM_PROTO:
+            return None
+        total_len = struct.unpack_from('!H', pkt, 2)[0]
+        return pkt[ihl:total_len]
+    if ver == 6:
+        # TBD: walk extension headers.  pim from routers doesn't have
+        # them in practice.
+        if len(pkt) < 40 or pkt[6] != PIM_PROTO:
+            return None
+        payload_len = struct.unpack_from('!H', pkt, 4)[0]
+        return pkt[40:40+payload_len]
+    return None
+
+def _decode_encoded_addr(msg, off, hdr_len):
+    '''
+    decodes an encoded-unicast/group/source address with hdr_len bytes of
+    header (2 for unicast, 4 for group/source) at msg[off:], returns
+    (header_bytes, ip, next_off).
+    '''
+    if off + hdr_len > len(msg):
+        raise PimDecodeError('truncated encoded address at %d' % off)
+    family = msg[off]
+    enc_type = msg[off+1]
+    if enc_type != 0:
+        raise PimDecodeError('unknown encoding type %d at %d' % (enc_type, off))
+    addr_len = pim_addr_lens.get(family)
+    if addr_len is None:
+        raise PimDecodeError('unknown address family %d at %d' % (family, off))
+    addr_off = off + hdr_len
+    end = addr_off + addr_len
+    if end > len(msg):
+        raise PimDecodeError('truncated address at %d' % addr_off)
+    ip = ipaddress.ip_address(bytes(msg[addr_off:end]))
+    return msg[off:addr_off], ip, end
+
+def decode_pim_joinprune(msg):
+    '''
+    decodes a PIMv2 Join/Prune message (RFC 7761 section 4.9.5) into a
+    PimNotice with the (S,G) joins and prunes.  returns None if it's some
+    other kind of PIM message, raises PimDecodeError if it's malformed.
+    (*,G) and (S,G,rpt) entries are skipped, only SSM (S,G)s are kept.
+    '''
+    if len(msg) < 4:
+        raise PimDecodeError('truncated pim header (%d bytes)' % len(msg))
+    ver = msg[0] >> 4
+    typ = msg[0] & 0x0f
+    if ver != 2 or typ != PIM_TYPE_JOIN_PRUNE:
+        return None
+    _, nbr_ip, off = _decode_encoded_addr(msg, 4, 2)
+    if off + 4 > len(msg):
+        raise PimDecodeError('truncated join/prune header')
+    grp_count = msg[off+1]
+    hold_secs = struct.unpack_from('!H', msg, off+2)[0]
+    off += 4
+    if hold_secs == PIM_HOLDTIME_INFINITE:
+        hold_time = None
+    else:
+        hold_time = datetime.timedelta(seconds=hold_secs)
+    notice = PimNotice(hold_time, nbr_ip)
+
+    for grp_idx in range(grp_count):
+        grp_hdr, grp_ip, off = _decode_encoded_addr(msg, off, 4)
+        if off + 4 > len(msg):
+            raise PimDecodeError('truncated source counts for group #%d' % (grp_idx+1))
+        join_cnt, prune_cnt = struct.unpack_from('!HH', msg, off)
+        off += 4
+        full_grp = grp_hdr[3] == grp_ip.max_prefixlen
+        for src_idx in range(join_cnt + prune_cnt):
+            src_hdr, src_ip, off = _decode_encoded_addr(msg, off, 4)
+            if src_hdr[2] & (PIM_SRC_FLAG_WILDCARD|PIM_SRC_FLAG_RPT):
+                logger.debug('skipping non-(S,G) source %s flags 0x%x for %s' % (src_ip, src_hdr[2], grp_ip))
+                continue
+            if not full_grp or src_hdr[3] != src_ip.max_prefixlen:
+                logger.debug('skipping masked (S,G) %s/%d->%s/%d' % (src_ip, src_hdr[3], grp_ip, grp_hdr[3]))
+                continue
+            if src_idx < join_cnt:
+                notice.joins.append((src_ip, grp_ip))
+            else:
+                notice.prunes.append((src_ip, grp_ip))
+    return notice
+
+def sg_joinprune_pcap_watch(ifname):
+    '''
+    watches ifname with tcpdump writing pcap, decodes the pim join/prune
+    packets directly and yields PimNotice objects.
+    '''
+    popen = pimpcap_stream(ifname)
+    yield from parse_pcap_notices(popen.stdout)
+    popen.stdout.close()
+    return_code = popen.wait()
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, popen.args)
+
+def parse_pcap_notices(stream):
+    '''
+    reads a pcap stream, yields a PimNotice for each join/prune packet.
+    '''
+    global logger
+    for linktype, frame in pcap_packets(stream):
+        try:
+            pkt = frame_to_ip(linktype, frame)
+            if pkt is None:
+                continue
+            msg = ip_to_pim(pkt)
+            if msg is None:
+                continue
+            notice = decode_pim_joinprune(msg)
+        except (PimDecodeError, struct.error) as e:
+            logger.warning('skipping undecodable pim packet: %s: %s' % (e, frame.hex()))
+            continue
+        if notice is None:
+            continue
+        logger.debug('decoded join/prune packet from upstream-neighbor %s' % notice.upstream_nbr)
+        yield notice
+
+def sg_joinprune_replay(fname):
+    '''
+    replays a saved capture instead of watching an interface, yields
+    PimNotice objects.  fname can be a pcap file (e.g. from
+    "tcpdump -w") or saved "tcpdump -vvv -n pim" text output.
+    '''
+    global logger
+    with open(fname, 'rb') as f:
+        is_pcap = f.read(4) in pcap_magics
+    if is_pcap:
+        logger.info('replaying pcap file %s' % fname)
+        with open(fname, 'rb') as f:
+            yield from parse_pcap_notices(f)
+    else:
+        logger.info('replaying tcpdump text file %s' % fname)
+        with open(fname) as f:
+            yield from parse_pimdump_text(f)
+
 class LiveSG(object):
     def __init__(self, source_ip, group_ip, expire_time):
         self.source = ipaddress.ip_address(source_ip)
@@ -204,15 +500,48 @@ class LiveSG(object):
     def __repr__(self):
         return '%s->%s' % (self.source, self.group)
 
+def write_joinfile(fname, sgs):
+    '''
+    writes the (S,G)s to a temp file next to fname and renames it into
+    place, so readers never see a partially written joinfile.
+    '''
+    joinfile_out = '\n'.join([f'{s},{g}' for (s,g) in sgs])
+    tmp_fname = os.path.join(os.path.dirname(fname),
+            '.' + os.path.basename(fname) + '.tmp')
+    with open(tmp_fname, 'w') as f:
+        print(joinfile_out, file=f)
+    os.replace(tmp_fname, fname)
+
 class ChannelManager(object):
 
     #dkr = '/snap/bin/docker'
     dkr = '/usr/bin/docker'
 
-    def __init__(self, upstream, downstream):
+    def __init__(self, upstream, downstream, journal=None):
         self.upstream = upstream
         self.downstream = downstream
         self.live_sgs = {}  # (src_ip,grp_ip) -> LiveSG
+        # the joinfile is published once per batch of changes (see
+        # publish), not once per (S,G)
+        self.dirty = False
+        # optional JoinJournalWriter, and the changes waiting for it
+        self.journal = journal
+        self.journal_events = []
+        # held while applying notices, and by the expiry thread
+        self.lock = threading.RLock()
+        self.expiry = ExpiryScheduler('sg-expiry', self.lock,
+                self.expire_sg, self.publish)
+
+    def publish(self):
+        global joinfile
+        if self.journal_events:
+            self.journal.append(self.journal_events)
+            self.journal_events = []
+        if not self.dirty:
+            return
+        write_joinfile(joinfile, self.live_sgs.keys())
+        self.dirty = False
+        logger.debug('published %d sgs to %s' % (len(self.live_sgs), joinfile))
 
     def launch_sg_join(self, sg, expire_time):
         global logger
@@ -231,9 +560,7 @@ class ChannelManager(object):
         # driad-ingest (or cbacc) will handle it
         live_sg = LiveSG(source, group, expire_time)
         self.live_sgs[sg] = live_sg
-        joinfile_out = '\n'.join([f'{s},{g}' for (s,g) in self.live_sgs.keys()])
-        with open(joinfile, 'w') as f:
-            print(joinfile_out, file=f)
+        self.dirty = True
 
         return live_sg
 
@@ -271,7 +598,7 @@ class ChannelManager(object):
         '''
 
     def stop_sg(self, sg):
-        global logger, joinfile
+        global logger
 
         logger.info('stopping sg %s' % (sg,))
 
@@ -281,11 +608,9 @@ class ChannelManager(object):
             logger.error('internal error: %s not in self.live_sgs in stop_sg' % (ip_sg,))
         else:
             del(self.live_sgs[ip_sg])
-
-        joinfile_out = '\n'.join([f'{s},{g}' for (s,g) in self.live_sgs.keys()])
-        with open(joinfile, 'w') as f:
-            print(joinfile_out, file=f)
-
+            self.dirty = True
+            if self.journal:
+                self.journal_events.append(('-', ip_sg, None))
 
         '''
         source = ipaddress.ip_address(source)
@@ -311,11 +636,17 @@ class ChannelManager(object):
 
     def add_or_refresh_sg(self, sg, notice_time, hold_time):
         # TBD: grace period if we took too long, maybe not just notice+hold
-        expire_time = notice_time + hold_time
+        if hold_time is None:
+            expire_time = None
+        else:
+            expire_time = notice_time + hold_time
         live_sg = self.live_sgs.get(sg)
         if live_sg:
             logger.info('live sg refreshed: %s' % (live_sg))
             live_sg.expire_time = expire_time
+            self.expiry.schedule(sg, expire_time)
+            if self.journal:
+                self.journal_events.append(('=', sg, hold_time))
             return
 
         src_ip, grp_ip = sg
@@ -325,6 +656,9 @@ class ChannelManager(object):
             live_sg = self.launch_sg_join(sg, expire_time)
             if not live_sg:
                 logger.error('failed to launch sg %s' % (sg,))
+        self.expiry.schedule(sg, expire_time)
+        if self.journal:
+            self.journal_events.append(('+', sg, hold_time))
 
     def remove_sg(self, sg):
         live_sg = self.live_sgs.get(sg)
@@ -332,6 +666,19 @@ class ChannelManager(object):
             logger.info('ignored pruning non-live sg: %s' % (sg,))
             return
         logger.info('removing live sg: %s' % (live_sg))
+        self.expiry.cancel(sg)
+        self.stop_sg(live_sg)
+
+    def expire_sg(self, sg):
+        '''
+        called from the expiry thread (holding self.lock) when the
+        holdtime for sg ran out without a refreshing join, e.g. because
+        the downstream neighbor went away without pruning.
+        '''
+        live_sg = self.live_sgs.get(sg)
+        if not live_sg:
+            return
+        logger.warning('expiring sg %s: no join since holdtime ran out at %s' % (live_sg, live_sg.expire_time))
         self.stop_sg(live_sg)
 
 def get_logger(name, verbosity=0):
@@ -359,16 +706,26 @@ def main(args_in):
         description='This is an implementation of an egress node in draft-jholland-mboned-mnat.')
 
     parser.add_argument('-v', '--verbose', action='count', default=0)
-    parser.add_argument('-u', '--upstream', required=True,
+    parser.add_argument('-u', '--upstream',
             help='this is the upstream interface, for routes to be added based on downstream join/prunes')
-    parser.add_argument('-d', '--downstream', required=True,
+    parser.add_argument('-d', '--downstream',
             help='this is the downstream interface with hopefully a connection to a pim network, monitored for joins and prunes')
     parser.add_argument('-j', '--joinfile', required=True,
         help='Name of the file inside the container where (S,G)s will be updated (needs absolute path within the container)')
+    parser.add_argument('--journal', action='store_true', default=False,
+        help='also append each change to <joinfile>.journal, so consumers started with --journal can apply changes instead of re-reading the whole joinfile')
+    parser.add_argument('-c', '--capture', choices=['pcap', 'text'],
+        default='pcap',
+        help='how to read join/prunes from tcpdump: "pcap" decodes the binary packets, "text" parses the -vvv output (default pcap)')
+    parser.add_argument('-r', '--replay',
+        help='read join/prunes from this saved pcap or "tcpdump -vvv -n pim" text file instead of the downstream interface, then exit (for testing and load generation)')
 
     args = parser.parse_args(args_in[1:])
+    if not args.replay and (not args.upstream or not args.downstream):
+        parser.error('--upstream and --downstream are required unless using --replay')
 
     logger = get_logger('pimwatch', args.verbose)
+    ingest_common.logger = logger
 
     if False: # TBD: cmd line flag?  running from service under journalctl this isn't needed but standalone it is. --jake 2020-09
         handler = RotatingFileHandler("pimwatch.log", maxBytes=10000000, backupCount=5)
@@ -379,22 +736,33 @@ def main(args_in):
     downstream_interface = args.downstream
 
     logger.info(f'started pimwatch, downstream={downstream_interface} upstream={upstream_interface}')
-    channels = ChannelManager(upstream_interface, downstream_interface)
+    journal = None
+    if args.journal:
+        journal = JoinJournalWriter(joinfile + '.journal')
+    channels = ChannelManager(upstream_interface, downstream_interface, journal)
     '''
     if ret != 0:
         logger.error('prequisites check failed')
         exit(ret)
     '''
-    with open(joinfile, 'w') as f:
-        print('', file=f)
+    write_joinfile(joinfile, [])
+
+    if args.replay:
+        watcher = sg_joinprune_replay(args.replay)
+    elif args.capture == 'text':
+        watcher = sg_joinprune_watch(downstream_interface)
+    else:
+        watcher = sg_joinprune_pcap_watch(downstream_interface)
 
-    for sgpkt in sg_joinprune_watch(downstream_interface):
+    for sgpkt in watcher:
         logger.debug('saw sg notice: "%s"', sgpkt)
         notice_time = datetime.datetime.now()
-        for sg in sgpkt.joins:
-            channels.add_or_refresh_sg(sg, notice_time, sgpkt.hold_time)
-        for sg in sgpkt.prunes:
-            channels.remove_sg(sg)
+        with channels.lock:
+            for sg in sgpkt.joins:
+                channels.add_or_refresh_sg(sg, notice_time, sgpkt.hold_time)
+            for sg in sgpkt.prunes:
+                channels.remove_sg(sg)
+            channels.publish()
     return 0
 
 if __name__=="__main__":
@@ -1,4 +1,4 @@
 #!/usr/bin/env bash
 
-docker build -t ingest-rtr:latest .
+docker build --file src/Dockerfile -t ingest-rtr:latest .
 
@@ -6,8 +6,16 @@ import ipaddress
 import re
 import datetime
 import random
+import struct
 import time
+import os
+import threading
 from enum import Enum
+# ingest_common.py is copied next to this script in the image, and is
+# in common/ in the source tree
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import ingest_common
+from ingest_common import DockerError, DockerEngine
 
 '''
 sample from tcpdump -n -vvv pim:
@@ -25,16 +33,47 @@ upstream_neighbor_ip = '10.10.1.1'
 self_ip = '10.9.1.128'
 
 class PimNotice(object):
-    def __init__(self, hold_time):
+    def __init__(self, hold_time, upstream_nbr=None):
         self.joins = []
         self.prunes = []
+        # hold_time is None for the "infinite" holdtime (0xffff)
         self.hold_time = hold_time
+        self.upstream_nbr = upstream_nbr
 
     def __repr__(self):
         joins = ','.join('%s->%s' % (s,g) for s,g in self.joins)
         prunes = ','.join('%s->%s' % (s,g) for s,g in self.prunes)
         return 'Joins[%s]; Prunes[%s]' % (joins, prunes)
 
+default_hold_time = datetime.timedelta(seconds=210)
+holdtime_units = {
+    'y': 365*86400,
+    'w': 7*86400,
+    'd': 86400,
+    'h': 3600,
+    'm': 60,
+    's': 1,
+}
+holdtime_re = re.compile(r'(?P<val>\d+)(?P<unit>[ywdhms])')
+
+def parse_holdtime(hold_str):
+    '''
+    parses tcpdump's holdtime string ("3m30s", "1h", "infinity") into a
+    timedelta, or None for infinity.  raises ValueError if unparseable.
+    '''
+    if hold_str == 'infinity':
+        return None
+    secs = 0
+    pos = 0
+    for m in holdtime_re.finditer(hold_str):
+        if m.start() != pos:
+            break
+        secs += int(m.group('val')) * holdtime_units[m.group('unit')]
+        pos = m.end()
+    if pos == 0 or pos != len(hold_str):
+        raise ValueError('bad holdtime "%s"' % hold_str)
+    return datetime.timedelta(seconds=secs)
+
 def pimdump_lines(ifname):
     global self_ip
     # filtering self_ip is a hack workaround because frr's mrib doesn't
@@ -114,9 +153,17 @@ def sg_joinprune_watch(ifname):
                 reset_parse_state = True
                 continue
 
-            # TBD: parse hold time: "3m30s". Be forgiving (with warnings)...
-            hold_time = datetime.timedelta(seconds=210)
-            cur_notice = PimNotice(hold_time)
+            try:
+                hold_time = parse_holdtime(hold_str)
+            except ValueError as e:
+                logger.warning('%s, using %s from line: "%s"' % (e, default_hold_time, line))
+                hold_time = default_hold_time
+            try:
+                nbr_ip = ipaddress.ip_address(cur_nbr)
+            except ValueError as e:
+                logger.warning('%s: bad upstream-neighbor "%s"' % (e, cur_nbr))
+                nbr_ip = None
+            cur_notice = PimNotice(hold_time, nbr_ip)
             continue
 
         if not cur_notice:
@@ -194,6 +241,221 @@ def sg_joinprune_watch(ifname):
             yield cur_notice
             reset_parse_state = True
 
+# pcap linktypes we know how to strip down to the IP header
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+PIM_PROTO = 103
+PIM_TYPE_JOIN_PRUNE = 3
+PIM_HOLDTIME_INFINITE = 0xffff
+
+# encoded-source flags (RFC 7761 section 4.9.1)
+PIM_SRC_FLAG_WILDCARD = 0x02
+PIM_SRC_FLAG_RPT = 0x01
+
+pim_addr_lens = { 1: 4, 2: 16 }  # address family -> address length
+
+class PimDecodeError(ValueError):
+    pass
+
+def pimpcap_stream(ifname):
+    '''
+    runs tcpdump writing pcap to stdout for pim packets on ifname, returns
+    the popen (read the pcap stream from popen.stdout).
+    '''
+    global self_ip
+    # filtering self_ip as in pimdump_lines
+    cmd = ['/usr/sbin/tcpdump', '-i', ifname, '-n', '-U', '-w', '-', 'pim', 'and', 'not', 'host', self_ip]
+    logger.info('running %s' % ' '.join(cmd))
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+def _read_exact(stream, n):
+    buf = stream.read(n)
+    if not buf:
+        return None
+    while len(buf) < n:
+        more = stream.read(n - len(buf))
+        if not more:
+            raise EOFError('pcap stream ended mid-record (%d of %d bytes)' % (len(buf), n))
+        buf += more
+    return buf
+
+def pcap_packets(stream):
+    '''
+    reads a pcap stream (file or pipe opened in binary mode), yields
+    (linktype, frame) for each captured packet.
+    '''
+    hdr = _read_exact(stream, 24)
+    if hdr is None:
+        return
+    magic = hdr[:4]
+    if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+        endian = '<'
+    elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+        endian = '>'
+    else:
+        raise PimDecodeError('bad pcap magic %s' % magic.hex())
+    linktype = struct.unpack(endian + 'I', hdr[20:24])[0] & 0x0fffffff
+    rec_fmt = struct.Struct(endian + 'IIII')
+    while True:
+        rec = _read_exact(stream, rec_fmt.size)
+        if rec is None:
+            return
+        _, _, incl_len, _ = rec_fmt.unpack(rec)
+        frame = _read_exact(stream, incl_len) if incl_len else b''
+        if frame is None:
+            raise EOFError('pcap stream ended before %d-byte packet' % incl_len)
+        yield linktype, frame
+
+def frame_to_ip(linktype, frame):
+    '''
+    strips the link layer from a captured frame, returns the IP packet
+    (or None if it isn't one).
+    '''
+    if linktype == LINKTYPE_ETHERNET:
+        off = 12
+        ethertype = struct.unpack_from('!H', frame, off)[0]
+        while ethertype in (0x8100, 0x88a8):
+            off += 4
+            ethertype = struct.unpack_from('!H', frame, off)[0]
+        off += 2
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype = struct.unpack_from('!H', frame, 14)[0]
+        off = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ethertype = struct.unpack_from('!H', frame, 0)[0]
+        off = 20
+    elif linktype == LINKTYPE_RAW:
+        return frame
+    elif linktype == LINKTYPE_NULL:
+        return frame[4:]
+    else:
+        raise PimDecodeError('unsupported pcap linktype %d' % linktype)
+    if ethertype not in (0x0800, 0x86dd):
+        return None
+    return frame[off:]
+
+def ip_to_pim(pkt):
+    '''
+    returns the PIM message from an IP packet, or None if it's not PIM.
+    '''
+    if len(pkt) < 1:
+        return None
+    ver = pkt[0] >> 4
+    if ver == 4:
+        ihl = (pkt[0] & 0x0f) * 4
+        if len(pkt) < 20 or ihl < 20 or pkt[9] != PIM_PROTO:
+            return None
+        total_len = struct.unpack_from('!H', pkt, 2)[0]
+        return pkt[ihl:total_len]
+    if ver == 6:
+        # TBD: walk extension headers.  pim from routers doesn't have
+        # them in practice.
+        if len(pkt) < 40 or pkt[6] != PIM_PROTO:
+            return None
+        payload_len = struct.unpack_from('!H', pkt, 4)[0]
+        return pkt[40:40+payload_len]
+    return None
+
+def _decode_encoded_addr(msg, off, hdr_len):
+    '''
+    decodes an encoded-unicast/group/source address with hdr_len bytes of
+    header (2 for unicast, 4 for group/source) at msg[off:], returns
+    (header_bytes, ip, next_off).
+    '''
+    if off + hdr_len > len(msg):
+        raise PimDecodeError('truncated encoded address at %d' % off)
+    family = msg[off]
+    enc_type = msg[off+1]
+    if enc_type != 0:
+        raise PimDecodeError('unknown encoding type %d at %d' % (enc_type, off))
+    addr_len = pim_addr_lens.get(family)
+    if addr_len is None:
+        raise PimDecodeError('unknown address family %d at %d' % (family, off))
+    addr_off = off + hdr_len
+    end = addr_off + addr_len
+    if end > len(msg):
+        raise PimDecodeError('truncated address at %d' % addr_off)
+    ip = ipaddress.ip_address(bytes(msg[addr_off:end]))
+    return msg[off:addr_off], ip, end
+
+def decode_pim_joinprune(msg):
+    '''
+    decodes a PIMv2 Join/Prune message (RFC 7761 section 4.9.5) into a
+    PimNotice with the (S,G) joins and prunes.  returns None if it's some
+    other kind of PIM message, raises PimDecodeError if it's malformed.
+    (*,G) and (S,G,rpt) entries are skipped, only SSM (S,G)s are kept.
+    '''
+    if len(msg) < 4:
+        raise PimDecodeError('truncated pim header (%d bytes)' % len(msg))
+    ver = msg[0] >> 4
+    typ = msg[0] & 0x0f
+    if ver != 2 or typ != PIM_TYPE_JOIN_PRUNE:
+        return None
+    _, nbr_ip, off = _decode_encoded_addr(msg, 4, 2)
+    if off + 4 > len(msg):
+        raise PimDecodeError('truncated join/prune header')
+    grp_count = msg[off+1]
+    hold_secs = struct.unpack_from('!H', msg, off+2)[0]
+    off += 4
+    if hold_secs == PIM_HOLDTIME_INFINITE:
+        hold_time = None
+    else:
+        hold_time = datetime.timedelta(seconds=hold_secs)
+    notice = PimNotice(hold_time, nbr_ip)
+
+    for grp_idx in range(grp_count):
+        grp_hdr, grp_ip, off = _decode_encoded_addr(msg, off, 4)
+        if off + 4 > len(msg):
+            raise PimDecodeError('truncated source counts for group #%d' % (grp_idx+1))
+        join_cnt, prune_cnt = struct.unpack_from('!HH', msg, off)
+        off += 4
+        full_grp = grp_hdr[3] == grp_ip.max_prefixlen
+        for src_idx in range(join_cnt + prune_cnt):
+            src_hdr, src_ip, off = _decode_encoded_addr(msg, off, 4)
+            if src_hdr[2] & (PIM_SRC_FLAG_WILDCARD|PIM_SRC_FLAG_RPT):
+                logger.debug('skipping non-(S,G) source %s flags 0x%x for %s' % (src_ip, src_hdr[2], grp_ip))
+                continue
+            if not full_grp or src_hdr[3] != src_ip.max_prefixlen:
+                logger.debug('skipping masked (S,G) %s/%d->%s/%d' % (src_ip, src_hdr[3], grp_ip, grp_hdr[3]))
+                continue
+            if src_idx < join_cnt:
+                notice.joins.append((src_ip, grp_ip))
+            else:
+                notice.prunes.append((src_ip, grp_ip))
+    return notice
+
+def sg_joinprune_pcap_watch(ifname):
+    '''
+    watches ifname with tcpdump writing pcap, decodes the pim join/prune
+    packets directly and yields PimNotice objects.
+    '''
+    global logger
+    popen = pimpcap_stream(ifname)
+    for linktype, frame in pcap_packets(popen.stdout):
+        try:
+            pkt = frame_to_ip(linktype, frame)
+            if pkt is None:
+                continue
+            msg = ip_to_pim(pkt)
+            if msg is None:
+                continue
+            notice = decode_pim_joinprune(msg)
+        except (PimDecodeError, struct.error) as e:
+            logger.warning('skipping undecodable pim packet: %s: %s' % (e, frame.hex()))
+            continue
+        if notice is None:
+            continue
+        logger.debug('decoded join/prune packet from upstream-neighbor %s' % notice.upstream_nbr)
+        yield notice
+    popen.stdout.close()
+    return_code = popen.wait()
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, popen.args)
+
 class AMTRelayOption(object):
     def __init__(self, precedence, discovery_optional, typ, value):
         self.precedence = int(precedence)
@@ -362,8 +624,9 @@ class ChannelManager(object):
     #dkr = '/snap/bin/docker'
     dkr = '/usr/bin/docker'
 
-    def __init__(self, ifname):
+    def __init__(self, ifname, docker_socket='/var/run/docker.sock'):
         self.ifname = ifname
+        self.docker = DockerEngine(docker_socket)
         self.live_sgs = {}  # (src_ip,grp_ip) -> LiveSG
         self.relay_ips = {} # source_ip -> relay_ip
         self.live_gateways = {} # relay_ip -> AMTGateway
@@ -388,46 +651,30 @@ ingest-frr
         # at startup, give docker service some time to start
         retries = 0
         while True:
-            cmd = [ChannelManager.dkr, 'container', 'ls', '--format={{.Names}}']
-            dock_p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-            out, err = dock_p.communicate(cmd)
-            retcode = dock_p.wait()
-            if retcode == 0:
+            try:
+                names = self.docker.container_names()
                 if retries != 0:
                     logger.info('(retry successful)')
                 break
-
-            retries += 1
-            if retries > 5:
-                logger.error('(startup docker functionality check: retry limit exceeded): return code %d from %s, out="%s", err="%s"' % (retcode, cmd, out.strip(), err.strip()))
-                return -1
-            logger.info('(retry in 1s) return code %d from %s, out="%s", err="%s"' % (retcode, cmd, out.strip(), err.strip()))
-            time.sleep(1)
-
-        if err:
-            logger.warning('stderr output from %s: "%s"' % (cmd, err))
-
-        for line in out.split('\n'):
-            if line.startswith('pimwatch-'):
-                logger.warning('shutting down pre-existing pimwatch container %s' % line)
-
-                cmd = [ChannelManager.dkr, 'stop', line.strip()]
-                dock_p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-                out, err = dock_p.communicate(cmd)
-                retcode = dock_p.wait()
-                if retcode != 0:
-                    logger.error('shutdown of pre-existing pimwatch container %s failed, aborting' % line)
-                    logger.error('return code %d from %s, out="%s", err="%s"' % (retcode, cmd, out, err))
+            except DockerError as e:
+                retries += 1
+                if retries > 5:
+                    logger.error('(startup docker functionality check: retry limit exceeded): %s' % (e,))
+                    return -1
+                logger.info('(retry in 1s) %s' % (e,))
+                time.sleep(1)
+
+        for name in names:
+            if name.startswith('pimwatch-'):
+                logger.warning('shutting down pre-existing pimwatch container %s' % name)
+                try:
+                    self.docker.stop(name)
+                except DockerError as e:
+                    logger.error('shutdown of pre-existing pimwatch container %s failed, aborting' % name)
+                    logger.error('%s' % (e,))
                     return -1
 
-                if err:
-                    logger.warning('stderr output from %s: "%s"' % (cmd, err))
-
-        cmd = [ChannelManager.dkr, 'network', 'inspect', mcast_nwname]
-        dock_p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        out, err = dock_p.communicate(cmd)
-        retcode = dock_p.wait()
-        if retcode != 0:
+        if not self.docker.network_exists(mcast_nwname):
             logger.error('no %s network detected, aborting' % mcast_nwname)
 
             '''
@@ -539,42 +786,16 @@ ingest-frr
         global logger, mcast_nwname, amt_bridge_nwname
         logger.info('launching gateway to relay %s' % (relay_ip,))
 
-        nwname = mcast_nwname
         contname = 'pimwatch-gw-%s' % (relay_ip.exploded)
         imagename = 'grumpyoldtroll/amtgw:latest'
-        cmd = [ChannelManager.dkr, 'create', '--rm', '--name', contname, '--privileged', '--network', amt_bridge_nwname, imagename, str(relay_ip)]
-        logger.info('running: %s' % (' '.join(cmd)))
-        launch_p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        out, err = launch_p.communicate(cmd)
-        retcode = launch_p.wait()
-        if retcode != 0:
-            logger.error('return code %s from %s, out="%s", err="%s", failed gw launch' % (retcode, cmd, out, err))
-            return None
-
-        cmd = [ChannelManager.dkr, 'network', 'connect', nwname, contname]
-        logger.info('running: %s' % (' '.join(cmd)))
-        connect_p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        out, err = connect_p.communicate(cmd)
-        retcode = connect_p.wait()
-        if retcode != 0:
-            logger.error('return code %s from %s, out="%s", err="%s", failed gw connect' % (retcode, cmd, out, err))
-            cmd = [ChannelManager.dkr, 'container', 'stop', contname]
-            stopret = subprocess.run(cmd)
-            logger.warning('stopped container: %s' % (stopret))
-            return None
-
-        time.sleep(1)
-        cmd = [ChannelManager.dkr, 'start', contname]
-        logger.info('running: %s' % (' '.join(cmd)))
-        start_p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        out, err = start_p.communicate(cmd)
-        retcode = start_p.wait()
-        if retcode != 0:
-            logger.error('return code %s from %s, out="%s", err="%s", failed gw start' % (retcode, cmd, out, err))
-            cmd = [ChannelManager.dkr, 'container', 'stop', contname]
-            stopret = subprocess.run(cmd)
-            logger.warning('stopped container: %s' % (stopret))
+        start_time = time.monotonic()
+        try:
+            self.docker.run_gateway(contname, imagename, [str(relay_ip)],
+                    amt_bridge_nwname, mcast_nwname)
+        except DockerError as e:
+            logger.error('failed gw launch to relay %s: %s' % (relay_ip, e))
             return None
+        logger.info('launched gateway to relay %s in %.3fs' % (relay_ip, time.monotonic() - start_time))
 
         gw = AMTGateway(relay_ip, contname)
         self.live_gateways[relay_ip] = gw
@@ -628,12 +849,20 @@ ingest-frr
         global logger
 
         logger.info('stopping gw %s' % gw)
-        cmd = [ChannelManager.dkr, 'container', 'stop', gw.contname]
-        stopret = subprocess.run(cmd)
-        logger.info('stopped container: %s' % (stopret))
+        # docker takes a while to stop a container, don't hold up the
+        # pim watching for it.
+        threading.Thread(target=self.stop_gateway_container, args=(gw.contname,), daemon=True).start()
 
         del(self.live_gateways[gw.relay_ip])
 
+    def stop_gateway_container(self, contname):
+        global logger
+        try:
+            self.docker.stop(contname)
+            logger.info('stopped container: %s' % (contname))
+        except DockerError as e:
+            logger.error('failed to stop container %s: %s' % (contname, e))
+
     def stop_sg(self, sg):
         global logger, upstream_neighbor_ip
 
@@ -699,7 +928,10 @@ ingest-frr
         global upstream_neighbor_ip
 
         # TBD: grace period if we took too long, maybe not just notice+hold
-        expire_time = notice_time + hold_time
+        if hold_time is None:
+            expire_time = None
+        else:
+            expire_time = notice_time + hold_time
         live_sg = self.live_sgs.get(sg)
         if live_sg:
             logger.info('live sg refreshed: %s' % (live_sg))
@@ -782,6 +1014,7 @@ def main(args):
         logger.addHandler(handler)
 
     logger.setLevel(logging.INFO)
+    ingest_common.logger = logger
 
     ifname = args[1]
     dnsserver = None
@@ -797,7 +1030,7 @@ def main(args):
         logger.error('prequisites check failed')
         exit(ret)
 
-    for sgpkt in sg_joinprune_watch(ifname):
+    for sgpkt in sg_joinprune_pcap_watch(ifname):
         logger.debug('saw sg notice: "%s"', sgpkt)
         notice_time = datetime.datetime.now()
         for sg in sgpkt.joins: